@@ -0,0 +1,182 @@
+# -*- coding:utf-8 -*-
+import datetime
+from utils.reader import NewsReader, EventReader
+from utils.codec import VectorCodec
+
+
+class MemoryCursor(list):
+    """
+    查詢結果, 與pymongo cursor一樣提供count()
+    """
+    def count(self):
+        return len(self)
+
+
+def match(doc, item):
+    """
+    簡單的mongoDB查詢條件: 相等, $in, $gt, $lt, $or
+    :param doc: document
+    :param item: 查詢條件, dict
+    :return: bool
+    """
+    for key, cond in item.iteritems():
+        if key == '$or':
+            if not any(match(doc, sub) for sub in cond):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(cond, dict):
+            for op, arg in cond.iteritems():
+                if op == '$in' and value not in arg:
+                    return False
+                if op == '$gt' and not (value is not None and value > arg):
+                    return False
+                if op == '$lt' and not (value is not None and value < arg):
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def project(doc, fields):
+    if not fields:
+        return dict(doc)
+    return dict((key, value) for key, value in doc.iteritems() if key == '_id' or fields.get(key))
+
+
+class MemoryNewsReader(NewsReader):
+    """
+    記憶體中的news collection, 介面同NewsReader, 用於benchmark
+    """
+    def __init__(self):
+        self.news = {}
+
+    def remove_collection(self):
+        self.news = {}
+
+    def insert_item(self, item):
+        self.news[item['_id']] = item
+        return item['_id']
+
+    def save_item(self, item):
+        return self.insert_item(item)
+
+    def query_many_by_time(self, start_time, end_time, include_start=False, fields=None):
+        start_time = start_time.replace("-", "").replace(" ", "").replace(":", "")
+        end_time = end_time.replace("-", "").replace(" ", "").replace(":", "")
+        result = [project(news, fields) for news in self.news.itervalues()
+                  if (start_time < news['crawlTime'] or include_start and start_time == news['crawlTime'])
+                  and news['crawlTime'] < end_time]
+        return MemoryCursor(sorted(result, key=lambda news: (news['crawlTime'], news['_id'])))
+
+    def count_many_by_time(self, start_time, end_time, include_start=False):
+        start_time = start_time.replace("-", "").replace(" ", "").replace(":", "")
+        end_time = end_time.replace("-", "").replace(" ", "").replace(":", "")
+        return sum(1 for news in self.news.itervalues()
+                   if (start_time < news['crawlTime'] or include_start and start_time == news['crawlTime'])
+                   and news['crawlTime'] < end_time)
+
+    def create_tail_index(self):
+        return "crawlTime_1__id_1"
+
+    def query_many_after(self, crawl_time, news_id, limit):
+        result = [dict(news) for news in self.news.itervalues()
+                  if (news['crawlTime'], news['_id']) > (crawl_time, news_id)]
+        return MemoryCursor(sorted(result, key=lambda news: (news['crawlTime'], news['_id']))[:limit])
+
+    def query_many_by_item(self, item, fields=None):
+        # 常見的 {'_id': {'$in': [...]}} 直接以key查詢
+        if item.keys() == ['_id'] and isinstance(item['_id'], dict) and item['_id'].keys() == ['$in']:
+            return MemoryCursor(project(self.news[news_id], fields) for news_id in item['_id']['$in'] if news_id in self.news)
+        return MemoryCursor(project(news, fields) for news in self.news.itervalues() if match(news, item))
+
+    def query_one_by_item(self, item):
+        result = self.query_many_by_item(item)
+        return result[0] if result else None
+
+
+class MemoryEventReader(EventReader):
+    """
+    記憶體中的event collection, 介面同EventReader, 用於benchmark
+    讀取時回傳複本, 與mongoDB一樣不會因為Model修改結果而改變collection
+    """
+    def __init__(self, window=10):
+        self.events = {}
+        self.articles = {}
+        self.day_diff = 86400
+        self.window = window
+        self.codec = VectorCodec()
+
+    def copy(self, event):
+        event = dict(event)
+        event['articles'] = [dict(article) for article in event.get('articles', [])]
+        return event
+
+    def remove_collection(self):
+        self.events = {}
+        self.articles = {}
+
+    def insert_item(self, item):
+        self.events[item['_id']] = self.copy(item)
+        return item['_id']
+
+    def save_item(self, item):
+        return self.insert_item(item)
+
+    def save_items(self, items):
+        for item in items:
+            self.insert_item(item)
+        return len(items)
+
+    def update_item(self, item_id, update, item=None):
+        return self.insert_item(item)
+
+    def create_modified_index(self):
+        return None
+
+    def create_article_index(self):
+        return None
+
+    def save_articles(self, event_id, articles, start=0):
+        members = self.articles.setdefault(event_id, [])
+        members[start:] = [dict(article) for article in articles]
+        return len(articles)
+
+    def query_articles(self, event_ids, page_size=1000):
+        for event_id in event_ids:
+            for pos, article in enumerate(self.articles.get(event_id, [])):
+                yield dict(article, event=event_id, pos=pos)
+
+    def close_events(self, t):
+        modified = self.time2time_string(datetime.datetime.now())
+        for event in self.events.itervalues():
+            if event['updated'] <= t and event['closed'] is False:
+                event['closed'] = True
+                event['modified'] = modified
+
+    def close_events_by_ids(self, event_ids, batch_size=500):
+        modified = self.time2time_string(datetime.datetime.now())
+        count = 0
+        for event_id in event_ids:
+            event = self.events.get(event_id)
+            if event and event['closed'] is False:
+                event['closed'] = True
+                event['modified'] = modified
+                count += 1
+        return count
+
+    def query_many_by_time(self, start_time, end_time, include_end=False):
+        return MemoryCursor(self.copy(event) for event in self.events.itervalues()
+                            if start_time < event['updated'] and (event['updated'] <= end_time if include_end
+                                                                  else event['updated'] < end_time)
+                            and event['closed'] is False)
+
+    def query_many_by_item(self, item):
+        return MemoryCursor(self.copy(event) for event in self.events.itervalues() if match(event, item))
+
+    def query_one_by_item(self, item):
+        if item.keys() == ['_id']:
+            event = self.events.get(item['_id'])
+            return self.copy(event) if event else None
+        result = self.query_many_by_item(item)
+        return result[0] if result else None
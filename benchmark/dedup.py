@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+"""
+近似重複合併 (--dedup) 在真實時間段上減少的工作量: 每個capture (python main.py capture) 各replay兩次, 比較有無 --dedup
+
+    python -m benchmark.dedup log/capture/*.jsonl.gz -o log/benchmark_dedup.json
+
+工作量以 vectorize 的新聞數, 聚類時與centroid的相似度計算次數 (similarities) 以及 cluster 階段的時間計算
+"""
+import os
+import json
+import argparse
+import datetime
+import tempfile
+from collections import OrderedDict
+
+from replay import replay
+
+
+def run(bundle, args, dedup):
+    fd, output = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        return replay(argparse.Namespace(bundle=bundle, output=output, baseline=None, dimension=args.dimension,
+                                         sim=args.sim, merge_sim=args.merge_sim, sub_sim=args.sub_sim,
+                                         keep=False, dedup=dedup))
+    finally:
+        os.remove(output)
+
+
+def removed(base, current):
+    return round(1. - float(current) / base, 4) if base else 0.
+
+
+def compare(bundle, args):
+    base = run(bundle, args, dedup=False)
+    current = run(bundle, args, dedup=True)
+    base_counters, counters = base['counters'], current['counters']
+    base_cluster, cluster = base['stages']['cluster']['wall'], current['stages']['cluster']['wall']
+    # 合併後event的成員仍包含全部的重複新聞, 以成員比較聚類結果
+    same = set(tuple(e['members']) for e in base['events']) & set(tuple(e['members']) for e in current['events'])
+    return OrderedDict([('bundle', bundle),
+                        ('start', base['start']),
+                        ('news', base_counters.get('news_in', 0)),
+                        ('representatives', counters.get('dedup_representatives', 0)),
+                        ('copies', counters.get('dedup_copies', 0)),
+                        ('vectorize_removed', removed(base_counters.get('news_vectorized', 0), counters.get('news_vectorized', 0))),
+                        ('similarities_removed', removed(base_counters.get('similarities', 0), counters.get('similarities', 0))),
+                        ('cluster_seconds', [base_cluster, cluster]),
+                        ('cluster_time_removed', removed(base_cluster, cluster)),
+                        ('wall_seconds', [base['wall_seconds'], current['wall_seconds']]),
+                        ('events', [len(base['events']), len(current['events'])]),
+                        ('same_events', len(same))])
+
+
+def main(args):
+    windows = []
+    for bundle in args.bundles:
+        result = compare(bundle, args)
+        print "  %s news = %d copies = %d similarities removed = %.1f%% cluster time removed = %.1f%% same events = %d/%d" % \
+            (result['start'], result['news'], result['copies'], 100 * result['similarities_removed'],
+             100 * result['cluster_time_removed'], result['same_events'], result['events'][0])
+        windows.append(result)
+
+    n_news = sum(w['news'] for w in windows)
+    n_copies = sum(w['copies'] for w in windows)
+    result = OrderedDict([('created', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+                          ('windows', windows),
+                          ('news', n_news),
+                          ('copies', n_copies),
+                          ('copies_fraction', round(float(n_copies) / n_news, 4) if n_news else 0.)])
+    print "news =", n_news, "copies =", n_copies, "fraction =", result['copies_fraction']
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(args.output, "w") as f:
+        f.write(json.dumps(result, indent=2))
+    print "result", args.output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the work removed by near-duplicate collapse on captured windows")
+    parser.add_argument("bundles", nargs="+", help="Capture bundles written by `python main.py capture`")
+    parser.add_argument("-o", "--output", default=os.path.join("log", "benchmark_dedup.json"),
+                        help="Result JSON. default=log/benchmark_dedup.json")
+    parser.add_argument("-dim", "--dimension", type=int, help="Vector dimension. default=captured value")
+    parser.add_argument("-s", '--sim', type=float, help="Similarity threshold. default=captured value")
+    parser.add_argument("-ms", '--merge_sim', type=float, help="Merge similarity threshold. default=captured value")
+    parser.add_argument("-ss", '--sub_sim', type=float, help="Subevent similarity threshold. default=captured value")
+    main(parser.parse_args())
@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+"""
+write_event實體彙整的benchmark: 原本的巢狀函式 + 全排序 + sklearn normalize 與 utils.entity.EntityAggregator 比較
+
+    python -m benchmark.entities -e 2000 -m 50 -o log/benchmark_entities.json
+
+同時確認兩者輸出相同, 並量測批次模式 (aggregate_many) 讀取heavy欄位的次數
+以很小的max_strings再彙整一次 (accumulate與decode), 確認intern表不超過上限且輸出不變
+"""
+import os
+import json
+import time
+import random
+import argparse
+import datetime
+from collections import OrderedDict
+
+from sklearn import preprocessing
+
+from utils.entity import EntityAggregator
+from generator import SyntheticCorpus
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_aggregate(news_list, decay=0.99, k_important=20):
+    """
+    原本write_event中的實體彙整, 保留作為比較基準
+    """
+    weight = 1.0
+    keywords = {}
+    persons = {}
+    locations = {}
+    organizations = {}
+    when_dict = {}
+    who_dict = {}
+    where_dict = {}
+
+    def update_score(input_list, update_dict, weight):
+        for keyword in input_list:
+            wd = keyword['word']
+            score = keyword['score']
+            if wd not in update_dict:
+                update_dict[wd] = score * weight
+            else:
+                update_dict[wd] += score * weight
+
+    def update_ner_score(input_list, update_dict, weight):
+        for keyword in input_list:
+            mention = keyword['mention']
+            count = keyword['count']
+            url = keyword['linkedURL']
+            if mention not in update_dict:
+                update_dict[mention] = {'count': count, 'linkedURL': url}
+            else:
+                update_dict[mention]['count'] += count
+
+    for news in news_list:
+        update_score(news['keywords'], keywords, weight)
+        update_score(news['when'], when_dict, weight)
+        update_score(news['where'], where_dict, weight)
+        update_score(news['who'], who_dict, weight)
+        update_ner_score(news['persons'], persons, weight)
+        update_ner_score(news['locations'], locations, weight)
+        update_ner_score(news['organizations'], organizations, weight)
+        weight *= decay
+
+    def normalize_entities(ent_dict, k_important):
+        if not ent_dict:
+            return []
+        sort_ent_list = sorted(ent_dict.iteritems(), key=lambda x: x[1], reverse=True)
+        word_list, score_list = zip(*sort_ent_list)
+        norm_score_list = preprocessing.normalize([score_list])[0]
+        return [{'word': word, 'score': '{:.2f}'.format(score)} for word, score in zip(word_list, norm_score_list)[:k_important]]
+
+    def normalize_ner_entities(ent_dict, k_important=10):
+        if not ent_dict:
+            return []
+        sort_ent_list = sorted(ent_dict.iteritems(), key=lambda x: x[1]['count'], reverse=True)
+        mention_list, score_dict = zip(*sort_ent_list)
+        score_tuple = [(i['count'], i['linkedURL']) for i in score_dict]
+        count_list, url_list = zip(*score_tuple)
+        norm_score_list = preprocessing.normalize([count_list])[0]
+        return [{'mention': mention, 'count': '{:.2f}'.format(count), 'score': '{:.2f}'.format(score), 'linkedURL': url}
+                for mention, count, score, url in zip(mention_list, count_list, norm_score_list, url_list)[:k_important]]
+
+    return {'keywords': normalize_entities(keywords, k_important),
+            'when': normalize_entities(when_dict, k_important),
+            'where': normalize_entities(where_dict, k_important),
+            'who': normalize_entities(who_dict, k_important),
+            'persons': normalize_ner_entities(persons, k_important),
+            'locations': normalize_ner_entities(locations, k_important),
+            'organizations': normalize_ner_entities(organizations, k_important)}
+
+
+def build_events(args):
+    """
+    :return: heavy: { news_id: heavy dict }
+    :return: events: list of (event_id, 成員新聞id list)
+    """
+    corpus = SyntheticCorpus(vocab_file=os.path.join(REPO, "utils", "2200.txt"), n_topics=args.topics, seed=args.seed)
+    rng = random.Random(args.seed)
+    start_time = datetime.datetime(2018, 3, 1)
+    heavy = {}
+    events = []
+    n = 0
+    for i in range(args.events):
+        topic = rng.randrange(args.topics)
+        news_ids = []
+        for _ in range(rng.randint(1, 2 * args.members - 1)):
+            news = corpus.news("n%08d" % n, topic, start_time + datetime.timedelta(seconds=n))
+            heavy[news['_id']] = dict((field, news[field]) for field in
+                                      ('keywords', 'when', 'where', 'who', 'persons', 'locations', 'organizations'))
+            news_ids.append(news['_id'])
+            n += 1
+        events.append(("e%06d" % i, news_ids))
+    return heavy, events
+
+
+def main(args):
+    heavy, events = build_events(args)
+    n_news = sum(len(news_ids) for _, news_ids in events)
+    print "events =", len(events), "news =", n_news
+
+    t = time.time()
+    legacy = dict((event_id, legacy_aggregate([heavy[news_id] for news_id in news_ids])) for event_id, news_ids in events)
+    legacy_wall = time.time() - t
+
+    aggregator = EntityAggregator()
+    t = time.time()
+    current = dict((event_id, aggregator.aggregate([heavy[news_id] for news_id in news_ids])) for event_id, news_ids in events)
+    current_wall = time.time() - t
+
+    loads = [0]
+
+    def load(news_ids):
+        loads[0] += 1
+        return dict((news_id, heavy[news_id]) for news_id in news_ids)
+
+    t = time.time()
+    batched = dict(aggregator.aggregate_many(events, load, batch_size=args.batch_size))
+    batched_wall = time.time() - t
+
+    # intern表上限: 經過accumulate與decode的字串遠多於max_strings時, 表的大小仍不超過上限
+    bounded = EntityAggregator(max_strings=args.max_strings)
+    peak = 0
+    capped = {}
+    for event_id, news_ids in events:
+        state = bounded.accumulate(bounded.new_state(), [heavy[news_id] for news_id in news_ids])
+        peak = max(peak, bounded.n_strings())
+        state = bounded.decode(bounded.encode(state))
+        peak = max(peak, bounded.n_strings())
+        capped[event_id] = bounded.rank(state)
+    n_strings = aggregator.n_strings()
+
+    result = OrderedDict([('created', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+                          ('events', len(events)),
+                          ('news', n_news),
+                          ('legacy_seconds', round(legacy_wall, 3)),
+                          ('aggregator_seconds', round(current_wall, 3)),
+                          ('batched_seconds', round(batched_wall, 3)),
+                          ('speedup', round(legacy_wall / current_wall, 2) if current_wall > 0 else None),
+                          ('batched_loads', loads[0]),
+                          ('per_event_loads', len(events)),
+                          ('equal', legacy == current == batched),
+                          ('strings', n_strings),
+                          ('max_strings', args.max_strings),
+                          ('strings_peak', peak),
+                          ('strings_bounded', peak <= args.max_strings < n_strings),
+                          ('capped_equal', capped == current)])
+    for key, value in result.iteritems():
+        print " ", key, "=", value
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(args.output, "w") as f:
+        f.write(json.dumps(result, indent=2))
+    print "result", args.output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark event entity aggregation against the legacy path")
+    parser.add_argument("-e", "--events", default=2000, type=int, help="Events. default=2000")
+    parser.add_argument("-m", "--members", default=20, type=int, help="Average news per event. default=20")
+    parser.add_argument("-t", "--topics", default=50, type=int, help="Synthetic topics. default=50")
+    parser.add_argument("-bs", "--batch_size", default=2000, type=int, help="News per batched load. default=2000")
+    parser.add_argument("-ms", "--max_strings", default=200, type=int,
+                        help="Intern table limit for the bounded check, should be below the distinct strings. default=200")
+    parser.add_argument("-sd", "--seed", default=0, type=int, help="Random seed. default=0")
+    parser.add_argument("-o", "--output", default=os.path.join("log", "benchmark_entities.json"),
+                        help="Result JSON. default=log/benchmark_entities.json")
+    main(parser.parse_args())
@@ -0,0 +1,180 @@
+# -*- coding:utf-8 -*-
+import math
+import random
+import datetime
+
+from utils.header import get_news_json, get_event_json
+
+
+class SyntheticCorpus():
+    """
+    合成新聞語料, 用於benchmark
+    每個topic有自己的詞集合 (來自 utils/2200.txt 的詞表) 以及實體池, topic熱度服從Zipf分布
+    新聞欄位與 utils/header.py 的 __news__ 相同, stemmedTitle / stemmedContent 由topic詞與雜訊詞組成
+    """
+    def __init__(self, vocab_file, n_topics=50, topic_words=60, noise=0.2, title_len=8, content_len=150, seed=0):
+        """
+        :param vocab_file: 詞表 (utils/2200.txt), 每行 "word class"
+        :param n_topics: topic數
+        :param topic_words: 每個topic的詞數
+        :param noise: 從整個詞表抽詞的比例
+        :param title_len: stemmedTitle的詞數
+        :param content_len: stemmedContent的詞數
+        :param seed: random seed
+        """
+        self.rng = random.Random(seed)
+        with open(vocab_file, "r") as f:
+            self.vocab = [line.split()[0] for line in f if line.strip() and not line.startswith("<")]
+        self.n_topics = n_topics
+        self.noise = noise
+        self.title_len = title_len
+        self.content_len = content_len
+        self.topics = []
+        for t in range(n_topics):
+            words = self.rng.sample(self.vocab, topic_words)
+            self.topics.append({'words': words,
+                                # 詞頻服從Zipf分布, 前面的詞較常出現
+                                'cum_weights': self.__cumulative([1.0 / (i + 1) for i in range(topic_words)]),
+                                'persons': ["person_%d_%d" % (t, i) for i in range(8)],
+                                'locations': ["location_%d_%d" % (t, i) for i in range(6)],
+                                'organizations': ["organization_%d_%d" % (t, i) for i in range(6)],
+                                'publishers': ["publisher_%d" % (i % 12) for i in range(t, t + 4)]})
+        self.topic_cum_weights = self.__cumulative([1.0 / (t + 1) for t in range(n_topics)])
+
+    def __cumulative(self, weights):
+        total = 0.
+        result = []
+        for w in weights:
+            total += w
+            result.append(total)
+        return result
+
+    def __choice(self, items, cum_weights):
+        x = self.rng.random() * cum_weights[-1]
+        lo, hi = 0, len(cum_weights) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cum_weights[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return items[lo]
+
+    def sample_topic(self):
+        return self.__choice(range(self.n_topics), self.topic_cum_weights)
+
+    def __words(self, topic, n):
+        words = []
+        for _ in range(n):
+            if self.rng.random() < self.noise:
+                words.append(self.rng.choice(self.vocab))
+            else:
+                words.append(self.__choice(topic['words'], topic['cum_weights']))
+        return words
+
+    def __scored(self, words, k):
+        return [{'word': word, 'score': round(self.rng.uniform(0.2, 1.0), 6)} for word in self.rng.sample(words, k)]
+
+    def __mentions(self, mentions, k):
+        return [{'mention': mention, 'count': self.rng.randint(1, 50), 'linkedURL': "http://xxx.xx.com"}
+                for mention in self.rng.sample(mentions, k)]
+
+    def news(self, news_id, topic_id, crawl_time):
+        """
+        :param news_id: str
+        :param topic_id: int
+        :param crawl_time: datetime
+        :return: news dict, 格式同 utils/header.py
+        """
+        topic = self.topics[topic_id]
+        title = self.__words(topic, self.title_len)
+        content = self.__words(topic, self.content_len)
+        news = get_news_json()
+        news['_id'] = news_id
+        news['newsID'] = news_id
+        news['url'] = "http://example.com/%s.html" % news_id
+        news['title'] = " ".join(title)
+        news['content'] = ". ".join(" ".join(content[i:i + 15]) for i in range(0, len(content), 15)) + "."
+        news['publishTime'] = crawl_time.strftime("%Y-%m-%d %H:%M:%S")
+        # mongoDB中的crawlTime為 %Y%m%d%H%M%S, 見 NewsReader.query_many_by_time
+        news['crawlTime'] = crawl_time.strftime("%Y%m%d%H%M%S")
+        news['publisher'] = self.rng.choice(topic['publishers'])
+        news['category'] = "topic_%d" % topic_id
+        news['seggedTitle'] = ""
+        news['seggedContent'] = []
+        news['stemmedTitle'] = " ".join(title)
+        news['stemmedContent'] = " ".join(content)
+        news['keywords'] = self.__scored(topic['words'][:20], 5)
+        news['when'] = [{'word': news['publishTime'], 'score': 1}]
+        news['where'] = self.__scored(topic['locations'], 2)
+        news['who'] = self.__scored(topic['persons'], 3)
+        news['persons'] = self.__mentions(topic['persons'], 3)
+        news['locations'] = self.__mentions(topic['locations'], 3)
+        news['organizations'] = self.__mentions(topic['organizations'], 2)
+        news['replica'] = []
+        return news
+
+    def window(self, n_news, start_time, end_time, prefix="n"):
+        """
+        產生時間段內均勻分布的新聞
+        :param n_news: 新聞數
+        :param start_time: datetime
+        :param end_time: datetime
+        :return: generator of news dict
+        """
+        step = (end_time - start_time).total_seconds() / (n_news + 1)
+        for i in range(n_news):
+            crawl_time = start_time + datetime.timedelta(seconds=step * (i + 1))
+            yield self.news("%s%08d" % (prefix, i), self.sample_topic(), crawl_time)
+
+    def idf(self, n_sample=2000):
+        """
+        以抽樣的新聞計算idf, 格式同 utils/idf.json
+        :param n_sample: 抽樣新聞數
+        :return: dict { word: idf }
+        """
+        df = {}
+        for _ in range(n_sample):
+            topic = self.topics[self.sample_topic()]
+            for word in set(self.__words(topic, self.title_len + self.content_len)):
+                df[word] = df.get(word, 0) + 1
+        return dict((word, math.log(float(n_sample) / (1 + df.get(word, 0)))) for word in self.vocab)
+
+    def events(self, n_events, start_time, day_window, vectorize, codec, members=3):
+        """
+        產生尚未關閉的event以及其成員新聞, updated時間均勻分布在 start_time 之前的 day_window 天內
+        :param n_events: event數
+        :param start_time: datetime, 聚類時間段的開始時間
+        :param day_window: event_day_window
+        :param vectorize: function(news_str) -> vector
+        :param codec: VectorCodec
+        :param members: 每個event的新聞數
+        :return: generator of (event dict, [news dict])
+        """
+        span = datetime.timedelta(days=day_window).total_seconds()
+        for i in range(n_events):
+            updated = start_time - datetime.timedelta(seconds=span * (i + 1) / (n_events + 2))
+            topic_id = i % self.n_topics
+            news_list = [self.news("h%08d_%d" % (i, j), topic_id, updated) for j in range(members)]
+            vecs = [vectorize(news['stemmedTitle'] + ' ' + news['stemmedContent']) for news in news_list]
+            centroid = sum(vecs) / len(vecs)
+            updated_t = updated.strftime("%Y-%m-%d %H:%M:%S")
+            event = get_event_json()
+            event['_id'] = "E%08d" % i
+            event['id'] = event['_id']
+            event['created'] = updated_t
+            event['updated'] = updated_t
+            event['modified'] = updated_t
+            event['closed'] = False
+            event['father'] = -1
+            event['childrens'] = []
+            event['relatedEvents'] = []
+            event['articles'] = [{'id': news['_id'], 'title': news['title'], 'category': news['category'],
+                                  'publisher': news['publisher'], 'url': news['url'], 'image': "",
+                                  'publishTime': news['publishTime'], 'score': 1.0,
+                                  'newsVector': codec.encode(vec, kind='sparse')}
+                                 for news, vec in zip(news_list, vecs)]
+            event['count'] = members
+            event['keynews'] = dict(event['articles'][0])
+            event['eventVector'] = codec.encode(centroid, kind='dense32')
+            yield event, news_list
@@ -0,0 +1,132 @@
+# -*- coding:utf-8 -*-
+"""
+離線重現一個capture的時間段 (python main.py capture), 輸出各階段時間與聚類結果, 並與baseline比較
+
+    python -m benchmark.replay log/capture/20180301000000.jsonl.gz -o log/replay_new.json -b log/replay_old.json
+"""
+import os
+import json
+import time
+import shutil
+import datetime
+import argparse
+from collections import OrderedDict
+
+from model import Model
+from utils.capture import CaptureBundle
+from backend import MemoryCursor, MemoryNewsReader, MemoryEventReader
+from run import prepare_workdir, build_config, peak_rss_mb
+
+
+def summarize(event_reader):
+    """
+    聚類結果的摘要, event id為隨機產生, 因此以成員新聞辨識event
+    :return: list of dict, 依成員排序
+    """
+    result = []
+    for event in event_reader.events.itervalues():
+        result.append(OrderedDict([('members', sorted(article['id'] for article in event['articles'])),
+                                   ('label', event.get('label', "")),
+                                   ('closed', event['closed'] is not False),
+                                   ('has_father', event.get('father', -1) != -1),
+                                   ('n_childrens', len(event.get('childrens') or []))]))
+    return sorted(result, key=lambda e: e['members'])
+
+
+def diff(baseline, current):
+    """
+    :param baseline: summarize的結果
+    :param current: summarize的結果
+    :return: dict, 只在一邊出現的event, 以及成員相同但label或狀態不同的event
+    """
+    base = dict((tuple(e['members']), e) for e in baseline)
+    cur = dict((tuple(e['members']), e) for e in current)
+    changed = [OrderedDict([('members', list(key)), ('baseline', base[key]), ('current', cur[key])])
+               for key in sorted(set(base) & set(cur)) if base[key] != cur[key]]
+    return OrderedDict([('equal', not changed and set(base) == set(cur)),
+                        ('only_baseline', [base[key] for key in sorted(set(base) - set(cur))]),
+                        ('only_current', [cur[key] for key in sorted(set(cur) - set(base))]),
+                        ('changed', changed)])
+
+
+def replay(args):
+    manifest, docs = CaptureBundle().load(args.bundle)
+    print "bundle", args.bundle, "news =", len(docs['news']), "events =", len(docs['event']), "members =", len(docs['member'])
+    # 沒有指定時使用capture時的參數
+    args.dimension = args.dimension or manifest['dim']
+    args.sim = args.sim or manifest['sim_thres']
+    args.merge_sim = args.merge_sim or manifest['merge_sim_thres']
+    args.sub_sim = args.sub_sim or manifest['subevent_sim_thres']
+
+    workdir = prepare_workdir()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start_time = datetime.datetime.strptime(manifest['start'], "%Y-%m-%d %H:%M:%S")
+        end_time = datetime.datetime.strptime(manifest['end'], "%Y-%m-%d %H:%M:%S")
+        config = build_config(args, start_time, end_time)
+        config.event_day_window = manifest['event_day_window']
+        news_reader = MemoryNewsReader()
+        event_reader = MemoryEventReader(window=config.event_day_window)
+        for news in docs['member'] + docs['news']:
+            news_reader.insert_item(news)
+        for event in docs['event']:
+            event_reader.insert_item(event)
+        model = Model(config=config, news_reader=news_reader, event_reader=event_reader)
+
+        t = time.time()
+        model.run(news_list=MemoryCursor(dict(news) for news in docs['news']), time_info=config.time_info)
+        wall = time.time() - t
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    report = model.metrics.report()
+    result = OrderedDict([('bundle', args.bundle),
+                          ('start', manifest['start']),
+                          ('end', manifest['end']),
+                          ('params', OrderedDict([('dim', args.dimension), ('sim', args.sim),
+                                                  ('merge_sim', args.merge_sim), ('sub_sim', args.sub_sim)])),
+                          ('wall_seconds', round(wall, 3)),
+                          ('docs_per_sec', round(len(docs['news']) / wall, 1) if wall > 0 else None),
+                          ('peak_rss_mb', round(peak_rss_mb(), 1)),
+                          ('stages', report['stages']),
+                          ('counters', report['counters']),
+                          ('events', summarize(event_reader))])
+    for name, stage in report['stages'].iteritems():
+        print "  %-12s wall = %.3f cpu = %.3f items = %d" % (name, stage['wall'], stage['cpu'], stage['items'])
+    print "  wall =", result['wall_seconds'], "docs/sec =", result['docs_per_sec'], "events =", len(result['events'])
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.loads(f.read(), object_pairs_hook=OrderedDict)
+        result['diff'] = diff(baseline['events'], result['events'])
+        result['baseline_wall_seconds'] = baseline['wall_seconds']
+        print "  baseline wall =", baseline['wall_seconds'], "equal =", result['diff']['equal'], \
+            "only_baseline =", len(result['diff']['only_baseline']), \
+            "only_current =", len(result['diff']['only_current']), "changed =", len(result['diff']['changed'])
+
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(args.output, "w") as f:
+        f.write(json.dumps(result, indent=2))
+    print "result", args.output
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a captured window offline")
+    parser.add_argument("bundle", help="Capture bundle written by `python main.py capture`")
+    parser.add_argument("-o", "--output", default=os.path.join("log", "replay.json"),
+                        help="Result JSON. default=log/replay.json")
+    parser.add_argument("-b", "--baseline", help="Previous replay result to diff the clustering output against")
+    parser.add_argument("-dim", "--dimension", type=int, help="Vector dimension. default=captured value")
+    parser.add_argument("-s", '--sim', type=float, help="Similarity threshold. default=captured value")
+    parser.add_argument("-ms", '--merge_sim', type=float, help="Merge similarity threshold. default=captured value")
+    parser.add_argument("-ss", '--sub_sim', type=float, help="Subevent similarity threshold. default=captured value")
+    parser.add_argument("-k", "--keep", action='store_true', help="Keep the temporary work directory. default=False")
+    parser.add_argument("-dd", "--dedup", action='store_true',
+                        help="Collapse near-duplicate news before clustering. default=False")
+    replay(parser.parse_args())
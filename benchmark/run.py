@@ -0,0 +1,209 @@
+# -*- coding:utf-8 -*-
+"""
+聚類pipeline的benchmark: 以合成語料與記憶體backend量測 vectorize, cluster, merge, reevaluate, write_event
+
+    python -m benchmark.run -a 1000,10000,100000 -e 100,1000 -o log/benchmark.json
+
+每個 (新聞數, event數) 在獨立的process中執行, 因此peak RSS互不影響
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import datetime
+import subprocess
+from collections import OrderedDict
+
+from utils.config import Config
+from model import Model
+from main import add_model_arguments
+from generator import SyntheticCorpus
+from backend import MemoryNewsReader, MemoryEventReader
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_TIME = datetime.datetime(2018, 3, 1)
+
+
+def peak_rss_mb():
+    # linux的ru_maxrss單位為KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def prepare_workdir(idf=None):
+    """
+    建立暫存的工作目錄: utils/ 放詞表, stopwords, idf.json; log/ 放Model的輸出
+    :param idf: dict, 合成語料的idf, None時使用 utils/idf.json
+    :return: 工作目錄
+    """
+    workdir = tempfile.mkdtemp(prefix="newsminer_bench_")
+    os.mkdir(os.path.join(workdir, "utils"))
+    names = ["2200.txt", "stopwords_en.txt"]
+    if idf is None:
+        names.append("idf.json")
+    else:
+        with open(os.path.join(workdir, "utils", "idf.json"), "w") as f:
+            f.write(json.dumps(idf))
+    for name in names:
+        os.symlink(os.path.join(REPO, "utils", name), os.path.join(workdir, "utils", name))
+    return workdir
+
+
+def build_config(args, start_time, end_time):
+    parser = argparse.ArgumentParser()
+    add_model_arguments(parser, args.dimension)
+    argv = ["-f", os.path.join(REPO, "utils", str(args.dimension) + ".txt"),
+            "-s", str(args.sim), "-ms", str(args.merge_sim), "-ss", str(args.sub_sim),
+            "-st", start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "-et", end_time.strftime("%Y-%m-%d %H:%M:%S")]
+    if args.dedup:
+        argv.append("-dd")
+    return Config(parser.parse_args(argv))
+
+
+def run_point(args, n_news, n_events):
+    """
+    執行一次benchmark
+    :param n_news: 時間段內的新聞數
+    :param n_events: 時間段開始時尚未關閉的event數
+    :return: dict
+    """
+    corpus = SyntheticCorpus(vocab_file=os.path.join(REPO, "utils", str(args.dimension) + ".txt"),
+                             n_topics=args.topics, seed=args.seed)
+    workdir = prepare_workdir(corpus.idf())
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        end_time = START_TIME + datetime.timedelta(days=1)
+        config = build_config(args, START_TIME, end_time)
+        news_reader = MemoryNewsReader()
+        event_reader = MemoryEventReader(window=config.event_day_window)
+        model = Model(config=config, news_reader=news_reader, event_reader=event_reader)
+
+        t = time.time()
+        for news in corpus.window(n_news, START_TIME, end_time):
+            news_reader.insert_item(news)
+        vectorize = lambda news_str: model._func.vectorize_single_news(dim=config.dim, news_str=news_str)
+        for event, news_list in corpus.events(n_events, START_TIME, config.event_day_window,
+                                              vectorize=vectorize, codec=event_reader.codec):
+            for news in news_list:
+                news_reader.insert_item(news)
+            event_reader.insert_item(event)
+        setup = time.time() - t
+        setup_rss = peak_rss_mb()
+
+        t = time.time()
+        model.run(news_list=news_reader.query_many_by_time(*config.time_info), time_info=config.time_info)
+        wall = time.time() - t
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    report = model.metrics.report()
+    for stage in report['stages'].itervalues():
+        stage['items_per_sec'] = round(stage['items'] / stage['wall'], 1) if stage['wall'] > 0 else None
+    return OrderedDict([('articles', n_news),
+                        ('events', n_events),
+                        ('setup_seconds', round(setup, 3)),
+                        ('wall_seconds', round(wall, 3)),
+                        ('docs_per_sec', round(n_news / wall, 1) if wall > 0 else None),
+                        ('setup_rss_mb', round(setup_rss, 1)),
+                        ('peak_rss_mb', round(peak_rss_mb(), 1)),
+                        ('events_out', len(event_reader.events)),
+                        ('stages', report['stages']),
+                        ('counters', report['counters'])])
+
+
+def scaling(points, key, other):
+    """
+    固定other時, wall time對key的log-log斜率 (1.0為線性, 2.0為平方)
+    :return: list of dict
+    """
+    curves = []
+    for value in sorted(set(p[other] for p in points)):
+        curve = sorted((p for p in points if p[other] == value), key=lambda p: p[key])
+        for a, b in zip(curve, curve[1:]):
+            if a[key] > 0 and a['wall_seconds'] > 0 and b['wall_seconds'] > 0 and b[key] > a[key]:
+                curves.append(OrderedDict([(other, value),
+                                           (key, [a[key], b[key]]),
+                                           ('exponent', round(math.log(b['wall_seconds'] / a['wall_seconds']) /
+                                                              math.log(float(b[key]) / a[key]), 3))]))
+    return curves
+
+
+def main(args):
+    points = []
+    for n_news in args.articles:
+        for n_events in args.events:
+            print "benchmark articles =", n_news, "events =", n_events
+            fd, point_file = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            argv = [sys.executable, "-m", "benchmark.run", "--point", str(n_news), str(n_events), point_file,
+                    "-t", str(args.topics), "-sd", str(args.seed), "-dim", str(args.dimension),
+                    "-s", str(args.sim), "-ms", str(args.merge_sim), "-ss", str(args.sub_sim)]
+            if args.keep:
+                argv.append("-k")
+            if args.dedup:
+                argv.append("-dd")
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call(argv, cwd=REPO, stdout=None if args.verbose else devnull)
+            with open(point_file, "r") as f:
+                point = json.loads(f.read(), object_pairs_hook=OrderedDict)
+            os.remove(point_file)
+            print "  wall =", point['wall_seconds'], "docs/sec =", point['docs_per_sec'], "peak rss =", point['peak_rss_mb']
+            points.append(point)
+
+    result = OrderedDict([('created', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+                          ('params', OrderedDict([('topics', args.topics), ('seed', args.seed), ('dim', args.dimension),
+                                                  ('sim', args.sim), ('merge_sim', args.merge_sim), ('sub_sim', args.sub_sim)])),
+                          ('points', points),
+                          ('scaling', OrderedDict([('articles', scaling(points, 'articles', 'events')),
+                                                   ('events', scaling(points, 'events', 'articles'))]))])
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(args.output, "w") as f:
+        f.write(json.dumps(result, indent=2))
+    print "result", args.output
+
+
+def point(args):
+    n_news, n_events, point_file = args.point
+    result = run_point(args, int(n_news), int(n_events))
+    with open(point_file, "w") as f:
+        f.write(json.dumps(result))
+
+
+def int_list(s):
+    return [int(i) for i in s.split(",") if i]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the clustering pipeline on a synthetic corpus")
+    parser.add_argument("-a", "--articles", default=[1000, 10000], type=int_list,
+                        help="Articles per window, comma separated. default=1000,10000")
+    parser.add_argument("-e", "--events", default=[100, 1000], type=int_list,
+                        help="Open events before the window, comma separated. default=100,1000")
+    parser.add_argument("-t", "--topics", default=50, type=int, help="Synthetic topics. default=50")
+    parser.add_argument("-sd", "--seed", default=0, type=int, help="Random seed. default=0")
+    parser.add_argument("-dim", "--dimension", default=2200, type=int, help="Vector dimension. default=2200")
+    parser.add_argument("-s", '--sim', default=0.7, type=float, help="Similarity threshold. default=0.7")
+    parser.add_argument("-ms", '--merge_sim', default=0.75, type=float, help="Merge similarity threshold. default=0.75")
+    parser.add_argument("-ss", '--sub_sim', default=0.75, type=float, help="Subevent similarity threshold. default=0.75")
+    parser.add_argument("-o", "--output", default=os.path.join("log", "benchmark.json"),
+                        help="Result JSON. default=log/benchmark.json")
+    parser.add_argument("-k", "--keep", action='store_true', help="Keep the temporary work directories. default=False")
+    parser.add_argument("-dd", "--dedup", action='store_true',
+                        help="Collapse near-duplicate news before clustering. default=False")
+    parser.add_argument("-v", "--verbose", action='store_true', help="Show model output. default=False")
+    parser.add_argument("--point", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.point:
+        point(args)
+    else:
+        main(args)
@@ -1,11 +1,17 @@
+# -*- coding:utf-8 -*-
 import os
 import sys
 reload(sys)
 sys.setdefaultencoding('utf8')
 import json
-from utils.reader import NewsReader, EventReader
+from utils.reader import NewsReader, EventReader, BufferedEventReader
 from utils.function import Function
 from utils.config import Config
+from utils.tailer import NewsTailer
+from utils.capture import CaptureBundle
+from utils.shard import ProcessTransport, time_slices, hash_shards
+from utils.scheduler import WindowScheduler
+from utils.admission import AdmissionController, AdaptiveWindowPolicy, recorded_windows
 from model import Model
 from datetime import *
 import time
@@ -54,6 +60,31 @@ def debug(args):
         print "---------------"
 
 
+def admission_controller(args, news_reader):
+    """
+    :return: AdmissionController, 沒有設定 --max_articles 時為 None
+    """
+    if not args.max_articles:
+        return None
+    news_reader.create_tail_index()
+    return AdmissionController(news_reader=news_reader,
+                               max_articles=args.max_articles,
+                               priority=args.priority,
+                               publishers=[p for p in args.publishers.split(",") if p],
+                               min_span=args.min_span)
+
+
+def run_admitted(model, admission, start_time_t, end_time_t, include_start=False):
+    """
+    將時間段切成不超過max_articles的子時間段, 以同一個常駐model依序聚類
+    """
+    for window, news_list, gauges in admission.windows(start_time_t, end_time_t, include_start):
+        print "sub-window", window['start'], window['end'], "news =", window['count'], \
+            "shed =", gauges['admission_shed'], "queue =", gauges['admission_queue_depth']
+        model.gauges = gauges
+        model.run(news_list=news_list, time_info=(window['start'], window['end']))
+
+
 def main(args):
     config = Config(args)
 
@@ -62,6 +93,16 @@ def main(args):
     event_reader = EventReader(uri=config.ip_port, window=config.event_day_window)
     start_time_t, end_time_t = config.time_info
     print start_time_t, end_time_t
+    admission = admission_controller(args, news_reader)
+    if admission:
+        print "start clustering"
+        clustering = Model(config=config,
+                           news_reader=news_reader,
+                           event_reader=event_reader,
+                           resident=True)
+        run_admitted(clustering, admission, start_time_t, end_time_t)
+        print "---------------"
+        return
     news_list = news_reader.query_many_by_time(start_time=start_time_t, end_time=end_time_t)
     print "---------------"
 
@@ -73,12 +114,222 @@ def main(args):
     print "---------------"
 
 
-if __name__ == "__main__":
-    dim = 2200
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers()
+def tail(args):
+    config = Config(args)
 
-    cmd_parser = subparsers.add_parser('debug', help='debug: running test()')
+    news_reader = NewsReader(uri=config.ip_port)
+    event_reader = EventReader(uri=config.ip_port, window=config.event_day_window)
+    news_reader.create_tail_index()
+
+    func = Function()
+    tailer = NewsTailer(news_reader=news_reader,
+                        token_file=os.path.join('log', 'tail.json'),
+                        batch_size=args.batch_size,
+                        max_latency=args.max_latency,
+                        poll_interval=args.poll_interval)
+    start_time_t, _ = config.time_info
+    token = tailer.load_token(crawl_time=event_reader.create_event_id(t=start_time_t))
+    print "tail from", token['crawlTime'], token['_id']
+
+    # 常駐的model, 聚類狀態在batch之間保留
+    clustering = Model(config=config,
+                       news_reader=news_reader,
+                       event_reader=event_reader,
+                       resident=True)
+    batch_start_t = start_time_t
+    for news_list in tailer.batches():
+        batch_end_t = func.time2time_string(datetime.now())
+        print "batch", len(news_list), batch_start_t, batch_end_t
+        clustering.run(news_list=news_list, time_info=(batch_start_t, batch_end_t))
+        tailer.commit(news_list)
+        batch_start_t = batch_end_t
+        print "---------------"
+
+
+def replay(args):
+    config = Config(args)
+
+    news_reader = NewsReader(uri=config.ip_port, news_name=args.news_name)
+    event_reader = EventReader(uri=config.ip_port, event_name=args.event_name, window=config.event_day_window)
+    if args.clean:
+        event_reader.remove_collection()
+    # event只寫入緩衝區, 在checkpoint時才寫回mongoDB
+    buffered_reader = BufferedEventReader(event_reader)
+
+    start_time_t, end_time_t = config.time_info
+    print start_time_t, end_time_t
+    day_window = args.day_window
+
+    func = Function()
+
+    def fixed_windows():
+        start_time = func.time_string2time(start_time_t)
+        end_time = func.time_string2time(end_time_t)
+        cur_start_time = start_time
+        cur_end_time = min(start_time + timedelta(days=day_window), end_time)
+        while cur_start_time < end_time:
+            yield {'start': func.time2time_string(cur_start_time),
+                   'end': func.time2time_string(cur_end_time),
+                   'include_start': False}
+            cur_start_time = cur_end_time
+            cur_end_time = min(cur_end_time + timedelta(days=day_window), end_time)
+
+    # 時間段: 之前記錄的時間段 (--windows), 依新聞量調整 (--target_articles / --latency_budget), 或固定的day_window
+    policy = None
+    if args.windows:
+        windows = recorded_windows(args.windows, start_time_t, end_time_t, run=args.window_run)
+    elif args.target_articles or args.latency_budget:
+        news_reader.create_tail_index()
+        policy = AdaptiveWindowPolicy(news_reader=news_reader,
+                                      target_articles=args.target_articles,
+                                      latency_budget=args.latency_budget,
+                                      min_span=args.min_window,
+                                      max_span=day_window * 86400,
+                                      record_file=os.path.join('log', 'windows.jsonl'))
+        windows = policy.windows(start_time_t, end_time_t)
+    else:
+        windows = fixed_windows()
+
+    # 同一個model跨所有時間段, 詞模型只讀取一次, 聚類狀態保留在記憶體
+    model = Model(config=config,
+                  news_reader=news_reader,
+                  event_reader=buffered_reader,
+                  resident=True)
+    n_window = 0
+    for window in windows:
+        print "start", window['start'], "end", window['end'], "target", window.get('target', "-")
+        news_list = news_reader.query_many_by_time(start_time=window['start'], end_time=window['end'],
+                                                   include_start=window['include_start'])
+        if 'target' in window:
+            model.gauges = {'window_target_articles': window['target'], 'window_articles': window['count']}
+        t = time.time()
+        model.run(news_list=news_list, time_info=(window['start'], window['end']))
+        if policy:
+            policy.observe(model.metrics.report()['counters'].get('news_in', 0), time.time() - t)
+        n_window += 1
+        if args.checkpoint and n_window % args.checkpoint == 0:
+            print "checkpoint, flush events =", buffered_reader.flush()
+        print "---------------"
+    print "flush events =", buffered_reader.flush()
+
+
+def shard(args):
+    config = Config(args)
+
+    news_reader = NewsReader(uri=config.ip_port)
+    event_reader = EventReader(uri=config.ip_port, window=config.event_day_window)
+    start_time_t, end_time_t = config.time_info
+    print start_time_t, end_time_t
+    if args.shard_by == 'hash':
+        tasks = hash_shards(start_time_t, end_time_t, args.shards)
+    else:
+        tasks = time_slices(start_time_t, end_time_t, args.shards)
+
+    # worker在各自的process中讀取新聞與聚類, coordinator只合併聚類摘要並寫入event
+    transport = ProcessTransport(config, processes=args.workers)
+    try:
+        clustering = Model(config=config,
+                           news_reader=news_reader,
+                           event_reader=event_reader)
+        clustering.run_sharded(transport=transport, tasks=tasks, time_info=config.time_info)
+    finally:
+        transport.close()
+
+
+def capture(args):
+    config = Config(args)
+
+    news_reader = NewsReader(uri=config.ip_port)
+    event_reader = EventReader(uri=config.ip_port, window=config.event_day_window)
+    start_time_t, end_time_t = config.time_info
+    print start_time_t, end_time_t
+
+    # 與Model.run讀取相同的輸入, 但不修改mongoDB (不關閉過期的event)
+    news_list = news_reader.query_many_by_time(start_time=start_time_t, end_time=end_time_t)
+    events = list(event_reader.query_open_events(t=start_time_t))
+    if config.event_article_layout == 'collection':
+        event_reader.load_articles(events)
+    member_ids = [news_in_event['id'] for event in events for news_in_event in event['articles']]
+
+    def members():
+        for i in range(0, len(member_ids), config.fetch_batch):
+            for news in news_reader.query_many_by_item({'_id': {'$in': member_ids[i:i + config.fetch_batch]}}):
+                yield news
+
+    path = args.output or os.path.join('log', 'capture', event_reader.create_event_id(t=start_time_t) + '.jsonl.gz')
+    manifest = {'start': start_time_t,
+                'end': end_time_t,
+                'dim': config.dim,
+                'sim_thres': config.sim_thres,
+                'merge_sim_thres': config.merge_sim_thres,
+                'subevent_sim_thres': config.subevent_sim_thres,
+                'event_day_window': config.event_day_window,
+                'captured_at': Function().time2time_string(datetime.now())}
+    manifest = CaptureBundle().save(path, manifest, news_list, events, members())
+    print "capture", path, "news =", manifest['n_news'], "events =", manifest['n_event'], "members =", manifest['n_member']
+
+
+def schedule(args):
+    func = Function()
+    log_file = os.path.join('log', 'log.json')
+    # 水位線: log/schedule.json, 沒有時依序使用 -st, 上次log的結束時間, 現在往前day_window天
+    if args.start_time_t:
+        default_start = func.time_string2time(args.start_time_t)
+    elif os.path.exists(log_file):
+        with open(log_file, "r") as f:
+            default_start = func.time_string2time(json.loads(f.read())['end'])
+    else:
+        default_start = datetime.now() - timedelta(days=args.day_window)
+
+    # 開始時間是前一次的結束時間 (水位線或上次log) 時, 包含crawlTime等於開始時間的新聞; 之後的時間段都包含
+    state = {'model': None,
+             'include_start': os.path.exists(os.path.join('log', 'schedule.json'))
+                              or (not args.start_time_t and os.path.exists(log_file))}
+
+    def run_window(start_time_t, end_time_t):
+        # 失敗後重建model與mongoDB連線, 不沿用可能不一致的記憶體狀態
+        if state['model'] is None:
+            args.start_time_t, args.end_time_t = start_time_t, end_time_t
+            config = Config(args)
+            config.event_day_window = args.event_days
+            news_reader = NewsReader(uri=config.ip_port)
+            event_reader = EventReader(uri=config.ip_port, window=config.event_day_window)
+            state['news_reader'] = news_reader
+            state['admission'] = admission_controller(args, news_reader)
+            state['model'] = Model(config=config,
+                                   news_reader=news_reader,
+                                   event_reader=event_reader,
+                                   resident=True)
+        try:
+            if state['admission']:
+                run_admitted(state['model'], state['admission'], start_time_t, end_time_t, state['include_start'])
+            else:
+                news_list = state['news_reader'].query_many_by_time(start_time=start_time_t, end_time=end_time_t,
+                                                                    include_start=state['include_start'])
+                state['model'].run(news_list=news_list, time_info=(start_time_t, end_time_t))
+        except Exception:
+            # 重試時重新讀取event, 已寫入event的新聞在vectorize時略過, 不會重複加入
+            state['model'] = None
+            raise
+        state['include_start'] = True
+        print "---------------"
+
+    scheduler = WindowScheduler(run_window=run_window,
+                                state_file=os.path.join('log', 'schedule.json'),
+                                lock_file=os.path.join('log', 'schedule.lock'),
+                                cadence=args.cadence,
+                                max_window=args.max_window,
+                                lag=args.lag,
+                                retries=args.retries,
+                                retry_delay=args.retry_delay)
+    print "schedule from", func.time2time_string(scheduler.load_watermark(default=default_start))
+    if args.once:
+        print "windows done =", scheduler.tick()
+    else:
+        scheduler.run_forever()
+
+
+def add_model_arguments(cmd_parser, dim):
     cmd_parser.add_argument("-ip", "--ip_port", default="10.1.1.46:27017", help="IP & port. default=10.1.1.46:27017")
     cmd_parser.add_argument("-dim", "--dimension", default=dim, type=int, help="Vector dimension. default=2200")
     cmd_parser.add_argument("-f", "--class_file", default="utils/" + str(dim) + ".txt",
@@ -93,26 +344,116 @@ if __name__ == "__main__":
                             help="fomat 2018-01-01 17:00:00")
     cmd_parser.add_argument("-et", '--end_time_t', type=str,
                             help="fomat 2018-01-01 17:00:00")
+    cmd_parser.add_argument("-pl", '--pipeline', action='store_true',
+                            help="Overlap mongoDB reads/writes with vectorize and clustering. default=False")
+    cmd_parser.add_argument("-qs", '--queue_size', default=4, type=int,
+                            help="Bounded queue size between pipeline stages. default=4")
+    cmd_parser.add_argument("-fb", '--fetch_batch', default=500, type=int,
+                            help="News per fetch batch in pipeline mode. default=500")
+    cmd_parser.add_argument("-nc", '--news_cache_mb', default=256, type=int,
+                            help="Memory budget (MB) for cached news content and entities. default=256")
+    cmd_parser.add_argument("-sn", '--snapshot', action='store_true',
+                            help="Load/save clustering state snapshots under log/snapshot. default=False")
+    cmd_parser.add_argument("-pg", '--progress', action='store_true',
+                            help="Show progress bars (tqdm) for each stage. default=False")
+    cmd_parser.add_argument("-pf", '--profile', action='store_true',
+                            help="cProfile each model stage, dumped to log/profile/<window start>. default=False")
+    cmd_parser.add_argument("-pm", '--profile_memory', action='store_true',
+                            help="tracemalloc top allocations of each model stage (needs tracemalloc). default=False")
+    cmd_parser.add_argument("-ca", '--cache', default=None,
+                            help="Hot event cache for front-end reads: redis://host:port/db, or memory. default=None")
+    cmd_parser.add_argument("-ex", '--export', action='store_true',
+                            help="Export clusters, centroids and statistics (jsonl + npz) to Output in the background. default=False")
+    cmd_parser.add_argument("-dd", '--dedup', action='store_true',
+                            help="Collapse near-duplicate news (SimHash + LSH) before clustering. default=False")
+
+
+def add_admission_arguments(cmd_parser):
+    cmd_parser.add_argument("-ma", '--max_articles', default=0, type=int,
+                            help="Max news per sub-window, larger windows are split by crawlTime counts, 0 = no limit. default=0")
+    cmd_parser.add_argument("-pr", '--priority', default='time', choices=AdmissionController.PRIORITIES,
+                            help="Which news to keep when a sub-window cannot be split further. default=time")
+    cmd_parser.add_argument("-pp", '--publishers', default="",
+                            help="Comma separated publishers, earlier first, for --priority publisher. default=''")
+    cmd_parser.add_argument("-msp", '--min_span', default=60, type=int,
+                            help="Shortest sub-window in seconds, news beyond --max_articles in it are shed. default=60")
+
+
+if __name__ == "__main__":
+    dim = 2200
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    cmd_parser = subparsers.add_parser('debug', help='debug: running test()')
+    add_model_arguments(cmd_parser, dim)
     cmd_parser.set_defaults(func=debug)
 
     cmd_parser = subparsers.add_parser('main', help='running main()')
     cmd_parser.add_argument("-is_test", default=False, type=bool, help="test")
-    cmd_parser.add_argument("-ip", "--ip_port", default="10.1.1.46:27017", help="IP & port. default=10.1.1.46:27017")
-    cmd_parser.add_argument("-dim", "--dimension", default=dim, type=int, help="Vector dimension. default=2200")
-    cmd_parser.add_argument("-f", "--class_file", default="utils/" + str(dim) + ".txt",
-                            help="Input class file. default=utils/2200.txt")
-    cmd_parser.add_argument("-d", '--day_window', default=1, type=int, help="Day window to clustering news. default=1")
-    cmd_parser.add_argument("-s", '--sim', default=0.7, type=float, help="Similarity threshold. default=0.7")
-    cmd_parser.add_argument("-ss", '--sub_sim', default=0.75, type=float,
-                            help="Subevent similarity threshold. default=0.75")
-    cmd_parser.add_argument("-ms", '--merge_sim', default=0.75, type=float,
-                            help="Merge similarity threshold. default=0.75")
-    cmd_parser.add_argument("-st", '--start_time_t', type=str,
-                            help="fomat 2018-01-01 17:00:00")
-    cmd_parser.add_argument("-et", '--end_time_t', type=str,
-                            help="fomat 2018-01-01 17:00:00")
+    add_model_arguments(cmd_parser, dim)
+    add_admission_arguments(cmd_parser)
     cmd_parser.set_defaults(func=main)
 
+    cmd_parser = subparsers.add_parser('tail', help='running tail(): incremental clustering of newly crawled news')
+    add_model_arguments(cmd_parser, dim)
+    cmd_parser.add_argument("-bs", '--batch_size', default=200, type=int,
+                            help="Max news per micro-batch. default=200")
+    cmd_parser.add_argument("-ml", '--max_latency', default=60, type=int,
+                            help="Max seconds a news waits before its batch is clustered. default=60")
+    cmd_parser.add_argument("-pi", '--poll_interval', default=5, type=int,
+                            help="Seconds between polls when no news arrives. default=5")
+    cmd_parser.set_defaults(func=tail)
+
+    cmd_parser = subparsers.add_parser('replay', help='running replay(): re-cluster a date range with one resident model')
+    add_model_arguments(cmd_parser, dim)
+    cmd_parser.add_argument("-cp", '--checkpoint', default=0, type=int,
+                            help="Flush buffered events to mongoDB every N windows, 0 = only at the end. default=0")
+    cmd_parser.add_argument("-nn", '--news_name', default="en_news", help="News collection. default=en_news")
+    cmd_parser.add_argument("-en", '--event_name', default="en_event", help="Event collection. default=en_event")
+    cmd_parser.add_argument("-c", '--clean', action='store_true', help="Remove the event collection first. default=False")
+    cmd_parser.add_argument("-ta", '--target_articles', default=0, type=int,
+                            help="Size each window to about this many news by crawlTime counts, "
+                                 "--day_window becomes the longest window. default=0 (fixed windows)")
+    cmd_parser.add_argument("-lb", '--latency_budget', default=0, type=float,
+                            help="Size each window to about this many seconds from the measured seconds per news. default=0")
+    cmd_parser.add_argument("-mwn", '--min_window', default=600, type=int,
+                            help="Shortest adaptive window in seconds. default=600")
+    cmd_parser.add_argument("-wf", '--windows', help="Replay the windows recorded in log/windows.jsonl. default=None")
+    cmd_parser.add_argument("-wr", '--window_run', default=None,
+                            help="Run id of the recorded windows to replay. default=the last recorded run")
+    cmd_parser.set_defaults(func=replay)
+
+    cmd_parser = subparsers.add_parser('shard', help='running shard(): map/reduce clustering with worker processes')
+    add_model_arguments(cmd_parser, dim)
+    cmd_parser.add_argument("-w", '--workers', default=2, type=int, help="Worker processes. default=2")
+    cmd_parser.add_argument("-ns", '--shards', default=4, type=int, help="Shards per window. default=4")
+    cmd_parser.add_argument("-sb", '--shard_by', default='time', choices=['time', 'hash'],
+                            help="Split the window into time slices or by news id hash. default=time")
+    cmd_parser.set_defaults(func=shard)
+
+    cmd_parser = subparsers.add_parser('schedule', help='running schedule(): run windows on a cadence, catching up in bounded chunks')
+    add_model_arguments(cmd_parser, dim)
+    cmd_parser.add_argument("-cd", '--cadence', default=60, type=int,
+                            help="Minutes between news windows, also the shortest window. default=60")
+    cmd_parser.add_argument("-mw", '--max_window', default=1440, type=int,
+                            help="Longest window in minutes when catching up a backlog. default=1440")
+    cmd_parser.add_argument("-lg", '--lag', default=0, type=int,
+                            help="Minutes a window end stays behind now, for late crawled news. default=0")
+    cmd_parser.add_argument("-ed", '--event_days', default=Config.event_day_window, type=int,
+                            help="Event window in days, open events older than this are closed. default=14")
+    cmd_parser.add_argument("-rt", '--retries', default=3, type=int, help="Retries of a failed window. default=3")
+    cmd_parser.add_argument("-rd", '--retry_delay', default=30, type=float,
+                            help="Seconds before the first retry, doubled with jitter after. default=30")
+    cmd_parser.add_argument("-1", '--once', action='store_true',
+                            help="Run the pending windows once and exit, for cron. default=False")
+    add_admission_arguments(cmd_parser)
+    cmd_parser.set_defaults(func=schedule)
+
+    cmd_parser = subparsers.add_parser('capture', help='running capture(): dump the inputs of one window for offline replay')
+    add_model_arguments(cmd_parser, dim)
+    cmd_parser.add_argument("-o", '--output', help="Bundle file. default=log/capture/<window start>.jsonl.gz")
+    cmd_parser.set_defaults(func=capture)
+
     ARGS = parser.parse_args()
     if ARGS.func is None:
         parser.print_help()
@@ -3,22 +3,39 @@ import json
 import os
 import time
 import datetime
+import heapq
+import contextlib
 import pymongo
 from bson import ObjectId
 
 import numpy as np
-from tqdm import tqdm
-from sklearn import preprocessing
 
 from utils.function import Function
+from utils.codec import VectorCodec
+from utils.entity import EntityAggregator
+from utils.delta import DeltaWriter
+from utils.cache import EventCache, create_cache
+from utils.export import ResultExporter
+from utils.graph import RelatedEventGraph
+from utils.dedup import SimHashDeduplicator
+from utils.stats import ClusterStats
+from utils.store import NewsStore
+from utils.snapshot import SnapshotManager
+from utils.registry import EventRegistry
+from utils.shard import reduce_summaries
+from utils.pipeline import Pipeline
+from utils.metrics import Metrics, progress
+from utils.profiler import StageProfiler
 from utils.header import get_event_json
 
 
 class Model():
-    def __init__(self, config, news_reader, event_reader):
+    def __init__(self, config, news_reader, event_reader, resident=False):
         self.config = config
         self._func = Function()
         self._func.load_word_model(dim=self.config.dim, class_file=self.config.class_file)
+        self._codec = VectorCodec()
+        self._entities = EntityAggregator(decay=0.99, k_important=20)
         self.__dim = self.config.dim
         self.__sim_thres = self.config.sim_thres
         self.__merge_sim_thres = self.config.merge_sim_thres
@@ -26,7 +43,8 @@ class Model():
         self.__mse_thres = 5e-6
         self.__cos_thres = self.config.cos_thres
         self.__cos_std_thres = self.config.cos_std_thres
-        self.__news = {}
+        # 新聞只保留精簡紀錄, content與實體列表在寫入時批次讀取
+        self.__news = NewsStore(news_reader=news_reader, budget_mb=self.config.news_cache_mb)
         self.__events = {}
         self.__updated_events = {}
         self.__clusters_vec = {}
@@ -34,6 +52,8 @@ class Model():
         self.__centroids = {}
         self.__son2father_event = {} # single id: str
         self.__father2son_event = {} # son set: set of str
+        self.__registry = EventRegistry() # 記憶體中尚未關閉的event, 依updated排序
+        self.__evaluated = set() # 常駐模式下, 上次變動後已經評估過是否分裂的event
         self.mse = []
         self.cos = []
         self.cos_std = []
@@ -44,50 +64,136 @@ class Model():
         self.__single_count = 0
         self.__news_reader = news_reader
         self.__event_reader = event_reader
+        # shard worker沒有event reader
+        if self.config.event_article_layout == 'collection' and event_reader is not None:
+            self.__event_reader.create_article_index()
+        # 給前端讀取的hot event cache (--cache), TTL與event_day_window相同
+        self.__cache = None
+        if self.config.cache:
+            self.__cache = EventCache(create_cache(self.config.cache), ttl=self.config.event_day_window * 86400)
+        # 常駐模式: 跨多次run保留聚類狀態, event只在第一次run時讀取
+        self.__resident = resident
+        self.__events_loaded = False
+        # 重疊I/O與CPU的pipeline, 每次run重建以分開統計
+        self.__pipeline = None
+        self.__event_source = None
+        # 每個時間段的階段計時與計數器, 每次run重建
+        self.metrics = Metrics()
+        # 由呼叫者設定的gauge (例如admission的queue depth與lag), 每次run寫入metrics
+        self.gauges = {}
+        self.__profiler = None
         self.__start = datetime.datetime.now()
         self.__date = ""
         current_base = os.path.abspath('.')
         self.output_path = self.config.output_path
         self.log_path = os.path.join(current_base, "log")
+        self.__snapshot = SnapshotManager(os.path.join(self.log_path, "snapshot")) if self.config.snapshot else None
+        if self.__snapshot and event_reader is not None:
+            self.__event_reader.create_modified_index()
+        self.__exporter = ResultExporter(self.output_path, dim=self.__dim)
+        # --dedup: 近似重複的新聞只以代表聚類
+        self.__dedup = SimHashDeduplicator(max_distance=self.config.dedup_distance) if self.config.dedup else None
+        # 相似事件圖, 常駐模式下跨時間段保留, 只重新計算centroid有移動的event
+        self.__graph = RelatedEventGraph(k=self.config.related_events_k,
+                                         threshold=self.config.related_events_thres,
+                                         tolerance=self.config.related_events_tolerance)
+        # 每個event的充分統計量, 評估分裂時不需要計算全部成員與centroid的距離
+        self.__stats = {}
 
         self.start_time_t = None
         self.end_time_t = None
 
+    def count_news(self, news_list):
+        """
+        計算輸入新聞數, news_list可以是pymongo cursor或list (tail模式的micro-batch)
+        :param news_list: cursor or list
+        :return: count: int
+        """
+        if isinstance(news_list, list):
+            return len(news_list)
+        return news_list.count()
+
     def vectorize_mongolist(self, news_list):
         """
         輸入一段新聞，並利用新聞中的stemContent將文檔向量化
         目前使用方法為每個詞的權重都為1，生成向量將除以所有詞總數
         :param news_list: 一段新聞, list [ dict news_info { news.json }, ... , ]
         :return: vectors: 根據給定的dim維度生成的全部文檔向量, list [ tuple news ( _id, vector ), ... , ]
+                 --dedup時只包含代表, 重複的新聞記錄在 self.__dedup.copies
         """
-        self.__news_count = news_list.count()
+        if self.__dedup:
+            self.__dedup.reset()
+        self.__news_count = self.count_news(news_list)
+        self.metrics.incr('news_in', self.__news_count)
         vectors = list()
-        # 進度條
-        time.sleep(0.3)
-        pbar = tqdm(total=self.__news_count, mininterval=0.5)
-        pb = 0
-        for news_dict in news_list:
-            news_id = news_dict['_id']
-            self.__news[news_id] = news_dict
-            news_stem_content = news_dict['stemmedTitle'] + ' ' + news_dict['stemmedContent']
-            # news_lower_content = news_dict['lowerContent']
-            news_len = len(news_stem_content)
-
-            if news_len > self.__min_news_len:
-                vector = self._func.vectorize_single_news(dim=self.__dim, news_str=news_stem_content)
-                # vector = vectorize_with_dis(dim=self.__dim, news_dict=news_dict)
-                vectors.append((news_id, vector))
-            pb += 1
-            pbar.update(1)
+        pbar = self.progress(total=self.__news_count)
+        # pipeline模式下由背景thread分批讀取cursor
+        if self.__pipeline:
+            news_batches = self.__pipeline.producer('fetch_news', self.__pipeline.batched(news_list, self.config.fetch_batch))
+            news_list = (news_dict for batch in news_batches for news_dict in batch)
+        with self.metrics.stage('vectorize') as stage:
+            for news_dict in news_list:
+                news_id = news_dict['_id']
+                news_stem_content = news_dict['stemmedTitle'] + ' ' + news_dict['stemmedContent']
+                # news_lower_content = news_dict['lowerContent']
+                news_len = len(news_stem_content)
+
+                if news_len > self.__min_news_len:
+                    # 只保存會加入聚類的新聞 (包含近似重複), 太短的新聞不會被drop_event移除
+                    self.__news.add(news_dict)
+                    # 近似重複的新聞不向量化, 聚類時與代表一起加入
+                    if self.__dedup is None or self.__dedup.add(news_id, news_stem_content) is None:
+                        vector = self.vectorize(news_stem_content)
+                        # vector = vectorize_with_dis(dim=self.__dim, news_dict=news_dict)
+                        vectors.append((news_id, vector))
+                else:
+                    self.metrics.incr('news_too_short')
+                stage.add(1)
+                pbar.update(1)
         pbar.close()
-        time.sleep(0.3)
+        self.metrics.incr('news_vectorized', len(vectors))
+        if self.__dedup:
+            report = self.__dedup.report()
+            self.metrics.incr('dedup_representatives', report['dedup_representatives'])
+            self.metrics.incr('dedup_copies', report['dedup_copies'])
+            self.metrics.set('dedup_work_removed', report['dedup_work_removed'])
         return vectors
 
-    def online_clustering(self, vectors, sim_thres, mode="clustering", father_event_id=None):
+    def vectorize(self, news_stem_content):
+        if not self.__pipeline:
+            return self._func.vectorize_single_news(dim=self.__dim, news_str=news_stem_content)
+        with self.__pipeline.measure('vectorize') as timer:
+            timer.items += 1
+            return self._func.vectorize_single_news(dim=self.__dim, news_str=news_stem_content)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        紀錄主thread階段的wall time與CPU time, pipeline模式下同時紀錄於pipeline的stage
+        :param name: stage名稱
+        :return: StageStat, 以 with 使用
+        """
+        with self.metrics.stage(name) as stat:
+            if self.__pipeline:
+                with self.__pipeline.measure(name) as timer:
+                    items = stat.items
+                    yield stat
+                    timer.items += stat.items - items
+            else:
+                yield stat
+
+    def progress(self, total=None):
+        """
+        :return: --progress時為tqdm進度條, 否則不做任何事
+        """
+        return progress(self.config.progress, total=total)
+
+    def online_clustering(self, vectors, sim_thres, mode="clustering", father_event_id=None, copies=None):
         """
         對輸入的vectors做online clustering聚類
         :param vectors: 全部文檔向量, list [ tuple news ( _id, vector ), ... , ]
         :param sim_thres: 相似度閾值
+        :param copies: { 代表的news id: 重複的news id list }, 重複的新聞以代表的向量一起加入同一個聚類 (權重為份數)
         :return: clusters: 向量聚類結果, dict [ array cluster0 [ (vec0), ... , (vecN) ] , ... , ]
         :return: centroids: 向量聚類中心, dict [ cluster0 (vec0), ... , clusterN (vecN) ]
         :return: clusters_id: 聚類新聞id, dict [ list cluster0 [ (_id_0), ... , (_id_N) ], ... , ]
@@ -96,19 +202,17 @@ class Model():
         clusters_id = {}
         centroids = {}
 
-        time.sleep(0.3)
-        # pbar = 0
-
         # 判斷mode, 分為split re-clustering跟clustering
         has_father_event = False
         if mode == "split":
             has_father_event = True
-        elif mode == "clustering":
-            pbar = tqdm(total=len(vectors), mininterval=0.5)
+        pbar = self.progress(total=len(vectors)) if mode == 'clustering' else progress(False)
+        n_similarities = 0
 
         for x in vectors:
             vid = x[0]
             vec = x[1]
+            n_similarities += len(centroids)
 
             try:
                 # 新聞計算最相似的聚類中心，並回傳最大相似值 ( cluster_id, sim )
@@ -118,6 +222,7 @@ class Model():
                 max_similarity = (0, 0)
 
             bestmukey = max_similarity[0]
+            members = [vid] + copies[vid] if copies and copies.get(vid) else [vid]
 
             # 最大相似度小於相似度閾值, 產生新事件
             if max_similarity[1] < sim_thres:
@@ -129,10 +234,11 @@ class Model():
                 else:
                     # key = self.__date + "E" + str(self.__event_count)
                     key = time.strftime("%Y%m%d%H%M%S", time.localtime()) + str(ObjectId())
-                clusters_vec[key] = np.array([vec])
-                clusters_id[key] = [vid]
+                clusters_vec[key] = np.array([vec] * len(members))
+                clusters_id[key] = members
                 centroids[key] = np.array(vec)
                 self.__event_count += 1
+                self.metrics.incr('events_split' if father_event_id else 'events_created')
 
                 if father_event_id:
                     self.__son2father_event[key] = father_event_id
@@ -143,35 +249,72 @@ class Model():
                         self.__father2son_event[father_event_id] = set(key_list)
             # 最大相似度大於相似度閾值
             else:
-                clusters_vec[bestmukey] = np.vstack((clusters_vec[bestmukey], np.array(vec)))
-                clusters_id[bestmukey].append(vid)
+                clusters_vec[bestmukey] = np.vstack((clusters_vec[bestmukey], np.array([vec] * len(members))))
+                clusters_id[bestmukey].extend(members)
                 centroids[bestmukey] = np.mean(clusters_vec[bestmukey], axis=0)
 
-            if mode == 'clustering':
-                pbar.update(1)
+            pbar.update(1)
 
-        if mode == 'clustering':
-            pbar.close()
-            time.sleep(0.3)
+        pbar.close()
+        self.metrics.incr('similarities', n_similarities)
         return clusters_vec, clusters_id, centroids
 
-    def read_events(self, start_time_t):
+    def iter_events(self, start_time_t, result=None):
+        """
+        從mongoDB event collection 讀取上一個階段聚類完成的event, 並以一次$in查詢讀取event中的全部news
+        成員另外存放時 (event_article_layout = 'collection'), 每fetch_batch個event以一次分頁查詢讀取成員
+        :param start_time_t: time string
+        :param result: 要讀取的event, None時讀取start_time_t之前event_day_window內的event
+        :return: generator of (event, news_docs { news_id: news })
+        """
+        if result is None:
+            result = self.__event_reader.query_recent_events_by_time(t=start_time_t)
+        batch = []
+        for event in result:
+            batch.append(event)
+            if len(batch) >= self.config.fetch_batch:
+                for item in self.__read_event_batch(batch):
+                    yield item
+                batch = []
+        for item in self.__read_event_batch(batch):
+            yield item
+
+    def __read_event_batch(self, events):
+        if events and self.config.event_article_layout == 'collection':
+            self.__event_reader.load_articles(events)
+        for event in events:
+            self.__event_reader.decode_vectors(event, dim=self.__dim)
+            news_ids = [news_in_event['id'] for news_in_event in event['articles']]
+            news_docs = {}
+            for news in self.__news_reader.query_many_by_item({'_id': {'$in': news_ids}}, fields=self.__news.fetch_fields()):
+                news_docs[news['_id']] = news
+            yield event, news_docs
+
+    def read_events(self, start_time_t, events=None):
         """
         從mongoDB event collection 讀取上一個階段聚類完成的event, 讀取後將event放入 self.__events 存儲
         在當中也會讀取mongoDB news collection, 並對於讀取的news作文檔向量化
         :param t: time string
+        :param events: iter_events的結果, pipeline模式下在背景預先讀取, None時直接讀取
         :return: event count: int
         """
-        result = self.__event_reader.query_recent_events_by_time(t=start_time_t)
+        if events is None:
+            events = self.iter_events(start_time_t)
 
-        time.sleep(0.3)
-        pbar = tqdm(total=result.count(), mininterval=0.5)
+        pbar = self.progress()
         event_count = 0
         #for event in tqdm(result):
-        for event in result:
+        for event, news_docs in events:
             event_id = event['_id']
             self.__events[event_id] = event
             self.__updated_events[event_id] = False
+            self.__registry.touch(event_id, event['updated'])
+            # 寫入時的eventVector與relatedEvents, centroid沒有移動時不需要重新計算
+            if event.get('eventVector') is not None:
+                self.__graph.index(event_id, event['eventVector'], neighbors=event.get('relatedEvents'))
+            if event.get('clusterStats') and event.get('eventVector') is not None:
+                self.__stats[event_id] = ClusterStats.decode(event['clusterStats'], self._codec, self.__dim,
+                                                             centroid=event['eventVector'])
 
             news_vec_in_event = []
             news_id_in_event = []
@@ -180,16 +323,22 @@ class Model():
             for news_in_event in event['articles']:
                 news_id = news_in_event['id']
                 # 讀取mongoDB news collection, 並作文檔向量化
-                result = self.__news_reader.query_one_by_item({'_id':news_id})
-                if result:
-                    news_stem_content = results['stemmedTitle'] + ' ' + result['stemmedContent']
+                result = news_docs.get(news_id)
+                news_vec = news_in_event.get('newsVector')
+                # 已存儲的向量直接使用, 不需要重新向量化
+                if result and news_vec is not None and news_vec.shape[0] == self.__dim:
+                    news_vec_in_event.append(news_vec)
+                    news_id_in_event.append(news_id)
+                    self.__news.add(result)
+                elif result:
+                    news_stem_content = result['stemmedTitle'] + ' ' + result['stemmedContent']
                     # news_lower_content = result['lowerContent']
                     news_content_len = len(news_stem_content)
                     if news_content_len > self.__min_news_len:
-                        news_vec_in_event.append(self._func.vectorize_single_news(dim=self.__dim, news_str=news_stem_content))
+                        news_vec_in_event.append(self.vectorize(news_stem_content))
                         # news_vec_in_event.append(vectorize_with_dis(dim=self.__dim, news_dict=result))
                         news_id_in_event.append(news_id)
-                        self.__news[news_id] = result
+                        self.__news.add(result)
 
             # 讀取event_jon中的層次關係
             childrens = event['childrens']
@@ -206,9 +355,127 @@ class Model():
             event_count += 1
             pbar.update(1)
         pbar.close()
-        time.sleep(0.3)
+        self.metrics.incr('events_read', event_count)
         return event_count
 
+    def export_news(self, news_ids, release=False):
+        """
+        :param news_ids: list of news id
+        :param release: 是否同時從記憶體中移除
+        :return: 新聞的精簡紀錄, 見NewsStore.export
+        """
+        records = self.__news.export(news_ids)
+        if release:
+            for news_id in news_ids:
+                self.__news.pop(news_id, None)
+        return records
+
+    def drop_event(self, event_id):
+        """
+        將event以及其新聞從記憶體中移除, 常駐模式下用於已關閉的event
+        :param event_id: str
+        :return:
+        """
+        for news_id in self.__clusters_id.pop(event_id, []):
+            self.__news.pop(news_id, None)
+        self.__clusters_vec.pop(event_id, None)
+        self.__centroids.pop(event_id, None)
+        self.__stats.pop(event_id, None)
+        self.__events.pop(event_id, None)
+        self.__updated_events.pop(event_id, None)
+        self.__registry.remove(event_id)
+        self.__evaluated.discard(event_id)
+        self.__father2son_event.pop(event_id, None)
+
+    def expire_events(self, start_time_t):
+        """
+        常駐模式下取代read_events: 將超過event_day_window沒有更新的event關閉, 並從記憶體中移除
+        :param start_time_t: time string
+        :return: expired count: int
+        """
+        last_time = self._func.time_string2time(start_time_t) + datetime.timedelta(days=-self.config.event_day_window)
+        last_time_t = self._func.time2time_string(last_time)
+        # 與read_events的查詢條件一致: updated 等於 last_time_t 的event也不再讀取
+        expired = self.__registry.expire(last_time_t)
+        for event_id, _ in expired:
+            self.drop_event(event_id)
+        # 只關閉記憶體中過期的event, 不需要掃描整個collection
+        # 與close_events一致, 移出記憶體的event (updated <= last_time_t) 同時關閉, 不留下沒有持久化的狀態
+        close_ids = [event_id for event_id, _ in expired]
+        self.__event_reader.close_events_by_ids(close_ids)
+        if self.__cache:
+            self.__cache.invalidate(close_ids)
+            self.__cache.flush()
+            self.report_cache()
+        self.metrics.incr('events_expired', len(expired))
+        return len(expired)
+
+    def report_cache(self):
+        for name, value in self.__cache.report().iteritems():
+            self.metrics.incr(name, value)
+
+    def save_snapshot(self):
+        """
+        將目前的聚類狀態寫入快照, 在event寫入mongoDB之後呼叫
+        :return: 快照目錄
+        """
+        state = {}
+        member_ids = []
+        for event_id, cluster_id in self.__clusters_id.iteritems():
+            state[event_id] = (cluster_id,
+                               self.__clusters_vec[event_id],
+                               self.__centroids[event_id],
+                               self.__son2father_event.get(event_id),
+                               event_id in self.__father2son_event,
+                               self.__registry.get(event_id))
+            member_ids.extend(cluster_id)
+        manifest = {'dim': self.__dim,
+                    'sim_thres': self.__sim_thres,
+                    'merge_sim_thres': self.__merge_sim_thres,
+                    'subevent_sim_thres': self.__subevent_sim_thres,
+                    'start': self.start_time_t,
+                    'end': self.end_time_t,
+                    'saved_at': self._func.time2time_string(datetime.datetime.now())}
+        return self.__snapshot.save(self.__date, manifest, state, self.__news.export(member_ids))
+
+    def load_snapshot(self, start_time_t):
+        """
+        讀取快照取代read_events, 之後只重新讀取快照之後在mongoDB中有修改的event
+        :param start_time_t: time string
+        :return: 是否成功讀取快照
+        """
+        manifest = self.__snapshot.load_manifest()
+        if not manifest or manifest['dim'] != self.__dim \
+                or manifest['sim_thres'] != self.__sim_thres \
+                or manifest['merge_sim_thres'] != self.__merge_sim_thres \
+                or manifest['subevent_sim_thres'] != self.__subevent_sim_thres:
+            return False
+        state, records = self.__snapshot.load(manifest)
+        for record in records:
+            self.__news.add(record)
+        for event_id, (cluster_id, vecs, centroid, father, closed, updated) in state.iteritems():
+            if closed:
+                continue
+            self.__clusters_id[event_id] = cluster_id
+            self.__clusters_vec[event_id] = vecs
+            self.__centroids[event_id] = np.asarray(centroid, dtype=np.float)
+            self.__updated_events[event_id] = False
+            self.__registry.touch(event_id, updated)
+            if father:
+                self.__son2father_event[event_id] = father
+
+        # 快照之後被修改過的event: 已關閉的移除, 其餘重新讀取
+        changed = list(self.__event_reader.query_many_by_item({'modified': {'$gt': manifest['saved_at']}}))
+        reload_events = []
+        for event in changed:
+            self.drop_event(event['_id'])
+            if event['closed'] is False:
+                reload_events.append(event)
+        self.read_events(start_time_t=start_time_t, events=self.iter_events(start_time_t, result=reload_events))
+        expired = self.expire_events(start_time_t=start_time_t)
+        print "snapshot", manifest['name'], "events =", len(state), "changed =", len(changed), "expired =", expired
+        return True
+
     def online_clustering_merge(self, cluster_tuple):
         """
         將完成聚類的新聞合併到原有的事件中
@@ -226,8 +493,7 @@ class Model():
             self.__centroids = centroids
         # 讀取到event
         else:
-            time.sleep(0.3)
-            pbar = tqdm(total=len(centroids), mininterval=0.5)
+            pbar = self.progress(total=len(centroids))
             # 遍歷所有新生成的event, 對讀取的舊event評估進行合併
             #for event_id in tqdm(centroids):
             for event_id in centroids:
@@ -235,6 +501,7 @@ class Model():
                 cluster_id = clusters_id[event_id]
                 centroid = centroids[event_id]
 
+                self.metrics.incr('similarities', len(self.__centroids))
                 max_similarity = max([(eid, self._func.cal_similarity(centroid, self.__centroids[eid])) \
                                           for eid in self.__centroids], key=lambda t: t[1])
 
@@ -252,6 +519,8 @@ class Model():
                     self.__clusters_id[bestmukey].extend(cluster_id)
                     # merge到現有的event中, 並紀錄是否該event有更新的news, 如果有則為true
                     self.__updated_events[bestmukey] = True
+                    self.__evaluated.discard(bestmukey)
+                    self.metrics.incr('events_merged')
 
                     # 之前曾經分裂過的event, 再次合併時必須將層次關係移除
                     if event_id in self.__son2father_event:
@@ -266,7 +535,6 @@ class Model():
 
                 pbar.update(1)
             pbar.close()
-            time.sleep(0.3)
 
     # input = (cluster_id, [vecs]) // cluster info
     def split_cluster(self, cluster, output=False):
@@ -281,7 +549,9 @@ class Model():
         clusters_id = self.__clusters_id[event_id]
 
         vectors = [ (clusters_id[i[0]], i[1]) for i in enumerate(event_vecs) ]
-        n_clusters_vec, n_clusters_id, n_centroids = self.online_clustering(vectors=vectors, sim_thres=self.__subevent_sim_thres, mode='split', father_event_id=event_id)
+        with self.metrics.stage('split') as stage:
+            stage.add(len(vectors))
+            n_clusters_vec, n_clusters_id, n_centroids = self.online_clustering(vectors=vectors, sim_thres=self.__subevent_sim_thres, mode='split', father_event_id=event_id)
 
         # replace the original cluster info with 1st newly generated cluster info
         self.__clusters_vec[event_id] = n_clusters_vec[event_id]
@@ -306,11 +576,12 @@ class Model():
             out.write("Event " + str(event_id) + "\n")
             for key in n_clusters_id:
                 news_id_all = n_clusters_id[key]
+                heavy = self.__news.load_heavy(news_id_all)
                 out.write("Cluster " + str(key) + " num = " + str(len(news_id_all)) + "\n")
                 for news_id in news_id_all:
-                    if news_id in self.__news:
+                    if news_id in self.__news and news_id in heavy:
                         result = self.__news[news_id]
-                        out.write("Title: " + result['title'] + " Time: " + result['crawlTime'] + " Content: " + result['content'] + "\n")
+                        out.write("Title: " + result.title + " Time: " + result.crawlTime + " Content: " + heavy[news_id]['content'] + "\n")
             out.close()
 
         n_clusters_vec.pop(event_id)
@@ -319,6 +590,28 @@ class Model():
 
         return (n_clusters_vec, n_clusters_id, n_centroids)
 
+    def cluster_stats(self, event_id):
+        """
+        取得event的充分統計量, 成員只有附加時以新成員增量更新,
+        成員被改變 (分裂, 讀取時缺少新聞) 或centroid移動超過cluster_stats_tolerance時以成員向量重新精確計算
+        :param event_id: str
+        :return: ClusterStats
+        """
+        members = self.__clusters_id[event_id]
+        vecs = self.__clusters_vec[event_id]
+        stats = self.__stats.get(event_id)
+        if stats is not None and stats.matches(members):
+            stats.add(vecs[stats.n:], last=members[-1])
+            if stats.drift() > self.config.cluster_stats_tolerance:
+                stats = None
+        else:
+            stats = None
+        if stats is None:
+            stats = ClusterStats.from_vectors(vecs, last=members[-1])
+            self.metrics.incr('stats_refreshed')
+        self.__stats[event_id] = stats
+        return stats
+
     def reevalute_centroids(self):
         """
         對cluster centroids重新評估, 重新計算一次聚類中心並評估是否需要分裂
@@ -330,15 +623,20 @@ class Model():
         clusters_id = {}
         centroids = {}
 
-        time.sleep(0.3)
-        pbar = tqdm(total=len(self.__centroids), mininterval=1)
+        pbar = self.progress(total=len(self.__centroids))
         for event_id in self.__clusters_vec:
+            # 常駐模式下只評估上次評估後有變動的event, 沒有變動的event評估結果不會改變
+            if self.__resident and event_id in self.__evaluated:
+                pbar.update(1)
+                continue
             vecs = self.__clusters_vec[event_id]
-            self.__centroids[event_id] = np.mean(vecs, axis=0)
-            cent_vec = self.__centroids[event_id]
+            stats = self.cluster_stats(event_id)
+            self.__centroids[event_id] = stats.centroid()
+            self.metrics.incr('events_evaluated')
             if len(vecs) > 1:
                 # mse = self._func.get_mse(vecs, cent_vec)
-                cos, cos_std = self._func.get_cos(vecs, cent_vec)
+                # 與 self._func.get_cos(vecs, cent_vec) 相同, 以充分統計量計算
+                cos, cos_std = stats.dispersion()
                 # self.mse.append(mse)
                 self.cos.append(cos)
                 self.cos_std.append(cos_std)
@@ -349,10 +647,12 @@ class Model():
                     clusters_vec.update(n_clusters_vec)
                     clusters_id.update(n_clusters_id)
                     centroids.update(n_centroids)
+                    pbar.update(1)
+                    continue
+            self.__evaluated.add(event_id)
             pbar.update(1)
         pbar.close()
 
-        time.sleep(0.3)
         return clusters_vec, clusters_id, centroids
 
     def rearrange_cluster(self):
@@ -374,26 +674,221 @@ class Model():
         vectors = self.vectorize_mongolist(news_list=news_list)
 
         print "Clustering"
-        clusters_vec, clusters_id, centroids = self.online_clustering(vectors=vectors, sim_thres=self.__sim_thres, mode='clustering')
+        with self.stage('cluster') as stage:
+            stage.add(len(vectors))
+            clusters_vec, clusters_id, centroids = self.online_clustering(vectors=vectors, sim_thres=self.__sim_thres, mode='clustering',
+                                                                          copies=self.__dedup.copies if self.__dedup else None)
         print "cluster = ", len(clusters_id)
 
         return (clusters_vec, clusters_id, centroids)
 
     def merge_events(self, cluster_tuple):
-        print "Read events"
-        self.read_events(start_time_t=self.start_time_t)
+        if self.__resident and self.__events_loaded:
+            print "Expire events"
+            print "expired = ", self.expire_events(start_time_t=self.start_time_t)
+        elif self.__snapshot and self.load_snapshot(start_time_t=self.start_time_t):
+            print "Load snapshot"
+            self.__events_loaded = True
+            cluster_tuple = self.drop_clustered(cluster_tuple)
+        else:
+            print "Read events"
+            with self.metrics.stage('read_events') as stage:
+                stage.add(self.read_events(start_time_t=self.start_time_t, events=self.__event_source))
+            self.__event_source = None
+            self.__events_loaded = True
+            cluster_tuple = self.drop_clustered(cluster_tuple)
 
         print "Merge"
         print "previous cluster = ", len(self.__clusters_id)
-        self.online_clustering_merge(cluster_tuple=cluster_tuple)
+        with self.stage('merge') as stage:
+            stage.add(len(cluster_tuple[2]))
+            self.online_clustering_merge(cluster_tuple=cluster_tuple)
         print "merged cluster = ", len(self.__clusters_id)
 
+    def drop_clustered(self, cluster_tuple):
+        """
+        移除已經是讀取的event成員的新聞: 同一個時間段中途失敗 (部分event已寫入) 後重跑時, 新聞不會重複加入
+        :param cluster_tuple: (clusters_vec, clusters_id, centroids), clustering_news的結果
+        :return: cluster_tuple
+        """
+        clusters_vec, clusters_id, centroids = cluster_tuple
+        clustered = set(news_id for members in self.__clusters_id.itervalues() for news_id in members)
+        dropped = 0
+        for key in clusters_id.keys():
+            keep = [i for i, news_id in enumerate(clusters_id[key]) if news_id not in clustered]
+            if len(keep) == len(clusters_id[key]):
+                continue
+            dropped += len(clusters_id[key]) - len(keep)
+            if not keep:
+                del clusters_vec[key], clusters_id[key], centroids[key]
+                continue
+            clusters_id[key] = [clusters_id[key][i] for i in keep]
+            clusters_vec[key] = clusters_vec[key][keep]
+            centroids[key] = np.mean(clusters_vec[key], axis=0)
+        if dropped:
+            self.metrics.incr('news_already_clustered', dropped)
+        return clusters_vec, clusters_id, centroids
+
     def reevaluate(self):
         print "Re-evaluate centroids"
-        cluster_tuple = self.reevalute_centroids()
+        with self.stage('reevaluate') as stage:
+            stage.add(len(self.__clusters_vec))
+            cluster_tuple = self.reevalute_centroids()
 
         print "Merge split event"
-        self.online_clustering_merge(cluster_tuple=cluster_tuple)
+        with self.stage('merge') as stage:
+            stage.add(len(cluster_tuple[2]))
+            self.online_clustering_merge(cluster_tuple=cluster_tuple)
+
+    def create_news_dict(self, record, score, vec):
+        n_news_dict = {"id":"", "publisher":"", "category":"", "title":"", "url":"", "publishTime":"", "score":0., "image":"", "newsVector":None}
+        n_news_dict['id'] = record.id
+        n_news_dict['title'] = record.title
+        n_news_dict['category'] = record.category
+        n_news_dict['publisher'] = record.publisher
+        n_news_dict['url'] = record.url
+        n_news_dict['image'] = record.image
+        n_news_dict['publishTime'] = record.publishTime
+        n_news_dict['score'] = score
+        n_news_dict['newsVector'] = self._codec.encode(vec, kind='sparse')
+        return n_news_dict
+
+    def create_key_news(self, news_id, score, vec, content, centroid_vec):
+        key_news_dict = self.create_news_dict(self.__news[news_id], score, vec)
+        with self.metrics.stage('abstract') as stage:
+            stage.add()
+            key_news_dict['abstract'] = self._func.get_content_abs(self.__dim, content, centroid_vec)
+        return key_news_dict
+
+    def summarize_event(self, event_id, event_json):
+        """
+        寫入event的keynews與實體列表, 並回傳articles與新增的articles
+        event保存累加的中間結果 (aggregates), 之後只以新加入的新聞更新; 每summary_full_every次更新,
+        或成員順序改變 (例如重新評估移除了新聞) 時重新計算全部新聞, 修正centroid移動造成的誤差
+        :param event_id: event id
+        :param event_json: event, 直接修改
+        :return: articles: list of news dict, 成員另外存放時增量更新只包含event中保留的articles與新增的articles
+        :return: appended: 新增的articles, 重新計算全部新聞時為 None
+        """
+        news_ids = self.__clusters_id[event_id]
+        aggregates = event_json.get('aggregates')
+        full_every = self.config.summary_full_every
+        if aggregates and full_every and aggregates['updates'] < full_every \
+                and aggregates.get('layout', 'inline') == self.config.event_article_layout \
+                and 0 < aggregates['members'] <= len(news_ids) \
+                and news_ids[aggregates['members'] - 1] == aggregates['last'] \
+                and event_json.get('keynews') and event_json['keynews']['id'] in self.__news:
+            self.metrics.incr('summaries_incremental')
+            return self.update_summary(event_id, event_json, aggregates)
+        self.metrics.incr('summaries_full')
+        return self.full_summary(event_id, event_json), None
+
+    def full_summary(self, event_id, event_json):
+        """
+        以event的全部新聞計算keynews, articles的score與實體列表
+        """
+        news_ids = self.__clusters_id[event_id]
+        # 批次讀取本event新聞的content與實體列表
+        heavy = self.__news.load_heavy(news_ids)
+        event_vecs = self.__clusters_vec[event_id]
+        centroid_vec = self.__centroids[event_id]
+        # sim_list同時用在給定articles的scores上
+        sim_list = [ (vid, self._func.cal_similarity(vec, centroid_vec) ) for vid, vec in enumerate(event_vecs) ]
+        self.metrics.incr('similarities', len(sim_list))
+        max_dist = self.pick_key_news(news_ids, sim_list, heavy)
+        if max_dist is not None:
+            key_news_id = news_ids[max_dist[0]]
+            event_json['keynews'] = self.create_key_news(key_news_id, max_dist[1], event_vecs[max_dist[0]],
+                                                         heavy[key_news_id]['content'], centroid_vec)
+
+        articles = []
+        for idx, news_id in enumerate(news_ids):
+            # 尋找news collection是否包含news_id的新聞
+            if news_id in self.__news:
+                articles.append(self.create_news_dict(self.__news[news_id], sim_list[idx][1], event_vecs[idx]))
+
+        # 寫入實體列表, 並嘗試加上一個衰退率讓遠離事件中心的實體權重下降
+        # 第i篇新聞 (依成員順序) 的權重為 0.99 ** i
+        with self.metrics.stage('entities') as stage:
+            member_heavy = [heavy[news_id] for news_id in news_ids if news_id in heavy]
+            stage.add(len(member_heavy))
+            state = self._entities.accumulate(self._entities.new_state(), member_heavy)
+            event_json.update(self._entities.rank(state))
+        event_json['aggregates'] = {'members': len(news_ids),
+                                    'last': news_ids[-1],
+                                    'updates': 0,
+                                    'layout': self.config.event_article_layout,
+                                    'state': self._entities.encode(state)}
+        return articles
+
+    def pick_key_news(self, news_ids, sim_list, heavy):
+        """
+        選擇相似度最高且讀取得到content的新聞作為keynews
+        最高的新聞不在heavy中 (news collection已刪除) 時改用次高的, 全部都讀不到時不更新keynews
+        :param news_ids: event的成員id
+        :param sim_list: [(成員位置, 與centroid的相似度)]
+        :param heavy: load_heavy的結果
+        :return: (成員位置, 相似度), 沒有可用的新聞時為 None
+        """
+        if not sim_list:
+            return None
+        max_dist = max(sim_list, key=lambda v:v[1])
+        if news_ids[max_dist[0]] in heavy:
+            return max_dist
+        for dist in sorted(sim_list, key=lambda v:v[1], reverse=True):
+            if news_ids[dist[0]] in heavy:
+                self.metrics.incr('keynews_fallback')
+                return dist
+        self.metrics.incr('keynews_missing')
+        return None
+
+    def update_summary(self, event_id, event_json, aggregates):
+        """
+        只以新加入的新聞更新keynews, articles與實體列表, 已經寫入的articles的score不重新計算
+        """
+        news_ids = self.__clusters_id[event_id]
+        start = aggregates['members']
+        new_ids = news_ids[start:]
+        heavy = self.__news.load_heavy(new_ids)
+        event_vecs = self.__clusters_vec[event_id]
+        centroid_vec = self.__centroids[event_id]
+
+        # keynews: 原本的keynews以目前的centroid重新計分, 與新加入的新聞比較
+        # 複製後修改, 讀取時的document保持不變, 供DeltaWriter比較
+        key_news = dict(event_json['keynews'])
+        event_json['keynews'] = key_news
+        # 先前讀不到content而沒有寫入keynews時, 由新加入的新聞遞補
+        if key_news.get('id') in news_ids:
+            key_idx = news_ids.index(key_news['id'])
+            key_news['score'] = self._func.cal_similarity(event_vecs[key_idx], centroid_vec)
+        else:
+            key_news['score'] = -1.
+        sim_list = [(start + i, self._func.cal_similarity(vec, centroid_vec)) for i, vec in enumerate(event_vecs[start:])]
+        self.metrics.incr('similarities', len(sim_list) + 1)
+        max_dist = self.pick_key_news(news_ids, sim_list, heavy)
+        if max_dist is not None and max_dist[1] > key_news['score']:
+            key_news_id = news_ids[max_dist[0]]
+            event_json['keynews'] = self.create_key_news(key_news_id, max_dist[1], event_vecs[max_dist[0]],
+                                                         heavy[key_news_id]['content'], centroid_vec)
+
+        appended = []
+        for idx, sim in sim_list:
+            news_id = news_ids[idx]
+            if news_id in self.__news:
+                appended.append(self.create_news_dict(self.__news[news_id], sim, event_vecs[idx]))
+        articles = list(event_json.get('articles') or []) + appended
+
+        with self.metrics.stage('entities') as stage:
+            member_heavy = [heavy[news_id] for news_id in new_ids if news_id in heavy]
+            stage.add(len(member_heavy))
+            state = self._entities.accumulate(self._entities.decode(aggregates['state']), member_heavy)
+            event_json.update(self._entities.rank(state))
+        event_json['aggregates'] = {'members': len(news_ids),
+                                    'last': news_ids[-1],
+                                    'updates': aggregates['updates'] + 1,
+                                    'layout': self.config.event_article_layout,
+                                    'state': self._entities.encode(state)}
+        return articles, appended
 
     def write_event(self, start_time_t):
         """
@@ -401,235 +896,161 @@ class Model():
         :param t: end_time_t 改為 start_time_t
         :return:
         """
-        time.sleep(0.3)
-        pbar = tqdm(total=len(self.__clusters_id), mininterval=1)
-        # events = []
-        for event_id in self.__clusters_id:
-            event_result = self.__event_reader.query_one_by_item({'_id': event_id})
-            # 先尋找event collection是否包含event_id的事件
-            # 沒有找到
-            if not event_result:
-                event_json = get_event_json()
-                event_json['created'] = self._func.time2time_string(datetime.datetime.now())
-                event_json['updated'] = start_time_t
-            # 找到
-            else:
-                event_json = event_result
-                # 由於不是每個讀取的event都有更新, 因此僅僅紀錄更新過的event並將其寫回mongodb, 如果沒有更新就直接跳過
-                if not self.__updated_events[event_id]:
+        pbar = self.progress(total=len(self.__clusters_id))
+        # 已經存在的event只寫入與讀取時不同的欄位, 以及新增的articles
+        delta = DeltaWriter(self.__event_reader)
+        # pipeline模式下由背景thread寫入mongoDB
+        if self.__pipeline:
+            writer = self.__pipeline.sink('write_events', lambda item: delta.save(*item))
+            save_item = lambda before, after, members=None, start=0: writer.put((before, after, members, start))
+        else:
+            save_item = delta.save
+        try:
+            # 相似事件圖只更新新增與移動的event
+            with self.metrics.stage('related') as stage:
+                similarities = self.__graph.similarities
+                stage.add(self.__graph.sync(self.__centroids))
+                self.metrics.incr('similarities', self.__graph.similarities - similarities)
+            # events = []
+            closed_events = []
+            written = set()
+            for event_id in self.__clusters_id:
+                # 讀取後沒有更新的event不需要再查詢mongoDB
+                if self.__updated_events.get(event_id) is False:
                     pbar.update(1)
                     continue
-                event_json['updated'] = start_time_t
-
-            # 寫入 event 基本info & 關鍵要素
-            # keynews
-            event_json['_id'] = event_id
-            event_json['id'] = event_id
-            def create_news_dict(news_dict, score):
-                n_news_dict = {"id":"", "publisher":"", "category":"", "title":"", "url":"", "publishTime":"", "score":0., "image":""}
-                n_news_dict['id'] = news_dict['_id']
-                n_news_dict['title'] = news_dict['title']
-                n_news_dict['category'] = news_dict['category']
-                n_news_dict['publisher'] = news_dict['publisher']
-                n_news_dict['url'] = news_dict['url']
-                n_news_dict['image'] = news_dict['image']
-                n_news_dict['publishTime'] = news_dict['publishTime']
-                n_news_dict['score'] = score
-                return n_news_dict
-
-            event_vecs = self.__clusters_vec[event_id]
-            centroid_vec = self.__centroids[event_id]
-            # sim_list同時用在給定articles的scores上
-            sim_list = [ (vid, self._func.cal_similarity(vec, centroid_vec) ) for vid, vec in enumerate(event_vecs) ]
-            max_dist = max(sim_list, key=lambda v:v[1])
-            key_news_id = self.__clusters_id[event_id][max_dist[0]]
-            news_dict = self.__news[key_news_id]
-            key_news_dict = create_news_dict(news_dict, max_dist[1])
-            key_news_dict['abstract'] = self._func.simple_content_abs(news_dict['content'])
-            event_json['keynews'] = key_news_dict
-            
-            articles = []
-            for idx, news_id in enumerate(self.__clusters_id[event_id]):
-                # 尋找news collection是否包含news_id的新聞
-                if news_id in self.__news:
-                    news_dict = self.__news[news_id]
-                    n_news_dict = create_news_dict(news_dict, sim_list[idx][1])
-                    articles.append(n_news_dict)
-            # articles
-            event_json['count'] = len(articles)
-            event_json['articles'] = articles
-
-            # 寫入 event 的父子關係
-            if event_id in self.__son2father_event:
-                father_event_id = self.__son2father_event[event_id]
-                event_json['father'] = father_event_id
-            # 在這裡插入如果有子事件分裂的話, 則對該事件停止繼續合併的策略
-            if event_id in self.__father2son_event:
-                son_event_set = self.__father2son_event[event_id]
-                event_json['childrens'] = list(son_event_set)
-                event_json['closed'] = start_time_t
+                event_result = self.__event_reader.query_one_by_item({'_id': event_id})
+                # 先尋找event collection是否包含event_id的事件
+                # 沒有找到
+                if not event_result:
+                    before = None
+                    event_json = get_event_json()
+                    event_json['created'] = self._func.time2time_string(datetime.datetime.now())
+                    event_json['updated'] = start_time_t
+                # 找到
+                else:
+                    before = dict(event_result)
+                    event_json = event_result
+                    # 由於不是每個讀取的event都有更新, 因此僅僅紀錄更新過的event並將其寫回mongodb, 如果沒有更新就直接跳過
+                    if not self.__updated_events[event_id]:
+                        pbar.update(1)
+                        continue
+                    event_json['updated'] = start_time_t
+
+                # 寫入 event 基本info & 關鍵要素
+                # keynews
+                event_json['_id'] = event_id
+                event_json['id'] = event_id
+                # keynews, articles與實體列表
+                articles, appended = self.summarize_event(event_id, event_json)
+                # articles
+                members, start = None, 0
+                if self.config.event_article_layout == 'collection':
+                    # 全部成員另外存放, 增量更新時只寫入新增的成員; event只保留score最高的event_inline_articles篇
+                    if appended is None:
+                        members = articles
+                    else:
+                        members, start = appended, event_json.get('count', 0)
+                    event_json['count'] = start + len(members)
+                    event_json['articles'] = heapq.nlargest(self.config.event_inline_articles, articles,
+                                                            key=lambda article: article['score'])
+                else:
+                    event_json['count'] = len(articles)
+                    event_json['articles'] = articles
+                centroid_vec = self.__centroids[event_id]
+                event_json['eventVector'] = self._codec.encode(centroid_vec, kind=self.config.event_vector_codec)
+                # 充分統計量, 下一次讀取時只以新加入的成員更新
+                stats = self.__stats.get(event_id)
+                if stats is not None and stats.n == len(self.__clusters_id[event_id]) and stats.matches(self.__clusters_id[event_id]):
+                    event_json['clusterStats'] = stats.encode(self._codec)
+                else:
+                    event_json.pop('clusterStats', None)
+                event_json['modified'] = self._func.time2time_string(datetime.datetime.now())
+
+                # 寫入 event 的父子關係
+                if event_id in self.__son2father_event:
+                    father_event_id = self.__son2father_event[event_id]
+                    event_json['father'] = father_event_id
+                # 在這裡插入如果有子事件分裂的話, 則對該事件停止繼續合併的策略
+                if event_id in self.__father2son_event:
+                    son_event_set = self.__father2son_event[event_id]
+                    event_json['childrens'] = list(son_event_set)
+                    event_json['closed'] = start_time_t
+                    closed_events.append(event_id)
 
             
-            # 寫入event的相似事件, 僅僅會link上本次生成或讀取的event, 存在於collection內已經過期的event不影響
-            centroid_vec = self.__centroids[event_id]
-            score_list = [ (event_id, eid, self._func.cal_similarity(centroid_vec, vec)) for eid, vec in self.__centroids.iteritems() ]
-            sort_scores = sorted(score_list, key=lambda v:v[-1], reverse=True)[1:]
-
-            # print sort_scores
-            k_realted_events = 15
-            related_events = []
-            for score in sort_scores[:k_realted_events]:
-                if score[-1] > 0.6:
-                    # r_event = {'id':"", 'label':"", score:0}
-                    r_event = {}
-                    rid = score[1]
-                    # rlabel = self.__events[rid]['label']
-                    # r_event['label'] = rlabel
-                    r_event['id'] = rid
-                    r_event['score'] = score[-1]
-                    related_events.append(r_event)
-
-            event_json['relatedEvents'] = related_events
-
-            # 寫入實體列表, 並嘗試加上一個衰退率讓遠離事件中心的實體權重下降
-            # 衰退率 decay = 1.0 / n_news, 此假設為聚類最外圍的新聞權重最小, 如果有10筆新聞, 最後一個新聞權重為0.1
-            # sim_list 為最靠近中心的新聞sort list
-            weight = 1.0
-            decay = 0.99
-            # {word:score}
-            keywords = {}
-            persons = {}
-            locations = {}
-            organizations = {}
-            entities = {}
-            when_dict = {}
-            who_dict = {}
-            where_dict = {}
-
-            def update_score(input_list, update_dict, weight):
-                for keyword in input_list:
-                    wd = keyword['word']
-                    score = keyword['score']
-                    if wd not in update_dict:
-                        update_dict[wd] = score * weight
+                # 寫入event的相似事件, 僅僅會link上本次生成或讀取的event, 存在於collection內已經過期的event不影響
+                event_json['relatedEvents'] = self.__graph.related(event_id)
+
+                # 先暫時以keywords最大的關鍵字作為label, 到時候可以換成mention或其他keywords
+                event_json['label'] = " ".join(i['word'] for i in event_json['keywords'][:5])
+                # 本方法為考量全部keywords > 0.6的關鍵字, 並串聯再一起
+                # event_json['label'] = " ".join([keyword for keyword in event_json['keywords'] if keyword['score'] > 0.6])
+
+                # events.append(event_json)
+                save_item(before, event_json, members, start)
+                if self.__cache:
+                    # 分裂後關閉的父事件從cache中刪除
+                    if event_json['closed']:
+                        self.__cache.invalidate([event_id])
                     else:
-                        update_dict[wd] += score * weight
-
-            def update_ner_score(input_list, update_dict, weight):
-                for keyword in input_list:
-                    mention = keyword['mention']
-                    count = keyword['count']
-                    url = keyword['linkedURL']
-                    if mention not in update_dict:
-                        update_dict[mention] = {'count':count, 'linkedURL':url}
+                        self.__cache.put(event_json)
+                self.__updated_events[event_id] = False
+                self.__registry.touch(event_id, start_time_t)
+                self.metrics.incr('events_written')
+                written.add(event_id)
+                pbar.update(1)
+
+            # 沒有更新的event, 鄰居列表因其他event新增或移動而改變時只寫回relatedEvents
+            for event_id in self.__graph.pop_changed():
+                if event_id in written:
+                    continue
+                event_result = self.__event_reader.query_one_by_item({'_id': event_id})
+                if not event_result:
+                    continue
+                before = dict(event_result)
+                event_json = event_result
+                event_json['relatedEvents'] = self.__graph.related(event_id)
+                event_json['modified'] = self._func.time2time_string(datetime.datetime.now())
+                save_item(before, event_json)
+                if self.__cache:
+                    if event_json['closed']:
+                        self.__cache.invalidate([event_id])
                     else:
-                        update_dict[mention]['count'] += count
-
-            for vid, _ in sim_list:
-                news_id = self.__clusters_id[event_id][vid]
-                news = self.__news[news_id]
-                # 關鍵詞抽取
-                update_score(news['keywords'], keywords, weight)
-
-                # when, where, who抽取
-                update_score(news['when'], when_dict, weight)
-                update_score(news['where'], where_dict, weight)
-                update_score(news['who'], who_dict, weight)
-
-                # person, locations, organizations抽取
-                # 暫時先用count作為score, 之後考慮打分機制
-                # 目前加上score考慮方式: 由count做打分, 並乘上weight, 隨著遠離cluster中心遞減
-                update_ner_score(news['persons'], persons, weight)
-                update_ner_score(news['locations'], locations, weight)
-                update_ner_score(news['organizations'], organizations, weight)
-
-                weight *= decay
-            # 把生成的全部要素關鍵放回event_json
-            k_important = 20
-            def normalize_entities(ent_dict, k_important):
-		if not ent_dict:
-			return []
-                sort_ent_list = sorted(ent_dict.iteritems(), key=lambda x:x[1], reverse=True)
-                word_list, score_list = zip(*sort_ent_list)
-                norm_score_list = preprocessing.normalize([score_list])[0]
-                return [{'word':word, 'score':'{:.2f}'.format(score)} for word, score in zip(word_list, norm_score_list)[:k_important]]
-            
-            # event_json['keywords'] = [{'word':word, 'score':'{:.2f}'.format(score)} for word, score in sorted(keywords.iteritems(), key=lambda x:x[1], reverse=True)[:k_important]]
-            event_json['keywords'] = normalize_entities(keywords, k_important=k_important)
-            event_json['when'] = normalize_entities(when_dict, k_important=k_important)
-            event_json['where'] = normalize_entities(where_dict, k_important=k_important)
-            event_json['who'] = normalize_entities(who_dict, k_important=k_important)
-            # count_list = []
-            def normalize_ner_entities(ent_dict, k_important=10):
-		if not ent_dict:
-			return []
-                sort_ent_list = sorted(ent_dict.iteritems(), key=lambda x:x[1]['count'], reverse=True)
-                mention_list, score_dict = zip(*sort_ent_list)
-                score_tuple = [(i['count'], i['linkedURL']) for i in score_dict]
-                count_list, url_list = zip(*score_tuple)
-                norm_score_list = preprocessing.normalize([count_list])[0]
-                return [{'mention':mention, 'count':'{:.2f}'.format(count), 'score':'{:.2f}'.format(score), 'linkedURL':url} for mention, count, score, url in zip(mention_list, count_list, norm_score_list, url_list)[:k_important]]
-
-            # event_json['persons'] = [{'mention':mention, 'score':'{:.2f}'.format(info['count']), 'linkedURL':info['linkedURL']}
-            #                          for mention, info in sorted(persons.iteritems(), key=lambda x:x[1]['count'], reverse=True)[:k_important]]
-            event_json['persons'] = normalize_ner_entities(persons, k_important=k_important)
-            event_json['locations'] = normalize_ner_entities(locations, k_important=k_important)
-            event_json['organizations'] = normalize_ner_entities(organizations, k_important=k_important)
-            # 先暫時以keywords最大的關鍵字作為label, 到時候可以換成mention或其他keywords
-            event_json['label'] = " ".join(i['word'] for i in event_json['keywords'][:5])
-            # 本方法為考量全部keywords > 0.6的關鍵字, 並串聯再一起
-            # event_json['label'] = " ".join([keyword for keyword in event_json['keywords'] if keyword['score'] > 0.6])
-
-            # events.append(event_json)
-            self.__event_reader.save_item(event_json)
-            pbar.update(1)
+                        self.__cache.put(event_json)
+                self.metrics.incr('events_related_written')
 
-        pbar.close()
-        time.sleep(0.3)
+            pbar.close()
+        except Exception:
+            # 寫入中途發生例外時停止背景thread, 不讓它阻塞在queue上
+            if self.__pipeline:
+                writer.abort()
+            raise
+        if self.__pipeline:
+            writer.close()
+        for name, value in delta.report().iteritems():
+            self.metrics.incr(name, value)
+        if self.__cache:
+            self.__cache.flush()
+            self.report_cache()
+
+        # 常駐模式下已分裂關閉的父事件不再參與之後的合併
+        if self.__resident:
+            for event_id in closed_events:
+                self.drop_event(event_id)
 
         # for event in events:
             # self.__event_reader.save_item(event)
 
     def write_result(self):
         """
-        輸出聚類結果
+        輸出聚類結果: cluster成員, centroid與相似度統計, 以jsonl與npz在背景thread寫入 output_path (見 utils/export.py)
         :return:
         """
-        outbase = self.output_path
-        if not os.path.exists(outbase):
-            os.mkdir(outbase)
-
-        out = open(os.path.join(outbase, str(self.__date)), "w")
-        # id_out = open(os.path.join(outbase, "cid"), "w")
-        clusters_id = self.rearrange_cluster()
-
-        for event_id, cluster in clusters_id:
-            out.write("Cluster " + str(event_id) + " num = " + str(len(cluster)) + "\n")
-            # id_out.write(json.dumps(cluster) + "\n")
-            if len(cluster) == 1:
-                self.__single_count += 1
-            for news_id in cluster:
-                if news_id in self.__news:
-                    result = self.__news[news_id]
-                    out.write("Title: " + result['title'] + " Time: " + result['crawlTime'] + " Content: " + result['content'] + "\n")
-
-        out.close()
-        # id_out.close()
-
-        # mse_out = open(os.path.join(outbase, "mse"+str(self.__date)), "w")
-        # for mse in sorted(self.mse, reverse=True):
-        #     mse_out.write(str(mse) + "\n")
-        # mse_out.close()
-
-        cos_out = open(os.path.join(outbase, "cos" + str(self.__date)), "w")
-        for cos in sorted(self.cos, reverse=True):
-            cos_out.write(str(cos) + "\n")
-        cos_out.close()
-
-        cos_out = open(os.path.join(outbase, "cos_std" + str(self.__date)), "w")
-        for cos in sorted(self.cos_std, reverse=True):
-            cos_out.write(str(cos) + "\n")
-        cos_out.close()
+        self.__single_count = sum(1 for cluster in self.__clusters_id.itervalues() if len(cluster) == 1)
+        snapshot = self.__exporter.snapshot(self.__clusters_id, self.__clusters_vec, self.__centroids,
+                                            cos=self.cos, cos_std=self.cos_std)
+        self.__exporter.submit(str(self.__date), snapshot)
 
     def write_log(self):
         """
@@ -651,37 +1072,179 @@ class Model():
                   'n_news':self.__news_count,
                   'n_single_event':self.__single_count,
                   'n_events':len(self.__clusters_id)}
+        if self.__pipeline:
+            params['stages'] = self.__pipeline.report()
+        params['news_store'] = self.__news.report()
+        self.metrics.set('events', len(self.__clusters_id))
+        self.metrics.set('news_records', len(self.__news))
+        params['metrics'] = self.metrics.report()
         with open(os.path.join(logbase, "log_"+str(self.__date)+".json"), "w") as f:
             f.write(json.dumps(params))
         with open(os.path.join(logbase, "log.json"), "w") as f:
             f.write(json.dumps(params))
+        self.write_metrics()
+
+    def write_metrics(self):
+        """
+        輸出本時間段的metrics: append到 log/metrics.jsonl, 並覆寫Prometheus textfile log/metrics.prom
+        :return:
+        """
+        self.metrics.write_jsonl(os.path.join(self.log_path, "metrics.jsonl"),
+                                 labels={'start': self.start_time_t, 'end': self.end_time_t})
+        self.metrics.write_prometheus(os.path.join(self.log_path, "metrics.prom"))
+        if self.__profiler:
+            profile_path = os.path.join(self.log_path, "profile", self.__date)
+            print "Profile", profile_path, self.__profiler.dump(profile_path)
+            self.__profiler = None
 
     def output(self, debug=False):
         print "Write event"
-        self.write_event(start_time_t=self.start_time_t)
-        if debug:
+        with self.stage('write_event') as stage:
+            stage.add(len(self.__clusters_id))
+            self.write_event(start_time_t=self.start_time_t)
+        if self.__snapshot:
+            print "Save snapshot", self.save_snapshot()
+        if debug or self.config.export:
             self.write_result()
         self.write_log()
+        if self.__pipeline:
+            for name, stage in self.__pipeline.report().iteritems():
+                print name, stage
+        # 輸出與log寫入重疊, 結束前等待完成, 背景輸出的例外在這裡拋出而不是留到下一次submit (或遺失)
+        self.__exporter.wait()
 
-    def run(self, news_list, time_info):
+    def begin(self, time_info, pipeline=False):
         """
-
-        :param news_list: 讀入時間段內全部新聞
-        :param time_info: (start_time, end_time) 的封裝
-        :param start_time: 開始時間 (start_time_ts, start_time_t) : (float, string)
-        :param end_time: 結束時間 (end_time_ts, end_time_t) : (float, string)
-        :return:
+        每個時間段開始時的設定, 常駐模式下每次run重新計時與統計
+        :param time_info: (start_time_t, end_time_t)
+        :param pipeline: 是否建立pipeline
         """
         start_time_t, end_time_t = time_info
         self.start_time_t = start_time_t
         self.end_time_t = end_time_t
         self.__date = self.__event_reader.create_event_id(t=self.start_time_t)
-        # 僅僅在有讀入新聞時才做clustering, 否則則直接留下log
-        if news_list.count():
-            cluster_tuple = self.clustering_news(news_list=news_list)
+        self.__start = datetime.datetime.now()
+        self.__single_count = 0
+        self.cos = []
+        self.cos_std = []
+        self.__pipeline = Pipeline(maxsize=self.config.queue_size) if pipeline else None
+        self.metrics = Metrics()
+        for name, value in self.gauges.iteritems():
+            self.metrics.set(name, value)
+        # --profile / --profile_memory: 每個stage的cProfile與tracemalloc, 關閉時不掛hook
+        if self.config.profile or self.config.profile_memory:
+            self.__profiler = StageProfiler(cpu=self.config.profile, memory=self.config.profile_memory)
+            self.metrics.hooks.append(self.__profiler)
+
+    def run_sharded(self, transport, tasks, time_info):
+        """
+        map/reduce模式: worker各自聚類一個shard (map), 在此以merge_sim_thres合併各shard的聚類 (reduce),
+        之後與run相同, 與讀取的event合併, 重新評估並寫入
+        :param transport: utils.shard.Transport
+        :param tasks: utils.shard.time_slices 或 hash_shards 產生的task
+        :param time_info: (start_time_t, end_time_t)
+        :return:
+        """
+        self.begin(time_info)
+        print "Map", len(tasks), "shards"
+        with self.stage('map') as stage:
+            summaries = transport.map(tasks)
+            stage.add(len(tasks))
+        self.__news_count = sum(summary['n_news'] for summary in summaries)
+        for summary in summaries:
+            for record in summary['records']:
+                self.__news.add(record)
+            # worker的計數器 (news_in, similarities, events_created...) 直接累加
+            for name, value in summary['metrics']['counters'].iteritems():
+                self.metrics.incr(name, value)
+            print "shard", summary['shard'], "news =", summary['n_news'], "cluster =", len(summary['clusters'])
+
+        print "Reduce"
+        with self.stage('reduce') as stage:
+            stage.add(sum(len(summary['clusters']) for summary in summaries))
+            clusters_id, centroids, stats, copies, merged = reduce_summaries(summaries, self.__merge_sim_thres,
+                                                                              self._func, self._codec)
+        self.metrics.incr('shard_clusters_merged', merged)
+        print "cluster = ", len(clusters_id)
+        # worker計算的充分統計量, 沒有被合併的聚類重新評估時不需要以成員向量重新計算
+        stats = dict((key, ClusterStats.decode(doc, self._codec, self.__dim, centroid=centroids[key]))
+                     for key, doc in stats.iteritems())
+
+        if self.__news_count:
+            with self.stage('rebuild') as stage:
+                stage.add(sum(len(members) for members in clusters_id.itervalues()))
+                cluster_tuple = self.rebuild_clusters(clusters_id, centroids, copies)
             self.merge_events(cluster_tuple=cluster_tuple)
+            for key, cluster_stats in stats.iteritems():
+                if key in self.__clusters_id and cluster_stats.matches(self.__clusters_id[key]):
+                    self.__stats[key] = cluster_stats
             self.reevaluate()
             self.output()
         else:
             self.write_log()
             print "no news in current time span"
+
+    def rebuild_clusters(self, clusters_id, centroids, copies):
+        """
+        map/reduce模式下worker不傳送成員向量, 以成員的stemmed欄位重新向量化, 與worker的向量相同
+        重複的新聞 (--dedup) 使用代表的向量; 已經從news collection刪除的新聞從聚類中移除
+        :param clusters_id: { 聚類id: news id list }
+        :param centroids: { 聚類id: centroid }
+        :param copies: { 重複的news id: 代表的news id }
+        :return: (clusters_vec, clusters_id, centroids), 格式同online_clustering
+        """
+        ids = [news_id for members in clusters_id.itervalues() for news_id in members if news_id not in copies]
+        vecs = {}
+        batch_size = self.config.fetch_batch
+        for i in range(0, len(ids), batch_size):
+            for news in self.__news_reader.query_many_by_item({'_id': {'$in': ids[i:i + batch_size]}},
+                                                              fields=self.__news.fetch_fields()):
+                vecs[news['_id']] = self.vectorize(news['stemmedTitle'] + ' ' + news['stemmedContent'])
+        clusters_vec = {}
+        for key in clusters_id.keys():
+            members = [news_id for news_id in clusters_id[key] if copies.get(news_id, news_id) in vecs]
+            missing = len(clusters_id[key]) - len(members)
+            if missing and not members:
+                self.metrics.incr('shard_news_missing', missing)
+                del clusters_id[key], centroids[key]
+                continue
+            clusters_vec[key] = np.asarray([vecs[copies.get(news_id, news_id)] for news_id in members], dtype=np.float)
+            if missing:
+                self.metrics.incr('shard_news_missing', missing)
+                clusters_id[key] = members
+                centroids[key] = np.mean(clusters_vec[key], axis=0)
+        return clusters_vec, clusters_id, centroids
+
+    def copies(self):
+        """
+        :return: { 代表的news id: 重複的news id list }, 沒有 --dedup 時為空
+        """
+        return self.__dedup.copies if self.__dedup else {}
+
+    def run(self, news_list, time_info):
+        """
+
+        :param news_list: 讀入時間段內全部新聞
+        :param time_info: (start_time, end_time) 的封裝
+        :param start_time: 開始時間 (start_time_ts, start_time_t) : (float, string)
+        :param end_time: 結束時間 (end_time_ts, end_time_t) : (float, string)
+        :return:
+        """
+        self.begin(time_info, pipeline=self.config.pipeline)
+        try:
+            # 僅僅在有讀入新聞時才做clustering, 否則則直接留下log
+            if self.count_news(news_list):
+                # pipeline模式下, 在向量化與聚類時由背景thread預先讀取event
+                if self.__pipeline and not self.__snapshot and not (self.__resident and self.__events_loaded):
+                    self.__event_source = self.__pipeline.producer('load_events', self.iter_events(self.start_time_t))
+                cluster_tuple = self.clustering_news(news_list=news_list)
+                self.merge_events(cluster_tuple=cluster_tuple)
+                self.reevaluate()
+                self.output()
+            else:
+                self.write_log()
+                print "no news in current time span"
+        finally:
+            # 例外時停止尚在讀取event的producer與寫入的sink
+            if self.__pipeline:
+                self.__pipeline.close()
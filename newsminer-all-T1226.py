@@ -32,6 +32,7 @@ import bson
 import getopt
 import threading
 import redis
+from utils.codec import VectorCodec
 reload(sys)
 sys.setdefaultencoding("utf-8")
 
@@ -59,6 +60,7 @@ redispassword=str(cong_list[13])
 congFile.close()
 closedID=[]
 now=""
+codec=VectorCodec()#新闻向量与事件向量的二进制编码
 #################
 def is_alphabet(uchar):
     """判断一个unicode是否是英文字母"""
@@ -146,7 +148,7 @@ def cluster(infile,threshold):
                 print Exception, ":", e
         narry=array(list_tmp)
         ##########新增单篇新闻的向量####
-        file_dict[key][u"newsVector"]=narry.tolist()
+        file_dict[key][u"newsVector"]=narry
         ####一篇文档的vector计算完毕，开始计算与之前topic的余弦相似度进行合并
         dict_similarity = {}
         if count == 0:  ####第一篇文档，直接归为第一个topic
@@ -189,7 +191,7 @@ def cluster(infile,threshold):
     print "clustering finished!"
     ##########输出事件聚类中心向量
     for i in topic2vec:
-        topic2vec[i] = topic2vec[i].tolist()
+        topic2vec[i] = codec.encode(topic2vec[i],kind="dense32")
 ###@#############
     fina_list=[]
     for i in DocumentinTopic:
@@ -216,13 +218,8 @@ def cluster(infile,threshold):
             singalArticle_dict[u"title"] = file_dict[document[j]][u"title"]
             singalArticle_dict[u"url"]= file_dict[document[j]][u"url"]
 ##0719修改部分#####
-            singalArticle_dict[u"newsVector"]=[]
-            for item in xrange(len(file_dict[document[j]][u"newsVector"])):
-                dict_tmp = {}
-                if file_dict[document[j]][u"newsVector"][item] >0:
-                    dict_tmp[str(item)]=file_dict[document[j]][u"newsVector"][item]
-                    singalArticle_dict[u"newsVector"].append(dict_tmp)
-                del dict_tmp
+            #改为二进制稀疏编码(utils/codec.py)，只存储非零位置与数值
+            singalArticle_dict[u"newsVector"]=codec.encode(file_dict[document[j]][u"newsVector"],kind="sparse")
             #singalArticle_dict[u"newsVector"] = file_dict[document[j]][u"newsVector"]
 ####0719##########
             ###旧的新闻格式还未增加该字段
@@ -275,7 +272,7 @@ def merge(NumOfTopic,threshold,newevent,oldevent):
     normlization={}
 ##################################
     for line in oldevent:
-        topic2vec[line[u"id"]] = array(line[u"eventVector"])
+        topic2vec[line[u"id"]] = codec.decode(line[u"eventVector"])
         number_DocsinTopic[line[u"id"]] = line[u"count"]
         normlization[line[u"id"]]=False
         ###############33
@@ -284,7 +281,7 @@ def merge(NumOfTopic,threshold,newevent,oldevent):
 ###############
     for line in newevent:
         ####
-        narry = array(line[u"eventVector"])
+        narry = codec.decode(line[u"eventVector"])
         key=line[u"id"]
         ####一篇文档的vector计算完毕，开始计算与之前topic的余弦相似度进行合并
         dict_similarity = {}
@@ -447,7 +444,7 @@ def merge(NumOfTopic,threshold,newevent,oldevent):
     print "merge finished!"
     ##########输出事件聚类中心向量
     for i in topic2vec:
-        topic2vec[i] = topic2vec[i].tolist()
+        topic2vec[i] = codec.encode(topic2vec[i],kind="dense32")
         for line in oldevent:
             if line[u"id"]==i:
                 line[u"eventVector"]=topic2vec[i]#更新事件的向量，事件的id号重要
@@ -479,6 +476,19 @@ def ReadMongoEventData(startTime,endTime):
         except Exception, e:
             print Exception, ":", e
     return (file_list,num)
+#redis中的事件给前端读取，不需要二进制的向量
+def CacheEventData(line):
+    cache_line=dict(line)
+    cache_line.pop(u"eventVector",None)
+    if isinstance(cache_line.get(u"keynews"),dict):
+        cache_line[u"keynews"]=dict(cache_line[u"keynews"])
+        cache_line[u"keynews"].pop(u"newsVector",None)
+    cache_line[u"articles"]=[]
+    for art in line[u"articles"]:
+        cache_art=dict(art)
+        cache_art.pop(u"newsVector",None)
+        cache_line[u"articles"].append(cache_art)
+    return json.dumps(cache_line,ensure_ascii=False)
 #将处理完成的事件信息存入事件库中
 def WriteMongoEventData(EventFiles):
     outfile=codecs.open(r"./result.txt","w","utf-8")
@@ -498,36 +508,34 @@ def WriteMongoEventData(EventFiles):
             line[u"_id"]=time.strftime("%Y%m%d%H%M%S", time.localtime())+str(ObjectId())
 
             if line[u"updated"] >= now:
-                r.set(line["_id"], json.dumps(line,ensure_ascii=False))
+                r.set(line["_id"], CacheEventData(line))
             try:
                 connection.insert(line)
             except Exception, e:
                 print Exception, ":", e
-                outfile.write(json.dumps(line, ensure_ascii=False) + "\n")
+                outfile.write(CacheEventData(line) + "\n")
         else:
             if line[u"updated"] >= now:
-                r.set(line["_id"], json.dumps(line,ensure_ascii=False))
+                r.set(line["_id"], CacheEventData(line))
             try:
                 connection.update({"_id": line[u"_id"]}, {'$set': line})
             except Exception, e:
                 print Exception, ":", e
-                outfile.write(json.dumps(line, ensure_ascii=False) + "\n")
+                outfile.write(CacheEventData(line) + "\n")
             #     print len(bson.dumps(line))
         #outfile.write(json.dumps(line, ensure_ascii=False) + "\n")
     outfile.close()
 #计算事件内，新闻的相似度方差，并根据与聚类中心的聚类，对新闻进行排序
 def variance(inputevent):
     similarity_dict = {}
-    event_narry = array(inputevent[u"eventVector"])
+    event_narry = codec.decode(inputevent[u"eventVector"])
     ################相似度列表初始化list
     sim_list = []
     ####################
     for article in inputevent[u"articles"]:
-        news_vec=[0.0 for ii in xrange(2500)]
-        for item in article[u"newsVector"]:
-            news_vec[int(item.keys()[0])]=item.values()[0]
-        dp = dot(event_narry, array(news_vec))
-        np = norm(event_narry) * norm(array(news_vec)) + 0.0001
+        news_vec=codec.decode(article[u"newsVector"],dim=len(event_narry))
+        dp = dot(event_narry, news_vec)
+        np = norm(event_narry) * norm(news_vec) + 0.0001
         # dp = dot(event_narry, array(article[u"newsVector"]))
         # np = norm(event_narry) * norm(array(article[u"newsVector"])) + 0.0001
         sim = dp / np
@@ -544,7 +552,7 @@ def sort(inputevent):  #输入需要排序的事件类
     Jaccard_dict={}
     keywords_list=inputevent[u"keywords"][:50]
     similarity_dict = {}
-    event_narry = array(inputevent[u"eventVector"])
+    event_narry = codec.decode(inputevent[u"eventVector"])
     ####################
     for article in inputevent[u"articles"]:
         Jaccard_dict[article[u"id"]] = 0.0
@@ -554,11 +562,9 @@ def sort(inputevent):  #输入需要排序的事件类
                     Jaccard_dict[article[u"id"]] += 1.0
             except Exception ,e:
                 pass
-        news_vec=[0.0 for ii in xrange(2500)]
-        for item in article[u"newsVector"]:
-            news_vec[int(item.keys()[0])]=item.values()[0]
-        dp = dot(event_narry, array(news_vec))
-        np = norm(event_narry) * norm(array(news_vec)) + 0.0001
+        news_vec=codec.decode(article[u"newsVector"],dim=len(event_narry))
+        dp = dot(event_narry, news_vec)
+        np = norm(event_narry) * norm(news_vec) + 0.0001
         # dp = dot(event_narry, array(article[u"newsVector"]))
         # np = norm(event_narry) * norm(array(article[u"newsVector"])) + 0.0001
         sim = dp / np
@@ -903,14 +909,14 @@ if __name__ == "__main__":
         if eventi[u"count"]<3:
             continue
         similarity_dict = {}
-        event_narryi = array(eventi[u"eventVector"])
+        event_narryi = codec.decode(eventi[u"eventVector"])
         for eventj in MergeEventFiles:
             if eventj[u"closed"] != False:
                 continue
             if eventj[u"count"] <3:
                 continue
             if eventi[u"id"]!=eventj[u"id"]:
-                event_narryj=array(eventj[u"eventVector"])
+                event_narryj=codec.decode(eventj[u"eventVector"])
                 dp = dot(event_narryi, event_narryj)
                 np = norm(event_narryi) * norm(event_narryj) + 0.0001
                 sim = dp / np
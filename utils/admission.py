@@ -0,0 +1,258 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import datetime
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class AdmissionController():
+    """
+    時間段的admission control: 停機後的積壓不再一次讀入同一個Model.run
+    以crawlTime索引的計數將時間段二分, 直到每個子時間段不超過max_articles
+    子時間段已經短於min_span仍然超過時 (短時間內的爆量), 依priority取前max_articles篇, 其餘略過 (load shedding)
+    """
+    PRIORITIES = ('time', 'publisher', 'replica')
+
+    def __init__(self, news_reader, max_articles, priority='time', publishers=None, min_span=60):
+        """
+        :param news_reader: NewsReader
+        :param max_articles: 每個子時間段最多的新聞數, 0為不限制
+        :param priority: 略過新聞時的優先順序, time: crawlTime較早的優先, publisher: 依publishers的順序,
+                         replica: 轉載數 (replica) 較多的優先
+        :param publishers: list of publisher, 越前面越優先, 不在list中的排在最後
+        :param min_span: 最短的子時間段 (秒), 不再二分
+        """
+        assert priority in self.PRIORITIES
+        self.__news_reader = news_reader
+        self.max_articles = max_articles
+        self.priority = priority
+        self.publishers = dict((publisher, rank) for rank, publisher in enumerate(publishers or []))
+        self.min_span = datetime.timedelta(seconds=max(1, min_span))
+
+    def count(self, start_time, end_time, include_start):
+        return self.__news_reader.count_many_by_time(start_time=start_time.strftime(TIME_FORMAT),
+                                                     end_time=end_time.strftime(TIME_FORMAT),
+                                                     include_start=include_start)
+
+    def plan(self, start_time_t, end_time_t, include_start=False):
+        """
+        :param start_time_t: 開始時間, time string
+        :param end_time_t: 結束時間, time string
+        :param include_start: 是否包含crawlTime等於開始時間的新聞 (開始時間是前一個時間段的結束時間時)
+        :return: 子時間段, list of dict (start, end, include_start, count), 依時間排序
+        """
+        start_time = datetime.datetime.strptime(start_time_t, TIME_FORMAT)
+        end_time = datetime.datetime.strptime(end_time_t, TIME_FORMAT)
+        windows = []
+        stack = [(start_time, end_time, include_start)]
+        while stack:
+            start, end, include_start = stack.pop()
+            count = self.count(start, end, include_start)
+            if not self.max_articles or count <= self.max_articles or end - start <= self.min_span:
+                # 與前一個子時間段合併後仍不超過max_articles時合併, 避免二分產生許多很小的子時間段
+                if windows and self.max_articles and windows[-1]['count'] + count <= self.max_articles:
+                    windows[-1]['end'] = end.strftime(TIME_FORMAT)
+                    windows[-1]['count'] += count
+                else:
+                    windows.append({'start': start.strftime(TIME_FORMAT),
+                                    'end': end.strftime(TIME_FORMAT),
+                                    'include_start': include_start,
+                                    'count': count})
+                continue
+            mid = start + datetime.timedelta(seconds=int((end - start).total_seconds()) // 2)
+            # 後半段先push, 先處理前半段, 結果依時間排序
+            stack.append((mid, end, True))
+            stack.append((start, mid, include_start))
+        return windows
+
+    def priority_key(self, news):
+        if self.priority == 'publisher':
+            return self.publishers.get(news.get('publisher'), len(self.publishers)), news['crawlTime'], news['_id']
+        if self.priority == 'replica':
+            return -len(news.get('replica') or []), news['crawlTime'], news['_id']
+        return news['crawlTime'], news['_id']
+
+    def admit(self, window):
+        """
+        讀取子時間段的新聞, 超過max_articles時只讀取優先的max_articles篇
+        :param window: plan的子時間段
+        :return: news_list: cursor
+        :return: shed: 略過的新聞數
+        """
+        if not self.max_articles or window['count'] <= self.max_articles:
+            news_list = self.__news_reader.query_many_by_time(start_time=window['start'], end_time=window['end'],
+                                                              include_start=window['include_start'])
+            return news_list, 0
+        # 先只讀取排序需要的欄位, 再以_id讀取保留的新聞
+        fields = {'crawlTime': 1, 'publisher': 1}
+        if self.priority == 'replica':
+            fields['replica'] = 1
+        candidates = self.__news_reader.query_many_by_time(start_time=window['start'], end_time=window['end'],
+                                                           include_start=window['include_start'], fields=fields)
+        kept = sorted(candidates, key=self.priority_key)[:self.max_articles]
+        news_list = self.__news_reader.query_many_by_item({'_id': {'$in': [news['_id'] for news in kept]}})
+        return news_list, window['count'] - len(kept)
+
+    def windows(self, start_time_t, end_time_t, include_start=False):
+        """
+        依序產生子時間段與其新聞, 以及queue depth與lag
+        :param include_start: 見plan
+        :return: generator of (window, news_list, gauges)
+        """
+        windows = self.plan(start_time_t, end_time_t, include_start)
+        backlog = sum(window['count'] for window in windows)
+        for i, window in enumerate(windows):
+            news_list, shed = self.admit(window)
+            end_time = datetime.datetime.strptime(window['end'], TIME_FORMAT)
+            gauges = {'admission_queue_depth': len(windows) - i - 1,
+                      'admission_backlog_articles': backlog,
+                      'admission_window_articles': window['count'],
+                      'admission_shed': shed,
+                      'admission_lag_seconds': int((datetime.datetime.now() - end_time).total_seconds())}
+            backlog -= window['count']
+            yield window, news_list, gauges
+
+
+class AdaptiveWindowPolicy():
+    """
+    依新聞量決定時間段長度, 取代固定的day_window
+    每個時間段的結束時間以crawlTime索引的計數二分搜尋, 使新聞數接近目標 (target_articles, 或latency_budget換算的新聞數)
+    選定的時間段append到record_file, replay時以相同的時間段重現
+    """
+    def __init__(self, news_reader, target_articles=0, latency_budget=0, min_span=600, max_span=7 * 86400,
+                 alpha=0.5, record_file=None):
+        """
+        :param news_reader: NewsReader
+        :param target_articles: 每個時間段的目標新聞數, 0為不限制
+        :param latency_budget: 每個時間段的目標執行秒數, 以觀察到的每篇新聞秒數換算為新聞數, 0為不限制
+        :param min_span: 最短的時間段 (秒)
+        :param max_span: 最長的時間段 (秒), 安靜的時段不會產生過長的時間段
+        :param alpha: 每篇新聞秒數的指數移動平均權重
+        :param record_file: 記錄時間段的jsonl, None時不記錄
+        """
+        self.__news_reader = news_reader
+        self.target_articles = target_articles
+        self.latency_budget = latency_budget
+        self.min_span = datetime.timedelta(seconds=max(60, min_span))
+        self.max_span = datetime.timedelta(seconds=max(min_span, max_span))
+        self.alpha = alpha
+        self.record_file = record_file
+        self.seconds_per_article = None
+        # 記錄的時間段以run區分, 不同開始時間的run時間段會重疊, replay時只取一個run
+        self.run_id = "%s-%d" % (datetime.datetime.now().strftime("%Y%m%d%H%M%S"), os.getpid())
+
+    def count(self, start_time, end_time, include_start):
+        return self.__news_reader.count_many_by_time(start_time=start_time.strftime(TIME_FORMAT),
+                                                     end_time=end_time.strftime(TIME_FORMAT),
+                                                     include_start=include_start)
+
+    def target(self):
+        """
+        :return: 目前的目標新聞數, 0為不限制
+        """
+        targets = [self.target_articles] if self.target_articles else []
+        if self.latency_budget and self.seconds_per_article:
+            targets.append(max(1, int(self.latency_budget / self.seconds_per_article)))
+        return min(targets) if targets else 0
+
+    def observe(self, n_news, seconds):
+        """
+        一個時間段完成後更新每篇新聞的秒數
+        :param n_news: 時間段的新聞數
+        :param seconds: 執行秒數
+        """
+        if not n_news:
+            return
+        rate = float(seconds) / n_news
+        if self.seconds_per_article is None:
+            self.seconds_per_article = rate
+        else:
+            self.seconds_per_article = self.alpha * rate + (1 - self.alpha) * self.seconds_per_article
+
+    def next_window(self, start_time, end_time, include_start):
+        """
+        :param start_time: 開始時間, datetime
+        :param end_time: 整段範圍的結束時間, datetime
+        :param include_start: 是否包含crawlTime等於開始時間的新聞
+        :return: dict (start, end, include_start, count, target)
+        """
+        target = self.target()
+        limit = min(end_time, start_time + self.max_span)
+        if not target and self.latency_budget:
+            # 尚未觀察到每篇新聞秒數, 先以最短的時間段量測
+            limit = min(end_time, start_time + self.min_span)
+        count = self.count(start_time, limit, include_start)
+        if target and count > target:
+            # 以分鐘為單位二分搜尋, 找出新聞數不超過target的最晚結束時間, 至少min_span
+            lo = min(start_time + self.min_span, limit)
+            lo_count = self.count(start_time, lo, include_start)
+            hi = limit
+            end, count = lo, lo_count
+            while lo_count <= target and hi - lo > datetime.timedelta(minutes=1):
+                mid = lo + datetime.timedelta(minutes=max(1, int((hi - lo).total_seconds() // 120)))
+                mid_count = self.count(start_time, mid, include_start)
+                if mid_count <= target:
+                    lo, lo_count = mid, mid_count
+                    end, count = mid, mid_count
+                else:
+                    hi = mid
+        else:
+            end = limit
+        window = {'start': start_time.strftime(TIME_FORMAT),
+                  'end': end.strftime(TIME_FORMAT),
+                  'include_start': include_start,
+                  'count': count,
+                  'target': target}
+        self.record(window)
+        return window
+
+    def record(self, window):
+        if not self.record_file:
+            return
+        record_dir = os.path.dirname(self.record_file)
+        if record_dir and not os.path.exists(record_dir):
+            os.makedirs(record_dir)
+        with open(self.record_file, "a") as f:
+            f.write(json.dumps(dict(window, run=self.run_id, seconds_per_article=self.seconds_per_article)) + "\n")
+
+    def windows(self, start_time_t, end_time_t, include_start=False):
+        """
+        依序產生時間段, 呼叫者在每個時間段完成後以observe回報執行時間
+        :param include_start: 第一個時間段是否包含crawlTime等於開始時間的新聞
+        :return: generator of window dict
+        """
+        start_time = datetime.datetime.strptime(start_time_t, TIME_FORMAT)
+        end_time = datetime.datetime.strptime(end_time_t, TIME_FORMAT)
+        while start_time < end_time:
+            window = self.next_window(start_time, end_time, include_start)
+            yield window
+            start_time = datetime.datetime.strptime(window['end'], TIME_FORMAT)
+            include_start = True
+
+
+def recorded_windows(record_file, start_time_t, end_time_t, run=None):
+    """
+    讀取AdaptiveWindowPolicy記錄的時間段, 用於以相同的時間段replay
+    :param run: 記錄的run id, None時為範圍內最後一個記錄的run
+    :return: list of window dict, 在 [start_time_t, end_time_t] 範圍內, 依時間排序, 相同開始時間以最後的紀錄為準,
+             與前一個時間段重疊的時間段略過, 同一篇新聞不會被處理兩次
+    """
+    runs = {}
+    last_run = None
+    with open(record_file, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            window = json.loads(line)
+            if start_time_t <= window['start'] and window['end'] <= end_time_t:
+                # 沒有run的舊紀錄視為同一個run
+                last_run = window.get('run')
+                runs.setdefault(last_run, {})[window['start']] = window
+    windows = runs.get(last_run if run is None else run, {})
+    result = []
+    for start in sorted(windows):
+        if result and start < result[-1]['end']:
+            continue
+        result.append(windows[start])
+    return result
@@ -0,0 +1,197 @@
+# -*- coding:utf-8 -*-
+import time
+import json
+
+
+def create_cache(url):
+    """
+    :param url: redis://host:port/db, 或 memory (同一個process內的替代品, 用於測試與benchmark)
+    :return: cache client, 介面為redis client的子集 (pipeline, set, get, delete, ttl)
+    """
+    if url == 'memory':
+        return MemoryCache()
+    # 只有使用redis時才需要安裝redis套件
+    import redis
+    return redis.StrictRedis.from_url(url)
+
+
+class MemoryPipeline():
+    """
+    MemoryCache的pipeline: 指令先放在本地, execute時一次執行
+    """
+    def __init__(self, cache):
+        self.__cache = cache
+        self.__commands = []
+
+    def set(self, key, value, ex=None):
+        self.__commands.append(('set', (key, value, ex)))
+        return self
+
+    def delete(self, *keys):
+        self.__commands.append(('delete', keys))
+        return self
+
+    def execute(self):
+        self.__cache.round_trips += 1
+        results = [getattr(self.__cache, '_' + name)(*params) for name, params in self.__commands]
+        self.__commands = []
+        return results
+
+
+class MemoryCache():
+    """
+    redis的in-process替代品, 只實作EventCache用到的指令, 包含TTL
+    round_trips 記錄來回次數, 用於確認寫入有批次進行
+    """
+    def __init__(self):
+        self.__data = {}
+        self.round_trips = 0
+
+    def _set(self, key, value, ex=None):
+        self.__data[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    def _delete(self, *keys):
+        return sum(1 for key in keys if self.__data.pop(key, None) is not None)
+
+    def __live(self, key):
+        item = self.__data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self.__data[key]
+            return None
+        return item
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def set(self, key, value, ex=None):
+        self.round_trips += 1
+        return self._set(key, value, ex)
+
+    def delete(self, *keys):
+        self.round_trips += 1
+        return self._delete(*keys)
+
+    def get(self, key):
+        self.round_trips += 1
+        item = self.__live(key)
+        return item[0] if item else None
+
+    def ttl(self, key):
+        """
+        :return: 剩餘秒數, 沒有TTL為 -1, 不存在為 -2 (與redis相同)
+        """
+        item = self.__live(key)
+        if item is None:
+            return -2
+        if item[1] is None:
+            return -1
+        return int(round(item[1] - time.time()))
+
+    def keys(self, pattern="*"):
+        prefix = pattern.rstrip("*")
+        return [key for key in self.__data if key.startswith(prefix) and self.__live(key)]
+
+
+class EventCache():
+    """
+    最近更新的event的cache tier, 給前端讀取, 不需要查詢mongoDB
+    - 寫入先放在本地, flush時以pipeline每batch_size個指令一次來回
+    - TTL為event_day_window: 超過後event不再更新, 也不會被讀取
+    - 不保存向量與增量更新的中間結果, 以緊湊的JSON存放
+    - 分裂或關閉的event從cache中刪除
+    """
+    # 前端不需要的欄位
+    DROP_FIELDS = ('eventVector', 'aggregates', 'clusterStats')
+
+    def __init__(self, client, ttl, batch_size=500, prefix="event:"):
+        """
+        :param client: create_cache的結果
+        :param ttl: 秒
+        :param batch_size: 每次pipeline的指令數
+        :param prefix: key的前綴
+        """
+        self.__client = client
+        self.ttl = int(ttl)
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.__pending = {}
+        self.sets = 0
+        self.deletes = 0
+        self.bytes = 0
+        self.round_trips = 0
+        self.errors = 0
+
+    def key(self, event_id):
+        return self.prefix + event_id
+
+    def encode(self, event):
+        """
+        :param event: event dict
+        :return: utf-8 JSON, 不包含 DROP_FIELDS 與 newsVector
+        """
+        doc = dict((k, v) for k, v in event.iteritems() if k not in self.DROP_FIELDS)
+        if isinstance(doc.get('keynews'), dict):
+            doc['keynews'] = dict((k, v) for k, v in doc['keynews'].iteritems() if k != 'newsVector')
+        doc['articles'] = [dict((k, v) for k, v in article.iteritems() if k != 'newsVector')
+                           for article in doc.get('articles') or []]
+        value = json.dumps(doc, ensure_ascii=False, separators=(',', ':'))
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return value
+
+    def put(self, event):
+        """
+        在呼叫時就序列化, 之後event被修改也不影響; 同一個event在flush前只保留最後一次
+        """
+        self.__pending[event['_id']] = self.encode(event)
+
+    def invalidate(self, event_ids):
+        for event_id in event_ids:
+            self.__pending[event_id] = None
+
+    def flush(self):
+        """
+        :return: 寫入與刪除的指令數
+        """
+        pending = self.__pending.items()
+        self.__pending = {}
+        for i in range(0, len(pending), self.batch_size):
+            pipe = self.__client.pipeline(transaction=False)
+            for event_id, value in pending[i:i + self.batch_size]:
+                if value is None:
+                    pipe.delete(self.key(event_id))
+                else:
+                    pipe.set(self.key(event_id), value, ex=self.ttl)
+            try:
+                pipe.execute()
+            except Exception, e:
+                # cache只是加速前端讀取, 失敗時不影響mongoDB的寫入, 過期後由TTL清除
+                print "event cache:", e
+                self.errors += 1
+                continue
+            finally:
+                self.round_trips += 1
+            for event_id, value in pending[i:i + self.batch_size]:
+                if value is None:
+                    self.deletes += 1
+                else:
+                    self.sets += 1
+                    self.bytes += len(value)
+        return len(pending)
+
+    def get(self, event_id):
+        value = self.__client.get(self.key(event_id))
+        return json.loads(value) if value is not None else None
+
+    def report(self):
+        """
+        :return: 上次report之後的計數, 回傳後歸零
+        """
+        report = {'cache_sets': self.sets,
+                  'cache_deletes': self.deletes,
+                  'cache_bytes': self.bytes,
+                  'cache_round_trips': self.round_trips,
+                  'cache_errors': self.errors}
+        self.sets = self.deletes = self.bytes = self.round_trips = self.errors = 0
+        return report
@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import gzip
+from bson import json_util
+
+
+class CaptureBundle():
+    """
+    一個時間段的Model.run輸入, 用於離線重現 (見 benchmark/replay.py)
+    檔案為gzip的JSON lines (bson json_util, 保留Binary向量):
+        第一行 manifest: 版本, 時間段, 參數, 各類document數
+        之後每行 {"type": "news" | "event" | "member", "doc": {...}}
+        news:   時間段內的新聞 (query_many_by_time的結果, 保留順序)
+        event:  時間段開始時尚未關閉的event (query_recent_events_by_time的結果)
+        member: event中的新聞
+    """
+    VERSION = 1
+
+    def save(self, path, manifest, news, events, members):
+        """
+        :param path: 輸出檔案
+        :param manifest: dict
+        :param news: iterable of news dict
+        :param events: list of event dict
+        :param members: iterable of news dict
+        :return: manifest
+        """
+        out_dir = os.path.dirname(path)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        manifest = dict(manifest)
+        manifest['version'] = self.VERSION
+        counts = {'news': 0, 'event': 0, 'member': 0}
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(json.dumps(manifest) + "\n")
+            for kind, docs in (('news', news), ('event', events), ('member', members)):
+                for doc in docs:
+                    f.write(json_util.dumps({'type': kind, 'doc': doc}) + "\n")
+                    counts[kind] += 1
+        os.rename(tmp_path, path)
+        manifest.update(('n_' + kind, count) for kind, count in counts.iteritems())
+        with open(path + ".manifest.json", "w") as f:
+            f.write(json.dumps(manifest))
+        return manifest
+
+    def load(self, path):
+        """
+        :param path: capture檔案
+        :return: manifest: dict
+        :return: docs: dict { 'news': [...], 'event': [...], 'member': [...] }
+        """
+        docs = {'news': [], 'event': [], 'member': []}
+        with gzip.open(path, "rb") as f:
+            manifest = json.loads(f.readline())
+            if manifest.get('version') != self.VERSION:
+                raise ValueError("unsupported capture version: %s" % manifest.get('version'))
+            for line in f:
+                item = json_util.loads(line)
+                docs[item['type']].append(item['doc'])
+        return manifest, docs
@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+import struct
+import numpy as np
+from bson.binary import Binary
+
+# header: version, kind, reserved, dim
+_HEADER = struct.Struct("<BBHI")
+_SUBTYPE = 0x80
+
+
+class VectorCodec():
+    """
+    新聞向量與事件向量的二進位編碼, 存為BSON Binary
+    dense32 / dense16: 完整向量, float32 / float16
+    sparse: 非零位置 (uint32) 與數值 (float32)
+    解碼時以 np.frombuffer 直接讀取, dense32不需要複製
+    同時相容舊格式: float list 以及 [{"21": 2}, ...] 形式的稀疏list
+    """
+    VERSION = 1
+    DENSE32 = 1
+    DENSE16 = 2
+    SPARSE = 3
+    KINDS = {'dense32': DENSE32, 'dense16': DENSE16, 'sparse': SPARSE}
+
+    def encode(self, vec, kind=None):
+        """
+        :param vec: numpy array
+        :param kind: 'dense32', 'dense16', 'sparse', None則依非零比例自動選擇dense32或sparse
+        :return: bson Binary
+        """
+        vec = np.asarray(vec)
+        dim = vec.shape[0]
+        if kind is None:
+            nnz = np.count_nonzero(vec)
+            kind = 'sparse' if nnz * 8 < dim * 4 else 'dense32'
+        code = self.KINDS[kind]
+        header = _HEADER.pack(self.VERSION, code, 0, dim)
+        if code == self.DENSE32:
+            payload = vec.astype('<f4').tostring()
+        elif code == self.DENSE16:
+            payload = vec.astype('<f2').tostring()
+        else:
+            idx = np.flatnonzero(vec)
+            payload = idx.astype('<u4').tostring() + vec[idx].astype('<f4').tostring()
+        return Binary(header + payload, subtype=_SUBTYPE)
+
+    def decode(self, data, dim=None):
+        """
+        :param data: bson Binary, 或舊格式的list
+        :param dim: 舊的稀疏list沒有記錄維度, 需要給定
+        :return: numpy array (dense32為唯讀view), 沒有資料時回傳 None
+        """
+        if data is None or len(data) == 0:
+            return None
+        if isinstance(data, list):
+            return self.decode_legacy(data, dim)
+        version, code, _, vdim = _HEADER.unpack_from(data)
+        if version != self.VERSION:
+            raise ValueError("unsupported vector codec version: %d" % version)
+        if code == self.DENSE32:
+            return np.frombuffer(data, dtype='<f4', count=vdim, offset=_HEADER.size)
+        if code == self.DENSE16:
+            return np.frombuffer(data, dtype='<f2', count=vdim, offset=_HEADER.size).astype(np.float32)
+        if code == self.SPARSE:
+            nnz = (len(data) - _HEADER.size) // 8
+            idx = np.frombuffer(data, dtype='<u4', count=nnz, offset=_HEADER.size)
+            val = np.frombuffer(data, dtype='<f4', count=nnz, offset=_HEADER.size + 4 * nnz)
+            vec = np.zeros(vdim, dtype=np.float32)
+            vec[idx] = val
+            return vec
+        raise ValueError("unknown vector kind: %d" % code)
+
+    def decode_legacy(self, data, dim):
+        """
+        舊格式: float list 或 [{"21": 2}, {"29": 1}] 的稀疏list
+        """
+        if not isinstance(data[0], dict):
+            return np.asarray(data, dtype=np.float32)
+        vec = np.zeros(dim, dtype=np.float32)
+        for item in data:
+            for key, value in item.iteritems():
+                vec[int(key)] = value
+        return vec
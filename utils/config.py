@@ -1,3 +1,4 @@
+# -*- coding:utf-8 -*-
 import os
 import json
 from function import Function
@@ -28,6 +29,22 @@ class Config:
     cos_thres = 0.2
     cos_std_thres = 0.055
     event_day_window = 14
+    # eventVector的存儲格式: dense32, dense16, sparse (見 utils/codec.py)
+    event_vector_codec = 'dense32'
+    # event摘要 (keynews, 實體列表) 以新加入的新聞增量更新, 每N次更新重新計算全部新聞, 0為每次都重新計算
+    summary_full_every = 20
+    # event成員的存放方式: inline (全部存在event的articles), collection (另外存放在 <event collection>_article,
+    # event只保留score最高的event_inline_articles篇), 適用於成員很多的event
+    event_article_layout = 'inline'
+    event_inline_articles = 50
+    # relatedEvents: 每個event前k個相似度超過thres的event, centroid移動超過tolerance (1 - cosine) 才重新計算
+    related_events_k = 15
+    related_events_thres = 0.6
+    related_events_tolerance = 0.001
+    # --dedup: SimHash簽章hamming distance不超過dedup_distance的新聞視為轉載 (見 utils/dedup.py)
+    dedup_distance = 3
+    # cluster的充分統計量 (見 utils/stats.py) 以新成員增量更新, centroid移動超過tolerance (1 - cosine) 時以成員向量重新精確計算
+    cluster_stats_tolerance = 0.001
     def __init__(self, args):
         func = Function()
         log_dir = os.path.join('log')
@@ -69,6 +86,17 @@ class Config:
         self.sim_thres = args.sim
         self.subevent_sim_thres = args.sub_sim
         self.merge_sim_thres = args.merge_sim
+        self.pipeline = args.pipeline
+        self.queue_size = args.queue_size
+        self.fetch_batch = args.fetch_batch
+        self.news_cache_mb = args.news_cache_mb
+        self.snapshot = args.snapshot
+        self.progress = args.progress
+        self.profile = args.profile
+        self.profile_memory = args.profile_memory
+        self.cache = args.cache
+        self.export = args.export
+        self.dedup = args.dedup
 
         self.output_path = os.path.join("Output",
                                         's{}ms{}sub{}dim{}'.format(self.sim_thres, self.merge_sim_thres, self.subevent_sim_thres, self.dim))
\ No newline at end of file
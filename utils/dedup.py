@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+import hashlib
+from collections import Counter
+
+import numpy as np
+
+
+class SimHashDeduplicator():
+    """
+    聚類前的近似重複 (轉載) 合併: 以stemmed內容的SimHash簽章與分段 (banded) LSH索引尋找近似重複的新聞
+    - 簽章: 每個詞的64-bit hash展開為 +1/-1, 依詞頻加總後取正負號; 詞的展開結果cache在記憶體
+    - 索引: 簽章切成bands段, 任一段相同的新聞為候選, 候選中hamming distance不超過max_distance的視為重複
+      max_distance < bands 時, 依鴿籠原理, 距離不超過max_distance的新聞一定有一段相同, 不會漏掉
+    - 第一篇為代表 (representative), 之後的重複新聞只記錄為代表的copies
+    """
+    def __init__(self, bits=64, bands=4, max_distance=3, max_tokens=200000):
+        """
+        :param bits: 簽章的bit數
+        :param bands: LSH的段數
+        :param max_distance: 視為重複的最大hamming distance
+        :param max_tokens: 詞的hash cache上限, reset時超過則清空
+        """
+        self.max_tokens = max_tokens
+        assert bits % bands == 0 and bits % 8 == 0 and bits <= 64
+        self.bits = bits
+        self.bands = bands
+        self.max_distance = max_distance
+        self.__band_bits = bits // bands
+        self.__band_mask = (1 << self.__band_bits) - 1
+        self.__weights = 1 << np.arange(bits, dtype=np.uint64)
+        self.__clear_tokens()
+        self.reset()
+
+    def __clear_tokens(self):
+        self.__token_rows = {}
+        # 詞的 +1/-1 展開, 前 len(self.__token_rows) 列有效, 容量不足時加倍
+        self.__rows = np.zeros((1024, self.bits), dtype=np.int8)
+
+    def reset(self):
+        """
+        清除索引 (每個時間段重新開始), 詞的hash cache保留, 超過max_tokens時清空
+        """
+        if len(self.__token_rows) > self.max_tokens:
+            self.__clear_tokens()
+        self.__index = [{} for _ in range(self.bands)]
+        self.__signatures = {}
+        self.copies = {}
+        self.n_representatives = 0
+        self.n_copies = 0
+
+    def __token_index(self, tokens):
+        new = [token for token in tokens if token not in self.__token_rows]
+        if new:
+            n = len(self.__token_rows)
+            if n + len(new) > len(self.__rows):
+                rows = np.zeros((max(2 * len(self.__rows), n + len(new)), self.bits), dtype=np.int8)
+                rows[:n] = self.__rows[:n]
+                self.__rows = rows
+            digests = "".join(hashlib.md5(token.encode('utf-8') if isinstance(token, unicode) else token).digest()[:self.bits // 8]
+                              for token in new)
+            bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(len(new), self.bits).astype(np.int8)
+            self.__rows[n:n + len(new)] = bits * 2 - 1
+            for i, token in enumerate(new):
+                self.__token_rows[token] = n + i
+        return [self.__token_rows[token] for token in tokens]
+
+    def signature(self, text):
+        """
+        :param text: stemmed內容, 以空白分隔
+        :return: int, SimHash簽章
+        """
+        counts = Counter(text.split())
+        if not counts:
+            return 0
+        tokens = counts.keys()
+        weights = np.array([counts[token] for token in tokens], dtype=np.int64)
+        rows = self.__token_index(tokens)
+        total = weights.dot(self.__rows[rows])
+        return int((self.__weights[total > 0]).sum())
+
+    def bands_of(self, signature):
+        return [(signature >> (i * self.__band_bits)) & self.__band_mask for i in range(self.bands)]
+
+    def distance(self, a, b):
+        return bin(a ^ b).count('1')
+
+    def add(self, news_id, text):
+        """
+        :param news_id: 新聞id
+        :param text: stemmed內容
+        :return: 重複時為代表的新聞id, 否則為 None (本篇成為代表)
+        """
+        signature = self.signature(text)
+        keys = self.bands_of(signature)
+        checked = set()
+        for band, key in zip(self.__index, keys):
+            for rep_id in band.get(key, ()):
+                if rep_id in checked:
+                    continue
+                checked.add(rep_id)
+                if self.distance(signature, self.__signatures[rep_id]) <= self.max_distance:
+                    self.copies[rep_id].append(news_id)
+                    self.n_copies += 1
+                    return rep_id
+        self.__signatures[news_id] = signature
+        self.copies[news_id] = []
+        for band, key in zip(self.__index, keys):
+            band.setdefault(key, []).append(news_id)
+        self.n_representatives += 1
+        return None
+
+    def report(self):
+        total = self.n_representatives + self.n_copies
+        return {'dedup_representatives': self.n_representatives,
+                'dedup_copies': self.n_copies,
+                'dedup_work_removed': round(float(self.n_copies) / total, 4) if total else 0.}
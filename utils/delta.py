@@ -0,0 +1,86 @@
+# -*- coding:utf-8 -*-
+import bson
+
+
+class DeltaWriter():
+    """
+    event的差異寫入: 與讀取時的document比較, 只以 $set 寫入改變的欄位, 新增在articles尾端的新聞以 $push 寫入
+    讀取時沒有的event才寫入完整的document
+    另外存放的成員 (event_article_layout = 'collection') 以 save_articles 批次寫入, 只寫入新增的成員
+    """
+    def __init__(self, event_reader):
+        """
+        :param event_reader: EventReader, 需要提供 save_item, update_item 與 save_articles
+        """
+        self.__event_reader = event_reader
+        self.bytes_written = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.members = 0
+
+    def diff(self, before, after):
+        """
+        :param before: 讀取時的event (shallow copy, 巢狀的值不能在之後被修改)
+        :param after: 要寫入的event
+        :return: update document, 沒有改變時為 None
+        """
+        sets = {}
+        for key, value in after.iteritems():
+            if key == '_id' or key == 'articles':
+                continue
+            if key not in before or before[key] != value:
+                sets[key] = value
+        unsets = dict((key, "") for key in before if key not in after)
+
+        update = {}
+        old_articles = before.get('articles') or []
+        new_articles = after.get('articles') or []
+        n_old = len(old_articles)
+        if new_articles == old_articles:
+            pass
+        elif len(new_articles) > n_old and new_articles[:n_old] == old_articles:
+            update['$push'] = {'articles': {'$each': new_articles[n_old:]}}
+        else:
+            sets['articles'] = new_articles
+        if sets:
+            update['$set'] = sets
+        if unsets:
+            update['$unset'] = unsets
+        return update or None
+
+    def save(self, before, after, articles=None, start=0):
+        """
+        :param before: 讀取時的event, 新的event為 None
+        :param after: 要寫入的event
+        :param articles: 另外存放的成員, None時不寫入
+        :param start: 第一個成員的位置, 0時取代全部成員
+        :return: 寫入的bytes (BSON)
+        """
+        size = 0
+        if articles is not None:
+            self.__event_reader.save_articles(after['_id'], articles, start=start)
+            self.members += len(articles)
+            size += sum(len(bson.BSON.encode(article)) for article in articles)
+        if before is None:
+            self.__event_reader.save_item(after)
+            self.inserted += 1
+            size += len(bson.BSON.encode(after))
+        else:
+            update = self.diff(before, after)
+            if update is None:
+                self.unchanged += 1
+                self.bytes_written += size
+                return size
+            self.__event_reader.update_item(after['_id'], update, item=after)
+            self.updated += 1
+            size += len(bson.BSON.encode(update))
+        self.bytes_written += size
+        return size
+
+    def report(self):
+        return {'event_bytes_written': self.bytes_written,
+                'events_inserted': self.inserted,
+                'events_delta': self.updated,
+                'events_unchanged': self.unchanged,
+                'event_members_written': self.members}
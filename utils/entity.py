@@ -0,0 +1,186 @@
+# -*- coding:utf-8 -*-
+import math
+import heapq
+
+# {word, score} 形式的要素, 依新聞權重累加score
+SCORE_FIELDS = ('keywords', 'when', 'where', 'who')
+# {mention, count, linkedURL} 形式的實體, 累加count, linkedURL取第一次出現的
+NER_FIELDS = ('persons', 'locations', 'organizations')
+
+
+class EntityAggregator():
+    """
+    event的關鍵要素與實體列表: 成員新聞依離中心的距離加上衰退的權重後累加, 各取前k_important個
+    - 衰退權重預先計算, 不在每篇新聞重新相乘
+    - 實體字串在同一個aggregator內共用同一個物件 (intern), 以dict.get累加, 不使用巢狀函式
+    - 以heap取前k個, 不排序全部實體; 分數仍以全部實體的L2 norm normalize, 與原本的輸出相同
+    """
+    def __init__(self, decay=0.99, k_important=20, max_strings=100000):
+        """
+        :param decay: 每篇新聞的權重衰退率, 第i篇 (由中心開始) 的權重為 decay ** i
+        :param k_important: 每種要素保留的數量
+        :param max_strings: intern表的上限, 超過時清空 (只影響字串是否共用, 不影響結果)
+        """
+        self.decay = decay
+        self.k_important = k_important
+        self.max_strings = max_strings
+        self.__weights = [1.0]
+        self.__strings = {}
+
+    def weights(self, n):
+        """
+        :return: 前n篇新聞的權重, 與逐篇 weight *= decay 的結果相同
+        """
+        while len(self.__weights) < n:
+            self.__weights.append(self.__weights[-1] * self.decay)
+        return self.__weights[:n]
+
+    def n_strings(self):
+        """
+        :return: intern表目前的字串數
+        """
+        return len(self.__strings)
+
+    def intern(self, s):
+        if len(self.__strings) >= self.max_strings and s not in self.__strings:
+            self.__strings.clear()
+        return self.__strings.setdefault(s, s)
+
+    def top_k(self, counter):
+        """
+        :param counter: {word: score}
+        :return: list of (word, score, normalized score), 依score由大到小, 最多k_important個
+        """
+        if not counter:
+            return []
+        norm = math.sqrt(sum(score * score for score in counter.itervalues()))
+        top = heapq.nlargest(self.k_important, counter.iteritems(), key=lambda item: item[1])
+        if norm == 0.:
+            return [(word, score, 0.) for word, score in top]
+        return [(word, score, score / norm) for word, score in top]
+
+    def new_state(self):
+        """
+        :return: 彙整的中間狀態: 各要素的score總和, 實體的count總和與linkedURL, 以及已經累加的新聞數
+        """
+        return {'n': 0,
+                'scores': dict((field, {}) for field in SCORE_FIELDS),
+                'counts': dict((field, {}) for field in NER_FIELDS),
+                'urls': dict((field, {}) for field in NER_FIELDS)}
+
+    def accumulate(self, state, news_list):
+        """
+        將新加入的成員新聞累加到state, 第i篇新聞的權重接續state中已經累加的新聞數
+        :param state: new_state或decode的結果, 直接修改
+        :param news_list: 新成員新聞的heavy欄位, list of dict, 依成員順序
+        :return: state
+        """
+        intern = self.intern
+        weights = self.weights(state['n'] + len(news_list))[state['n']:]
+        for news, weight in zip(news_list, weights):
+            for field in SCORE_FIELDS:
+                counter = state['scores'][field]
+                get = counter.get
+                for keyword in news[field]:
+                    word = keyword['word']
+                    score = get(word)
+                    # 第一次出現時才intern
+                    if score is None:
+                        counter[intern(word)] = keyword['score'] * weight
+                    else:
+                        counter[word] = score + keyword['score'] * weight
+            # 實體暫時以count作為score, 不乘上權重
+            for field in NER_FIELDS:
+                counter = state['counts'][field]
+                get = counter.get
+                url = state['urls'][field]
+                for entity in news[field]:
+                    mention = entity['mention']
+                    count = get(mention)
+                    if count is None:
+                        mention = intern(mention)
+                        counter[mention] = entity['count']
+                        url[mention] = entity['linkedURL']
+                    else:
+                        counter[mention] = count + entity['count']
+        state['n'] += len(news_list)
+        return state
+
+    def rank(self, state):
+        """
+        :param state: accumulate的結果
+        :return: dict { field: list }, 格式同event的 keywords, when, where, who, persons, locations, organizations
+        """
+        result = {}
+        for field in SCORE_FIELDS:
+            result[field] = [{'word': word, 'score': '{:.2f}'.format(norm_score)}
+                             for word, _, norm_score in self.top_k(state['scores'][field])]
+        for field in NER_FIELDS:
+            urls = state['urls'][field]
+            result[field] = [{'mention': mention, 'count': '{:.2f}'.format(count), 'score': '{:.2f}'.format(norm_score),
+                              'linkedURL': urls[mention]}
+                             for mention, count, norm_score in self.top_k(state['counts'][field])]
+        return result
+
+    def aggregate(self, news_list):
+        """
+        :param news_list: 成員新聞的heavy欄位, list of dict, 依離中心由近到遠
+        :return: dict { field: list }, 格式同event的 keywords, when, where, who, persons, locations, organizations
+        """
+        return self.rank(self.accumulate(self.new_state(), news_list))
+
+    def encode(self, state):
+        """
+        存入mongoDB的格式, 實體可能包含 '.' 或 '$', 因此以 [word, value] list 存放而不是dict的key
+        """
+        return {'n': state['n'],
+                'scores': dict((field, [[word, score] for word, score in state['scores'][field].iteritems()])
+                               for field in SCORE_FIELDS),
+                'counts': dict((field, [[mention, count, state['urls'][field][mention]]
+                                        for mention, count in state['counts'][field].iteritems()])
+                               for field in NER_FIELDS)}
+
+    def decode(self, doc):
+        """
+        :param doc: encode的結果
+        :return: state
+        """
+        intern = self.intern
+        state = self.new_state()
+        state['n'] = doc['n']
+        for field in SCORE_FIELDS:
+            state['scores'][field] = dict((intern(word), score) for word, score in doc['scores'][field])
+        for field in NER_FIELDS:
+            for mention, count, url in doc['counts'][field]:
+                mention = intern(mention)
+                state['counts'][field][mention] = count
+                state['urls'][field][mention] = url
+        return state
+
+    def aggregate_many(self, events, load, batch_size=2000):
+        """
+        批次模式: 多個event一起讀取heavy欄位後彙整, 讀取次數依新聞數而不是event數
+        :param events: iterable of (event_id, 成員新聞id list, 依離中心由近到遠)
+        :param load: function(news_ids) -> { news_id: heavy dict }, 例如 NewsStore.load_heavy
+        :param batch_size: 每批最多的新聞數
+        :return: generator of (event_id, aggregate的結果)
+        """
+        batch = []
+        n_news = 0
+        for event_id, news_ids in events:
+            batch.append((event_id, news_ids))
+            n_news += len(news_ids)
+            if n_news >= batch_size:
+                for item in self.__aggregate_batch(batch, load):
+                    yield item
+                batch = []
+                n_news = 0
+        for item in self.__aggregate_batch(batch, load):
+            yield item
+
+    def __aggregate_batch(self, batch, load):
+        if not batch:
+            return
+        heavy = load([news_id for _, news_ids in batch for news_id in news_ids])
+        for event_id, news_ids in batch:
+            yield event_id, self.aggregate([heavy[news_id] for news_id in news_ids if news_id in heavy])
@@ -0,0 +1,138 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import json
+import threading
+
+import numpy as np
+
+
+class ResultExporter():
+    """
+    聚類結果的機器可讀輸出, 取代逐行串接title與content的文字檔
+    每個時間段輸出兩個檔案:
+    - <name>.jsonl: 每個cluster一行, 包含成員新聞id與相似度統計
+    - <name>.npz: 欄位式的陣列 (event_ids, sizes, centroids, 成員的cluster index與相似度, cos, cos_std), 供離線分析
+    統計與寫檔在背景thread進行, 同時最多只有一個時間段在輸出, 下一次submit前等待前一次完成
+    呼叫者在時間段結束時呼叫wait (Model.output), 背景的例外在該時間段拋出
+    """
+    def __init__(self, output_path, dim, background=True, buffer_size=1 << 20):
+        """
+        :param output_path: 輸出目錄
+        :param dim: 向量維度, 沒有cluster時centroids為 (0, dim)
+        :param background: 是否在背景thread輸出
+        :param buffer_size: jsonl的寫入緩衝 (bytes)
+        """
+        self.output_path = output_path
+        self.dim = dim
+        self.background = background
+        self.buffer_size = buffer_size
+        self.__thread = None
+        self.__exc_info = None
+        self.exported = 0
+
+    def snapshot(self, clusters_id, clusters_vec, centroids, cos=None, cos_std=None):
+        """
+        在主thread中複製目前的聚類結果, 之後的時間段修改dict不影響輸出
+        向量陣列在聚類時以新的陣列取代而不是原地修改, 因此只複製list與參考
+        :return: dict, 給 submit
+        """
+        event_ids = list(clusters_id)
+        return {'event_ids': event_ids,
+                'news': [list(clusters_id[event_id]) for event_id in event_ids],
+                'vecs': [clusters_vec[event_id] for event_id in event_ids],
+                'centroids': [centroids[event_id] for event_id in event_ids],
+                'cos': list(cos or []),
+                'cos_std': list(cos_std or [])}
+
+    def submit(self, name, snapshot):
+        """
+        :param name: 檔名 (不含副檔名), 例如時間段的開始時間
+        :param snapshot: snapshot的結果
+        """
+        self.wait()
+        if not self.background:
+            self.write(name, snapshot)
+            return
+        self.__thread = threading.Thread(target=self.__run, args=(name, snapshot))
+        self.__thread.start()
+
+    def __run(self, name, snapshot):
+        try:
+            self.write(name, snapshot)
+        except Exception:
+            self.__exc_info = sys.exc_info()
+
+    def wait(self):
+        """
+        等待背景的輸出完成, 背景發生的例外在這裡拋出
+        """
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__exc_info:
+            exc_info, self.__exc_info = self.__exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def similarities(self, vecs, centroid):
+        """
+        :return: 成員向量與centroid的cosine similarity, np.array
+        """
+        vecs = np.asarray(vecs, dtype=np.float32).reshape(-1, self.dim)
+        centroid = np.asarray(centroid, dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1) * np.linalg.norm(centroid)
+        dots = vecs.dot(centroid)
+        return np.where(norms > 0, dots / np.where(norms > 0, norms, 1.), 0.)
+
+    def write(self, name, snapshot):
+        """
+        :return: (jsonl path, npz path)
+        """
+        if not os.path.exists(self.output_path):
+            os.makedirs(self.output_path)
+        jsonl_path = os.path.join(self.output_path, name + ".jsonl")
+        npz_path = os.path.join(self.output_path, name + ".npz")
+
+        n = len(snapshot['event_ids'])
+        sizes = np.zeros(n, dtype=np.int32)
+        sim_mean = np.zeros(n, dtype=np.float32)
+        sim_min = np.zeros(n, dtype=np.float32)
+        sim_std = np.zeros(n, dtype=np.float32)
+        news_ids = []
+        news_event = []
+        news_sim = []
+        with open(jsonl_path, "w", self.buffer_size) as f:
+            for i, event_id in enumerate(snapshot['event_ids']):
+                members = snapshot['news'][i]
+                sims = self.similarities(snapshot['vecs'][i], snapshot['centroids'][i]) if members else np.zeros(0)
+                sizes[i] = len(members)
+                if len(sims):
+                    sim_mean[i], sim_min[i], sim_std[i] = sims.mean(), sims.min(), sims.std()
+                news_ids.extend(members)
+                news_event.extend([i] * len(members))
+                news_sim.extend(sims.tolist())
+                f.write(json.dumps({'event': event_id,
+                                    'size': len(members),
+                                    'sim_mean': round(float(sim_mean[i]), 6),
+                                    'sim_min': round(float(sim_min[i]), 6),
+                                    'sim_std': round(float(sim_std[i]), 6),
+                                    'news': members}) + "\n")
+
+        if n:
+            centroids = np.asarray(snapshot['centroids'], dtype=np.float32).reshape(n, self.dim)
+        else:
+            centroids = np.zeros((0, self.dim), dtype=np.float32)
+        np.savez_compressed(npz_path,
+                            event_ids=np.array(snapshot['event_ids'], dtype=np.unicode_),
+                            sizes=sizes,
+                            centroids=centroids,
+                            sim_mean=sim_mean,
+                            sim_min=sim_min,
+                            sim_std=sim_std,
+                            news_ids=np.array(news_ids, dtype=np.unicode_),
+                            news_event=np.array(news_event, dtype=np.int32),
+                            news_sim=np.array(news_sim, dtype=np.float32),
+                            cos=np.array(snapshot['cos'], dtype=np.float32),
+                            cos_std=np.array(snapshot['cos_std'], dtype=np.float32))
+        self.exported += 1
+        return jsonl_path, npz_path
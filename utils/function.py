@@ -3,9 +3,11 @@ import sys
 reload(sys)
 sys.setdefaultencoding( "utf-8" )
 import os
+import re
 import json
 import numpy as np
 from scipy.spatial import distance
+from scipy import sparse
 from nltk.stem.porter import PorterStemmer
 from nltk.tokenize import word_tokenize
 from datetime import *
@@ -14,9 +16,17 @@ import time
 import logging
 logging.basicConfig(format='%(asctime)s : %(levelname)s " %(message)s', level=logging.INFO)
 
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
 class Function():
+    # stem cache的上限, 常駐模式下超過時清空, 避免隨新詞無限成長
+    STEM_CACHE_SIZE = 200000
+
     def __init__(self):
         self.word_model = {}
+        self.stopword_set = set()
+        self.stem_cache = {}
 
     def load_word_model(self, dim, class_file):
         """
@@ -34,6 +44,7 @@ class Function():
         with open(os.path.join("utils", "stopwords_en.txt"), 'r') as f:
             for line in f:
                 self.stopwords.append(line.strip())
+        self.stopword_set = set(self.stopwords)
 
         self.idf_table = {}
         with open(os.path.join("utils", "idf.json"), "r") as f:
@@ -106,71 +117,79 @@ class Function():
     def simple_content_abs(self, content):
         return ".".join(content.strip().split('.')[:3]) + "."
 
-    def get_content_abs(self, dim, content, centroid, r=0.1):
+    def stem_words(self, sentence):
+        """
+        句子的stem列表, 不在詞表中的詞略過; 以regex切詞並cache每個詞的stem, 不對每個句子呼叫word_tokenize
+        :param sentence: str
+        :return: list of str
+        """
+        stems = []
+        for token in WORD_PATTERN.findall(sentence.lower()):
+            # 數字的stem就是自己, 不放入cache
+            if token.isdigit():
+                if token in self.word_model:
+                    stems.append(token)
+                continue
+            stem = self.stem_cache.get(token)
+            if stem is None:
+                if len(self.stem_cache) >= self.STEM_CACHE_SIZE:
+                    self.stem_cache.clear()
+                if token in self.stopword_set:
+                    stem = ""
+                else:
+                    try:
+                        stem = self.porter_stemmer.stem(token)
+                    except Exception:
+                        stem = ""
+                self.stem_cache[token] = stem
+            if stem in self.word_model:
+                stems.append(stem)
+        return stems
+
+    def get_content_abs(self, dim, content, centroid, r=0.1, min_fsent_len=8):
         """
         MEAD方法, score = C + P + F
+        全部句子一次向量化為sparse matrix (句子 x dim, 詞類別的出現次數), 以矩陣運算計算
+        C: 與centroid的cosine similarity, P: 位置權重 (n - i + 1) / n * C, F: 與第一句的cosine similarity
         :param dim: dimension
         :param content: str
         :param centroid: numpy array
         :param r: compression ratio
+        :param min_fsent_len: 第一句少於此詞數時, 擴展到前兩句
         :return: compress_content: str
         """
-        # 分成多個句子
-        id_matrix = np.eye(dim)
-        content_split = content.split('.')
-        min_fsent_len = 8
-
-        c_val = np.zeros((len(content_split),))
-        p_val = np.zeros_like(c_val)
-        f_overlap = np.zeros_like(c_val)
-        n = p_val.shape[0]
-
+        sentences = [sentence for sentence in content.split('.') if sentence.strip()]
+        if not sentences:
+            return self.simple_content_abs(content)
         # 如果取到的第一句太短, 擴展到前兩句
-        if content_split[0] < min_fsent_len:
-            first_sent = ".".join(content_split[:2])
-            oth_sents = content_split[2:]
-        else:
-            first_sent = content_split[0]
-            oth_sents = content_split[1:]
-
-        first_sent_vec = np.zeros(dim)
-        wd_count = 0
-        _, first_sent_stem = self.preprocess(first_sent)
-        for wd in first_sent_stem:
-            try:
-                first_sent_vec += id_matrix[int(self.word_model[wd])]
-                wd_count += 1
-            except:
-                pass
-        # if first sentence is not exist
-        if not wd_count:
+        if len(sentences) > 1 and len(sentences[0].split()) < min_fsent_len:
+            sentences = [".".join(sentences[:2])] + sentences[2:]
+
+        rows = []
+        cols = []
+        for i, sentence in enumerate(sentences):
+            for stem in self.stem_words(sentence):
+                rows.append(i)
+                cols.append(int(self.word_model[stem]))
+        n = len(sentences)
+        # 第一句沒有任何詞表中的詞
+        if not rows or rows[0] != 0:
             return self.simple_content_abs(content)
+        # 重複的 (row, col) 在轉換時相加
+        matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, dim))
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.
+        centroid_norm = np.linalg.norm(centroid) or 1.
 
-        first_sent_vec /= wd_count
-        c_val[0] = self.cal_similarity(first_sent_vec, centroid)
-        p_val[0] = (n + 1.0) / n * c_val[0]
-        f_overlap[0] = 1.0
-
-        oth_sents_vecs = np.zeros((len(oth_sents), dim))
-        for i, sents in enumerate(oth_sents):
-            wd_count = 0
-            _, oth_sent_stem = self.preprocess(sents)
-            for wd in oth_sent_stem:
-                try:
-                    oth_sents_vecs[i, :] += id_matrix[int(self.word_model[wd])]
-                    wd_count += 1
-                except:
-                    pass
-
-            if wd_count:
-                oth_sents_vecs[i, :] /= wd_count
-                c_val[i+1] = self.cal_similarity(oth_sents_vecs[i, :], centroid)
-                p_val[i+1] = float(n - i) / n * c_val[i+1]
-                f_overlap[i+1] = self.cal_similarity(oth_sents_vecs[i, :], first_sent_vec)
+        c_val = matrix.dot(centroid) / norms / centroid_norm
+        p_val = (n + 1. - np.arange(n)) / n * c_val
+        first = matrix.getrow(0).toarray().ravel()
+        f_overlap = matrix.dot(first) / norms / norms[0]
 
         score = c_val + p_val + f_overlap
-        sort_score = sorted([(i, j) for i, j in enumerate(score)], key=lambda x:x[1], reverse=True)
-        compress_content = ".".join([content_split[i] for i, j in sort_score[: int(n*r)+1]]) + "."
+        # 同分時保留句子順序
+        order = sorted(range(n), key=lambda i: score[i], reverse=True)
+        compress_content = ".".join([sentences[i] for i in order[: int(n*r)+1]]) + "."
 
         return compress_content
 
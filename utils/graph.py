@@ -0,0 +1,199 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+
+
+class RelatedEventGraph():
+    """
+    event的相似事件 (relatedEvents) 圖: 每個event保留相似度超過threshold的前k個鄰居
+    - 只重新計算新增, 或centroid移動超過tolerance (1 - cosine) 的event, 每次為 changed x 全部 的矩陣乘法, 不是 K x K
+    - 其他event的鄰居列表只以changed的那一欄更新; 鄰居的分數下降或被移除時, 該event的列表重新計算一次
+    - 狀態即event的 eventVector 與 relatedEvents, 讀取event時以 index 放回, 沒有移動的event不需要重新計算
+    - 列表與寫入時不同的event記錄在 changed, 沒有更新的event也需要寫回 relatedEvents (pop_changed)
+    """
+    def __init__(self, k=15, threshold=0.6, tolerance=0.001):
+        """
+        :param k: 每個event的鄰居數
+        :param threshold: 鄰居的最低相似度
+        :param tolerance: centroid移動超過 (1 - cosine) 時才重新計算
+        """
+        self.k = k
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.__vecs = {}       # event id -> 建立列表時的 normalized centroid
+        self.__neighbors = {}  # event id -> {neighbor id: score}
+        self.__linked = {}     # event id -> 以它為鄰居的event id set
+        self.__dirty = set()   # 鄰居列表可能不完整, 需要重新計算的event
+        self.__changed = set() # 鄰居列表與寫入時不同的event
+        self.similarities = 0
+
+    def __len__(self):
+        return len(self.__vecs)
+
+    def __contains__(self, event_id):
+        return event_id in self.__vecs
+
+    def normalize(self, centroid):
+        vec = np.asarray(centroid, dtype=np.float64).ravel()
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def index(self, event_id, centroid, neighbors=None):
+        """
+        放入event, 給定neighbors (讀取時的relatedEvents) 時直接使用, 否則在下一次refresh時計算
+        :param event_id: event id
+        :param centroid: 建立neighbors時的centroid (eventVector)
+        :param neighbors: list of {id, score}, None為需要計算
+        """
+        self.__unlink(event_id)
+        self.__vecs[event_id] = self.normalize(centroid)
+        if neighbors is None:
+            self.__neighbors[event_id] = {}
+            self.__dirty.add(event_id)
+        else:
+            self.__set_neighbors(event_id, dict((r['id'], r['score']) for r in neighbors))
+            # 與寫入的relatedEvents相同
+            self.__changed.discard(event_id)
+
+    def remove(self, event_ids):
+        """
+        移除event, 以它為鄰居的event重新計算
+        """
+        for event_id in event_ids:
+            if event_id not in self.__vecs:
+                continue
+            self.__unlink(event_id)
+            del self.__vecs[event_id]
+            del self.__neighbors[event_id]
+            self.__dirty.discard(event_id)
+            self.__changed.discard(event_id)
+            for other in self.__linked.pop(event_id, ()):
+                if self.__neighbors[other].pop(event_id, None) is not None:
+                    self.__changed.add(other)
+                self.__dirty.add(other)
+
+    def moved(self, event_id, centroid):
+        """
+        :return: centroid與建立列表時相比, 是否移動超過tolerance
+        """
+        vec = self.normalize(centroid)
+        return 1. - float(vec.dot(self.__vecs[event_id])) > self.tolerance
+
+    def sync(self, centroids):
+        """
+        以目前全部的centroid更新圖: 移除不在centroids中的event, 新增或移動的event重新計算
+        :param centroids: { event id: centroid vector }
+        :return: 重新計算的event數
+        """
+        self.remove([event_id for event_id in self.__vecs if event_id not in centroids])
+        changed = []
+        for event_id, centroid in centroids.iteritems():
+            if event_id not in self.__vecs or self.moved(event_id, centroid):
+                self.__unlink(event_id)
+                self.__vecs[event_id] = self.normalize(centroid)
+                self.__neighbors[event_id] = {}
+                changed.append(event_id)
+        # 讀取時鄰居已經不在圖中的event也需要補齊
+        for event_id in self.__vecs:
+            if event_id not in self.__dirty and any(other not in self.__vecs for other in self.__neighbors[event_id]):
+                self.__dirty.add(event_id)
+        return self.refresh(changed)
+
+    def refresh(self, changed):
+        """
+        :param changed: centroid改變的event
+        :return: 重新計算的event數
+        """
+        changed = [event_id for event_id in changed if event_id in self.__vecs]
+        changed_set = set(changed)
+        ids = self.__vecs.keys()
+        if not ids:
+            return 0
+        pos = dict((event_id, j) for j, event_id in enumerate(ids))
+        matrix = np.vstack([self.__vecs[event_id] for event_id in ids])
+        if changed:
+            scores = np.vstack([self.__vecs[event_id] for event_id in changed]).dot(matrix.T)
+            self.similarities += scores.size
+            for row, event_id in zip(scores, changed):
+                self.__dirty.discard(event_id)
+                self.__set_neighbors(event_id, self.top(ids, row, event_id))
+                # 其他event的列表只更新這一欄
+                candidates = set(ids[j] for j in np.nonzero(row > self.threshold)[0]) | self.__linked.get(event_id, set())
+                for other in candidates:
+                    if other == event_id or other in changed_set:
+                        continue
+                    self.__update(other, event_id, float(row[pos[other]]))
+        dirty = [event_id for event_id in self.__dirty if event_id in self.__vecs]
+        self.__dirty = set()
+        if dirty:
+            scores = np.vstack([self.__vecs[event_id] for event_id in dirty]).dot(matrix.T)
+            self.similarities += scores.size
+            for row, event_id in zip(scores, dirty):
+                self.__set_neighbors(event_id, self.top(ids, row, event_id))
+        return len(changed) + len(dirty)
+
+    def top(self, ids, row, event_id):
+        """
+        :return: {neighbor id: score}, 相似度超過threshold的前k個, 不包含自己
+        """
+        idx = np.nonzero(row > self.threshold)[0]
+        idx = idx[np.argsort(-row[idx], kind='mergesort')]
+        neighbors = {}
+        for j in idx:
+            if ids[j] == event_id:
+                continue
+            neighbors[ids[j]] = float(row[j])
+            if len(neighbors) >= self.k:
+                break
+        return neighbors
+
+    def pop_changed(self):
+        """
+        :return: 上次呼叫後鄰居列表改變的event id set
+        """
+        changed, self.__changed = self.__changed, set()
+        return changed
+
+    def related(self, event_id):
+        """
+        :return: list of {id, score}, 依score由大到小, 格式同event的relatedEvents
+        """
+        neighbors = self.__neighbors.get(event_id, {})
+        return [{'id': other, 'score': score}
+                for other, score in sorted(neighbors.iteritems(), key=lambda item: item[1], reverse=True)]
+
+    def __update(self, event_id, other, score):
+        neighbors = self.__neighbors[event_id]
+        if other in neighbors:
+            if score < neighbors[other]:
+                # 分數下降, 可能有其他event排在它前面或它已經低於threshold
+                self.__dirty.add(event_id)
+            elif score != neighbors[other]:
+                neighbors[other] = score
+                self.__changed.add(event_id)
+        elif score > self.threshold:
+            if len(neighbors) < self.k:
+                neighbors[other] = score
+                self.__linked.setdefault(other, set()).add(event_id)
+                self.__changed.add(event_id)
+            else:
+                weakest = min(neighbors, key=neighbors.get)
+                if score > neighbors[weakest]:
+                    del neighbors[weakest]
+                    self.__linked.get(weakest, set()).discard(event_id)
+                    neighbors[other] = score
+                    self.__linked.setdefault(other, set()).add(event_id)
+                    self.__changed.add(event_id)
+
+    def __set_neighbors(self, event_id, neighbors):
+        if neighbors != self.__neighbors.get(event_id):
+            self.__changed.add(event_id)
+        self.__unlink(event_id)
+        self.__neighbors[event_id] = neighbors
+        for other in neighbors:
+            self.__linked.setdefault(other, set()).add(event_id)
+
+    def __unlink(self, event_id):
+        for other in self.__neighbors.get(event_id, ()):
+            linked = self.__linked.get(other)
+            if linked is not None:
+                linked.discard(event_id)
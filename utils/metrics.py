@@ -0,0 +1,158 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+from collections import OrderedDict
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+class StageStat():
+    """
+    單一階段的統計: 次數, wall time, CPU time, 處理的item數
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.items = 0
+
+    def add(self, n=1):
+        self.items += n
+
+    def report(self):
+        return OrderedDict([('calls', self.calls),
+                            ('wall', round(self.wall, 6)),
+                            ('cpu', round(self.cpu, 6)),
+                            ('items', self.items)])
+
+
+class _Stage():
+    def __init__(self, metrics, stat):
+        self.__metrics = metrics
+        self.__stat = stat
+
+    def __enter__(self):
+        self.__wall = time.time()
+        self.__cpu = cpu_time()
+        self.__metrics.enter(self.__stat.name)
+        return self.__stat
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__stat.calls += 1
+        self.__stat.wall += time.time() - self.__wall
+        self.__stat.cpu += cpu_time() - self.__cpu
+        self.__metrics.exit(self.__stat.name)
+        return False
+
+
+class Metrics():
+    """
+    每個時間段的階段計時與計數器
+    stage: with metrics.stage('cluster') as stage: ... stage.add(n)
+    counter: metrics.incr('similarities', n)
+    gauge: metrics.set('n_events', n)
+    時間段結束時輸出為JSON lines以及Prometheus text format
+    """
+    def __init__(self, prefix="newsminer"):
+        self.prefix = prefix
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.gauges = OrderedDict()
+        self.hooks = []
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStat(name)
+        return _Stage(self, self.stages[name])
+
+    def enter(self, name):
+        for hook in self.hooks:
+            hook.enter(name)
+
+    def exit(self, name):
+        for hook in self.hooks:
+            hook.exit(name)
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def report(self):
+        return OrderedDict([('stages', OrderedDict((name, stat.report()) for name, stat in self.stages.iteritems())),
+                            ('counters', self.counters),
+                            ('gauges', self.gauges)])
+
+    def write_jsonl(self, path, labels=None):
+        """
+        以append的方式寫入一行JSON
+        :param path: 檔案位置
+        :param labels: dict, 例如時間段 {'start': ..., 'end': ...}
+        """
+        record = OrderedDict(labels or {})
+        record.update(self.report())
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def to_prometheus(self):
+        """
+        :return: Prometheus text exposition format
+        """
+        lines = []
+        for field, help_text in (('wall', 'Wall time of the stage in seconds'),
+                                 ('cpu', 'CPU time of the stage in seconds'),
+                                 ('items', 'Items processed by the stage'),
+                                 ('calls', 'Times the stage was entered')):
+            metric = "%s_stage_%s" % (self.prefix, field + "_seconds" if field in ('wall', 'cpu') else field)
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s gauge" % metric)
+            for name, stat in self.stages.iteritems():
+                lines.append('%s{stage="%s"} %s' % (metric, name, repr(float(getattr(stat, field)))))
+        for name, value in self.counters.iteritems():
+            metric = "%s_%s_total" % (self.prefix, name)
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %s" % (metric, repr(float(value))))
+        for name, value in self.gauges.iteritems():
+            metric = "%s_%s" % (self.prefix, name)
+            lines.append("# TYPE %s gauge" % metric)
+            lines.append("%s %s" % (metric, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        寫入Prometheus textfile collector可讀取的檔案 (先寫暫存檔再rename)
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.rename(tmp_path, path)
+
+
+class _NoProgress():
+    def update(self, n=1):
+        pass
+
+    def close(self):
+        pass
+
+
+def progress(enabled, total=None, mininterval=0.5):
+    """
+    可選的進度條, 關閉時不做任何事
+    :param enabled: 是否顯示
+    :return: tqdm 或 no-op
+    """
+    if enabled and tqdm is not None:
+        return tqdm(total=total, mininterval=mininterval)
+    return _NoProgress()
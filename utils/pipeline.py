@@ -0,0 +1,239 @@
+# -*- coding:utf-8 -*-
+import sys
+import time
+import threading
+from Queue import Queue, Empty, Full
+from collections import OrderedDict
+
+_DONE = object()
+
+
+class StageTimer():
+    """
+    紀錄單一階段的忙碌時間 (busy), 等待queue的時間 (wait) 以及處理的item數
+    """
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.
+        self.wait = 0.
+        self.items = 0
+        self.start = None
+        self.end = None
+
+    def report(self):
+        wall = (self.end or time.time()) - (self.start or time.time())
+        return {'busy': round(self.busy, 3),
+                'wait': round(self.wait, 3),
+                'wall': round(wall, 3),
+                'items': self.items,
+                'utilization': round(self.busy / wall, 3) if wall > 0 else 0.}
+
+
+class Sink():
+    """
+    背景thread消化寫入工作, 主thread只負責put, 寫入在queue滿時才會阻塞主thread
+    """
+    def __init__(self, timer, func, maxsize):
+        self.__timer = timer
+        self.__func = func
+        self.__queue = Queue(maxsize=maxsize)
+        self.__exc_info = None
+        self.__aborted = False
+        self.__thread = threading.Thread(target=self.__work)
+        self.__thread.daemon = True
+        self.__timer.start = time.time()
+        self.__thread.start()
+
+    def __work(self):
+        while True:
+            t = time.time()
+            item = self.__queue.get()
+            self.__timer.wait += time.time() - t
+            if item is _DONE:
+                break
+            if self.__exc_info or self.__aborted:
+                continue
+            t = time.time()
+            try:
+                self.__func(item)
+            except Exception:
+                self.__exc_info = sys.exc_info()
+            self.__timer.busy += time.time() - t
+            self.__timer.items += 1
+
+    def put(self, item):
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        self.__queue.put(item)
+
+    def close(self):
+        if not self.__thread.is_alive():
+            return
+        self.__queue.put(_DONE)
+        self.__thread.join()
+        self.__timer.end = time.time()
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+
+    def abort(self):
+        """
+        呼叫者發生例外時使用: 略過尚未寫入的item並結束thread, 不拋出寫入的例外 (避免蓋過呼叫者的例外)
+        """
+        if not self.__thread.is_alive():
+            return
+        self.__aborted = True
+        self.__queue.put(_DONE)
+        self.__thread.join()
+        self.__timer.end = time.time()
+
+
+class Pipeline():
+    """
+    以threading + bounded Queue重疊mongoDB I/O與CPU階段
+    producer: 背景thread讀取 (news batch, event members), 主thread邊消化邊計算
+    sink: 背景thread寫入 (event save), 主thread計算下一個event
+    主thread提早結束 (例外) 時以close停止全部的producer與sink, 不留下阻塞在queue上的thread與開啟的cursor
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.stages = OrderedDict()
+        self.__closers = []
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageTimer(name)
+        return self.stages[name]
+
+    def batched(self, iterable, batch_size):
+        """
+        將iterable切成固定大小的list
+        :return: generator of list
+        """
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def producer(self, name, iterable):
+        """
+        在背景thread中迭代iterable (mongoDB cursor等I/O), 結果放入bounded queue
+        :param name: stage名稱
+        :param iterable: iterable
+        :return: generator, 由主thread消化
+        """
+        timer = self.stage(name)
+        queue = Queue(maxsize=self.maxsize)
+        stop = threading.Event()
+        exc_info = []
+
+        def put(item):
+            # 消化端停止後不再阻塞在已滿的queue上
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def work():
+            timer.start = time.time()
+            it = iter(iterable)
+            try:
+                while not stop.is_set():
+                    t = time.time()
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        break
+                    timer.busy += time.time() - t
+                    timer.items += 1
+                    t = time.time()
+                    if not put(item):
+                        break
+                    timer.wait += time.time() - t
+            except Exception:
+                exc_info.append(sys.exc_info())
+            finally:
+                # 提早停止時釋放cursor (pymongo cursor與generator都有close)
+                if stop.is_set() and hasattr(iterable, 'close'):
+                    iterable.close()
+            timer.end = time.time()
+            put(_DONE)
+
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+        def close():
+            stop.set()
+            while True:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    break
+            thread.join()
+
+        def consume():
+            try:
+                while True:
+                    item = queue.get()
+                    if item is _DONE:
+                        break
+                    yield item
+                thread.join()
+                if exc_info:
+                    raise exc_info[0][0], exc_info[0][1], exc_info[0][2]
+            finally:
+                close()
+        self.__closers.append(close)
+        return consume()
+
+    def sink(self, name, func):
+        """
+        :param name: stage名稱
+        :param func: 對每個item執行的寫入function
+        :return: Sink
+        """
+        sink = Sink(self.stage(name), func, self.maxsize)
+        self.__closers.append(sink.abort)
+        return sink
+
+    def close(self):
+        """
+        停止全部的producer與sink, 已正常結束的不受影響
+        """
+        closers, self.__closers = self.__closers, []
+        for close in closers:
+            close()
+
+    def measure(self, name):
+        """
+        紀錄主thread上CPU階段的時間
+        :return: StageTimer, 以 with 使用
+        """
+        return _Measure(self.stage(name))
+
+    def report(self):
+        return OrderedDict((name, timer.report()) for name, timer in self.stages.iteritems())
+
+
+class _Measure():
+    def __init__(self, timer):
+        self.__timer = timer
+
+    def __enter__(self):
+        self.__t = time.time()
+        if self.__timer.start is None:
+            self.__timer.start = self.__t
+        return self.__timer
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        now = time.time()
+        self.__timer.busy += now - self.__t
+        self.__timer.end = now
+        return False
@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+import os
+import pstats
+import cProfile
+from collections import Counter
+
+# python 2 需要安裝 pytracemalloc, 沒有時只做cProfile
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class StageProfiler():
+    """
+    以Metrics的hook對每個stage做cProfile與tracemalloc
+    巢狀的stage (例如reevaluate中的split) 進入時暫停外層profiler, 因此每個stage只紀錄自己的時間
+    只有主thread的stage會被紀錄, pipeline背景thread的讀寫不在內
+    tracemalloc只對最外層的stage做snapshot, 巢狀stage (例如每個event的abstract) 的分配算在外層stage中
+    輸出:
+        <path>/<stage>.prof     cProfile dump, 以 pstats / snakeviz 讀取
+        <path>/<stage>.txt      依cumulative time排序的前N個function
+        <path>/<stage>.mem.txt  該stage的記憶體增量與峰值, 以及分配記憶體最多的前N行
+    """
+    def __init__(self, cpu=True, memory=False, top_n=30):
+        """
+        :param cpu: 是否使用cProfile
+        :param memory: 是否使用tracemalloc
+        :param top_n: 文字報告中的行數
+        """
+        self.cpu = cpu
+        self.memory = memory and tracemalloc is not None
+        if memory and tracemalloc is None:
+            print "tracemalloc is not available, --profile_memory is ignored"
+        self.top_n = top_n
+        self.__profiles = {}
+        self.__allocations = {}
+        self.__peaks = {}
+        self.__growth = {}
+        self.__stack = []
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def enter(self, name):
+        if self.cpu:
+            if self.__stack:
+                self.__profiles[self.__stack[-1][0]].disable()
+            if name not in self.__profiles:
+                self.__profiles[name] = cProfile.Profile()
+            self.__profiles[name].enable()
+        snapshot, current = None, 0
+        if self.memory and not self.__stack:
+            # get_traced_memory的peak是tracemalloc.start之後的最大值, 每個stage開始時重設
+            # (pytracemalloc沒有reset_peak, 此時只紀錄stage結束時的記憶體增量)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+            current = tracemalloc.get_traced_memory()[0]
+        self.__stack.append((name, snapshot, current))
+
+    def exit(self, name):
+        name, snapshot, start = self.__stack.pop()
+        if snapshot is not None:
+            allocations = self.__allocations.setdefault(name, Counter())
+            for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'lineno'):
+                frame = stat.traceback[0]
+                allocations["%s:%d" % (frame.filename, frame.lineno)] += stat.size_diff
+            current, peak = tracemalloc.get_traced_memory()
+            self.__growth[name] = max(self.__growth.get(name, 0), current - start)
+            if hasattr(tracemalloc, 'reset_peak'):
+                self.__peaks[name] = max(self.__peaks.get(name, 0), peak - start)
+        if self.cpu:
+            self.__profiles[name].disable()
+            if self.__stack:
+                self.__profiles[self.__stack[-1][0]].enable()
+
+    def dump(self, path):
+        """
+        寫入每個stage的profile結果
+        :param path: 輸出目錄, 例如 log/profile/<date>
+        :return: 寫入的stage名稱
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name, profile in self.__profiles.iteritems():
+            profile.dump_stats(os.path.join(path, name + ".prof"))
+            with open(os.path.join(path, name + ".txt"), "w") as f:
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(self.top_n)
+        for name, allocations in self.__allocations.iteritems():
+            with open(os.path.join(path, name + ".mem.txt"), "w") as f:
+                f.write("traced memory growth: %.1f KiB\n" % (self.__growth[name] / 1024.))
+                if name in self.__peaks:
+                    f.write("peak traced memory above stage start: %.1f KiB\n" % (self.__peaks[name] / 1024.))
+                for line, size in allocations.most_common(self.top_n):
+                    f.write("%10.1f KiB  %s\n" % (size / 1024., line))
+        return sorted(set(self.__profiles) | set(self.__allocations))
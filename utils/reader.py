@@ -3,7 +3,9 @@
 import json
 from datetime import *
 import time
+import pymongo
 from pymongo import MongoClient
+from codec import VectorCodec
 
 class Reader():
     def parse_uri(self, host, username, pswd):
@@ -74,27 +76,65 @@ class NewsReader(Reader):
         result = self.news_collection.save(item)
         return result
 
-    def query_many_by_time(self, start_time, end_time):
+    def query_many_by_time(self, start_time, end_time, include_start=False, fields=None):
         """
         尋找mongoDB news collection中符合時間段內的新聞
         :param start_time: 開始時間 (上次查詢後最後時間)
         :param end_time: 結束時間 (time.time() 現在運行時間)
+        :param include_start: 是否包含crawlTime等於開始時間的新聞 (切分時間段時, 除了第一段以外都需要包含)
+        :param fields: projection, None時回傳完整document
         :return: result: 查詢結果
         """
 	start_time = start_time.replace("-", "").replace(" ", "").replace(":", "")
 	end_time = end_time.replace("-", "").replace(" ", "").replace(":", "")
-        result = self.news_collection.find({"crawlTime": {"$gt": start_time, "$lt": end_time}})
+        start_op = "$gte" if include_start else "$gt"
+        result = self.news_collection.find({"crawlTime": {start_op: start_time, "$lt": end_time}}, fields)
         # for i in result:
         #     print i
         return result
 
-    def query_many_by_item(self, item):
+    def count_many_by_time(self, start_time, end_time, include_start=False):
+        """
+        計算時間段內的新聞數, 以crawlTime索引計算, 不讀取document
+        :param start_time: 開始時間
+        :param end_time: 結束時間
+        :param include_start: 是否包含crawlTime等於開始時間的新聞
+        :return: count: int
+        """
+        start_time = start_time.replace("-", "").replace(" ", "").replace(":", "")
+        end_time = end_time.replace("-", "").replace(" ", "").replace(":", "")
+        start_op = "$gte" if include_start else "$gt"
+        return self.news_collection.count_documents({"crawlTime": {start_op: start_time, "$lt": end_time}})
+
+    def create_tail_index(self):
+        """
+        建立 (crawlTime, _id) 複合索引, 供tail模式依高水位線查詢
+        :return: index name
+        """
+        return self.news_collection.create_index([("crawlTime", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+
+    def query_many_after(self, crawl_time, news_id, limit):
+        """
+        尋找mongoDB news collection中 (crawlTime, _id) 大於高水位線的新聞, 依 (crawlTime, _id) 排序
+        :param crawl_time: 高水位線的crawlTime
+        :param news_id: 高水位線的_id, 同一crawlTime下只取_id更大的新聞
+        :param limit: 最多回傳筆數
+        :return: result: 查詢結果
+        """
+        result = self.news_collection.find({"$or": [{"crawlTime": {"$gt": crawl_time}},
+                                                    {"crawlTime": crawl_time, "_id": {"$gt": news_id}}]}) \
+            .sort([("crawlTime", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]) \
+            .limit(limit)
+        return result
+
+    def query_many_by_item(self, item, fields=None):
         """
         根據提供的item尋找mongoDB news collection中符合的新聞
         :param item: 查詢的item條件, dict
+        :param fields: projection, None時回傳完整document
         :return: result: 查詢結果
         """
-        result = self.news_collection.find(item)
+        result = self.news_collection.find(item, fields)
         # for i in result:
         #     print i
         return result
@@ -118,6 +158,7 @@ class EventReader(Reader):
         self.init_mongoDB()
         self.day_diff = 86400
         self.window = window
+        self.codec = VectorCodec()
 
     def init_mongoDB(self):
         """
@@ -126,6 +167,8 @@ class EventReader(Reader):
         :return: none
         """
         self.event_collection = self.db[self._event_collection_name]
+        # 另外存放的event成員 (Config.event_article_layout = 'collection')
+        self.article_collection = self.db[self._event_collection_name + "_article"]
         print self.db
         print self.event_collection
 
@@ -140,6 +183,90 @@ class EventReader(Reader):
         result = self.event_collection.save(item)
         return result
 
+    def save_items(self, items):
+        """
+        批次寫入多個event (以_id取代或新增)
+        :param items: list of event dict
+        :return: result: BulkWriteResult
+        """
+        if not items:
+            return None
+        requests = [pymongo.ReplaceOne({'_id': item['_id']}, item, upsert=True) for item in items]
+        return self.event_collection.bulk_write(requests, ordered=False)
+
+    def update_item(self, item_id, update, item=None):
+        """
+        以update document ($set, $push, $unset) 更新event, 只傳送改變的部分
+        :param item_id: event id
+        :param update: update document
+        :param item: 更新後完整的event, 此處不使用 (緩衝寫入時使用)
+        :return: result: UpdateResult
+        """
+        return self.event_collection.update_one({'_id': item_id}, update)
+
+    def create_modified_index(self):
+        """
+        建立 modified 索引, 供讀取快照後查詢快照之後修改過的event
+        :return: index name
+        """
+        return self.event_collection.create_index([("modified", pymongo.ASCENDING)])
+
+    def create_article_index(self):
+        """
+        建立event成員的 (event, pos) 唯一索引
+        :return: index name
+        """
+        return self.article_collection.create_index([("event", pymongo.ASCENDING), ("pos", pymongo.ASCENDING)],
+                                                    unique=True)
+
+    def save_articles(self, event_id, articles, start=0):
+        """
+        批次寫入event的成員, 第i個成員的pos為 start + i
+        start為0時取代全部成員, 否則接在已經寫入的成員之後
+        :param event_id: event id
+        :param articles: list of news dict, 格式同event的articles
+        :param start: 第一個成員的pos
+        :return: 寫入的成員數
+        """
+        requests = []
+        for i, article in enumerate(articles):
+            doc = dict(article, event=event_id, pos=start + i)
+            requests.append(pymongo.ReplaceOne({'event': event_id, 'pos': start + i}, doc, upsert=True))
+        if requests:
+            self.article_collection.bulk_write(requests, ordered=False)
+        if start == 0:
+            self.article_collection.delete_many({'event': event_id, 'pos': {'$gte': len(articles)}})
+        return len(articles)
+
+    def query_articles(self, event_ids, page_size=1000):
+        """
+        依 (event, pos) 分頁讀取多個event的成員, 每頁以上一頁最後的 (event, pos) 繼續查詢
+        :param event_ids: list of event id
+        :param page_size: 每頁的成員數
+        :return: generator of member dict (包含 event, pos)
+        """
+        query = {'event': {'$in': list(event_ids)}}
+        while True:
+            page = list(self.article_collection.find(query, {'_id': False})
+                        .sort([("event", pymongo.ASCENDING), ("pos", pymongo.ASCENDING)])
+                        .limit(page_size))
+            for member in page:
+                yield member
+            if len(page) < page_size:
+                return
+            last = page[-1]
+            query = {'event': {'$in': list(event_ids)},
+                     '$or': [{'event': {'$gt': last['event']}},
+                             {'event': last['event'], 'pos': {'$gt': last['pos']}}]}
+
+    def load_articles(self, events, page_size=1000):
+        """
+        以一次分頁查詢讀取多個event的全部成員, 取代event中只保留前N個的articles
+        :param events: list of event dict, 直接修改
+        :return: events
+        """
+        return attach_articles(events, self.query_articles([event['_id'] for event in events], page_size=page_size))
+
     def create_event_id(self, t):
         """
 
@@ -151,8 +278,50 @@ class EventReader(Reader):
         eid = eid.replace(' ', '')
         return eid
 
+    def decode_vectors(self, event, dim=None):
+        """
+        將event的eventVector以及articles中的newsVector解碼為numpy array, 沒有向量時為None
+        :param event: event dict
+        :param dim: 舊格式稀疏list的維度
+        :return: event
+        """
+        event['eventVector'] = self.codec.decode(event.get('eventVector'), dim)
+        for article in event.get('articles', []):
+            article['newsVector'] = self.codec.decode(article.get('newsVector'), dim)
+        return event
+
     def close_events(self, t):
-        self.event_collection.update({"updated": {"$lt": t}, "closed":False}, {"$set":{"closed":True}}, upsert=False, multi=True)
+        """
+        關閉 updated <= t 的event, 與query_many_by_time ($gt) 一致: 不再讀取的event同時關閉
+        :param t: time string
+        """
+        modified = self.time2time_string(datetime.now())
+        self.event_collection.update({"updated": {"$lte": t}, "closed":False}, {"$set":{"closed":True, "modified":modified}}, upsert=False, multi=True)
+
+    def close_events_by_ids(self, event_ids, batch_size=500):
+        """
+        以 _id 批次關閉event, 只更新給定的event, 不掃描整個collection
+        :param event_ids: list of event id
+        :param batch_size: 每次 $in 的event數
+        :return: 關閉的event數
+        """
+        modified = self.time2time_string(datetime.now())
+        count = 0
+        for i in range(0, len(event_ids), batch_size):
+            result = self.event_collection.update_many({"_id": {"$in": event_ids[i:i + batch_size]}, "closed": False},
+                                                       {"$set": {"closed": True, "modified": modified}})
+            count += result.modified_count
+        return count
+
+    def query_open_events(self, t):
+        """
+        與query_recent_events_by_time讀取相同的event, 但不關閉過期的event (只讀, 用於capture)
+        :param t: time string
+        :return: result: 查詢結果
+        """
+        last_time = self.time_string2time(t) + timedelta(days=-self.window)
+        last_time_t = self.time2time_string(last_time)
+        return self.query_many_by_time(start_time=last_time_t, end_time=t, include_end=True)
 
     def query_recent_events_by_time(self, t):
         """
@@ -164,16 +333,19 @@ class EventReader(Reader):
         last_time_t = self.time2time_string(last_time)
         self.close_events(last_time_t)
         print "read event from", last_time_t, " to ", t
-        return self.query_many_by_time(start_time=last_time_t, end_time=t)
+        # updated 等於 t 的event是同一個時間段先前中途失敗的執行寫入的, 一併讀取使重跑不會重複聚類
+        return self.query_many_by_time(start_time=last_time_t, end_time=t, include_end=True)
 
-    def query_many_by_time(self, start_time, end_time):
+    def query_many_by_time(self, start_time, end_time, include_end=False):
         """
         尋找mongoDB event collection中符合時間段內的新聞
         :param start_time: 開始時間 (上次查詢後最後時間)
         :param end_time: 結束時間 (time.time() 現在運行時間)
+        :param include_end: 是否包含updated等於結束時間的event
         :return: result: 查詢結果
         """
-        result = self.event_collection.find({"updated": {"$gt": start_time, "$lt": end_time}, "closed": False})
+        end_op = "$lte" if include_end else "$lt"
+        result = self.event_collection.find({"updated": {"$gt": start_time, end_op: end_time}, "closed": False})
         # for i in result:
         #     print i
         return result
@@ -200,6 +372,126 @@ class EventReader(Reader):
         #     print i
         return result
 
+def attach_articles(events, members):
+    """
+    :param events: list of event dict, 直接修改
+    :param members: query_articles的結果, 同一個event依pos排序
+    :return: events, articles 為全部成員
+    """
+    articles = dict((event['_id'], []) for event in events)
+    for member in members:
+        event_id = member.pop('event')
+        member.pop('pos')
+        articles[event_id].append(member)
+    for event in events:
+        event['articles'] = articles[event['_id']]
+    return events
+
+
+class BufferedEventReader():
+    """
+    EventReader的寫入緩衝, save_item只寫入記憶體, 在flush時才批次寫回mongoDB
+    讀取時先查詢緩衝區, 因此Model看到的event與直接寫入mongoDB時一致
+    """
+    def __init__(self, event_reader, batch_size=500):
+        self.__event_reader = event_reader
+        self.__batch_size = batch_size
+        self.__buffer = {}
+        self.__close_time = None
+        self.__close_ids = set()
+        self.__articles = {}
+
+    def __getattr__(self, name):
+        return getattr(self.__event_reader, name)
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def save_item(self, item):
+        self.__buffer[item['_id']] = item
+        return item['_id']
+
+    def update_item(self, item_id, update, item=None):
+        # 緩衝區保存完整的event, flush時整批取代
+        self.__buffer[item_id] = item
+        return item_id
+
+    def save_articles(self, event_id, articles, start=0):
+        # 緩衝區保存event的全部成員, flush時整批取代
+        if event_id not in self.__articles:
+            existing = [] if start == 0 else self.__event_reader.load_articles([{'_id': event_id}])[0]['articles']
+            self.__articles[event_id] = existing
+        self.__articles[event_id][start:] = articles
+        return len(articles)
+
+    def query_articles(self, event_ids, page_size=1000):
+        rest = []
+        for event_id in event_ids:
+            if event_id in self.__articles:
+                for pos, article in enumerate(self.__articles[event_id]):
+                    yield dict(article, event=event_id, pos=pos)
+            else:
+                rest.append(event_id)
+        if rest:
+            for member in self.__event_reader.query_articles(rest, page_size=page_size):
+                yield member
+
+    def load_articles(self, events, page_size=1000):
+        return attach_articles(events, self.query_articles([event['_id'] for event in events], page_size=page_size))
+
+    def query_one_by_item(self, item):
+        if item.keys() == ['_id'] and item['_id'] in self.__buffer:
+            return self.__buffer[item['_id']]
+        return self.__event_reader.query_one_by_item(item)
+
+    def close_events(self, t):
+        for event in self.__buffer.itervalues():
+            if event['closed'] is False and event['updated'] <= t:
+                event['closed'] = True
+        if self.__close_time is None or t > self.__close_time:
+            self.__close_time = t
+
+    def close_events_by_ids(self, event_ids, batch_size=500):
+        for event_id in event_ids:
+            if event_id in self.__buffer:
+                if self.__buffer[event_id]['closed'] is False:
+                    self.__buffer[event_id]['closed'] = True
+            else:
+                self.__close_ids.add(event_id)
+        return len(event_ids)
+
+    def query_recent_events_by_time(self, t):
+        last_time = self.time_string2time(t) + timedelta(days=-self.window)
+        last_time_t = self.time2time_string(last_time)
+        self.close_events(last_time_t)
+        print "read event from", last_time_t, " to ", t
+        result = [event for event in self.__event_reader.query_many_by_time(start_time=last_time_t, end_time=t,
+                                                                            include_end=True)
+                  if event['_id'] not in self.__buffer]
+        result.extend(event for event in self.__buffer.itervalues()
+                      if event['closed'] is False and last_time_t < event['updated'] <= t)
+        return result
+
+    def flush(self):
+        """
+        將緩衝區的event批次寫回mongoDB, 並關閉緩衝期間過期的event
+        :return: 寫入的event數
+        """
+        events = self.__buffer.values()
+        for i in range(0, len(events), self.__batch_size):
+            self.__event_reader.save_items(events[i:i + self.__batch_size])
+        if self.__close_time:
+            self.__event_reader.close_events(self.__close_time)
+        if self.__close_ids:
+            self.__event_reader.close_events_by_ids(list(self.__close_ids), batch_size=self.__batch_size)
+        for event_id, articles in self.__articles.iteritems():
+            self.__event_reader.save_articles(event_id, articles)
+        self.__articles = {}
+        self.__buffer = {}
+        self.__close_time = None
+        self.__close_ids = set()
+        return len(events)
+
 def test_news():
     IP_PORT = "10.1.1.46:27017"
     news_reader = NewsReader(uri=IP_PORT)
@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+import heapq
+
+
+class EventRegistry():
+    """
+    記憶體中尚未關閉的event, 以updated時間排序的expiry heap
+    更新時直接push新的 (updated, event_id), 舊的紀錄在pop時才略過 (lazy deletion)
+    過期只需要pop heap頂端, 不需要掃描全部event
+    """
+    def __init__(self):
+        self.__updated = {}
+        self.__heap = []
+
+    def __contains__(self, event_id):
+        return event_id in self.__updated
+
+    def __len__(self):
+        return len(self.__updated)
+
+    def __iter__(self):
+        return iter(self.__updated)
+
+    def get(self, event_id, default=None):
+        return self.__updated.get(event_id, default)
+
+    def touch(self, event_id, updated):
+        """
+        加入或更新event
+        :param event_id: str
+        :param updated: time string
+        """
+        if self.__updated.get(event_id) == updated:
+            return
+        self.__updated[event_id] = updated
+        heapq.heappush(self.__heap, (updated, event_id))
+        # 過時的紀錄太多時重建heap
+        if len(self.__heap) > 2 * len(self.__updated) + 64:
+            self.__heap = [(t, eid) for eid, t in self.__updated.iteritems()]
+            heapq.heapify(self.__heap)
+
+    def remove(self, event_id):
+        """
+        移除event, heap中的紀錄在expire時略過
+        """
+        return self.__updated.pop(event_id, None)
+
+    def expire(self, last_time_t):
+        """
+        移除並回傳 updated <= last_time_t 的event
+        :param last_time_t: time string
+        :return: list of (event id, updated)
+        """
+        expired = []
+        while self.__heap and self.__heap[0][0] <= last_time_t:
+            updated, event_id = heapq.heappop(self.__heap)
+            if self.__updated.get(event_id) == updated:
+                del self.__updated[event_id]
+                expired.append((event_id, updated))
+        return expired
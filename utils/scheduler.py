@@ -0,0 +1,139 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import fcntl
+import random
+import datetime
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class WindowScheduler():
+    """
+    取代舊版 time.txt 的時間段輪替: 依cadence定期執行聚類, 並以水位線 (上次完成的時間段結束時間) 決定下一個時間段
+    落後時 (例如停機後) 將積壓切成最多max_window的時間段依序補跑, 不會產生一個巨大的時間段
+    同時只允許一個執行 (lock file), 失敗時以jittered exponential backoff重試
+    """
+    def __init__(self, run_window, state_file, lock_file, cadence=60, max_window=1440, lag=0,
+                 retries=3, retry_delay=30):
+        """
+        :param run_window: function(start_time_t, end_time_t), 執行一個時間段
+        :param state_file: 水位線的存放位置, json
+        :param lock_file: lock file, 避免重疊執行
+        :param cadence: 兩次執行的間隔 (分鐘), 也是最短的時間段
+        :param max_window: 補跑時每個時間段最長的分鐘數
+        :param lag: 時間段結束時間落後現在的分鐘數, 等待爬蟲寫入較晚的新聞
+        :param retries: 失敗時的重試次數
+        :param retry_delay: 第一次重試前等待的秒數, 之後每次加倍並加上隨機抖動
+        """
+        self.__run_window = run_window
+        self.__state_file = state_file
+        self.__lock_file = lock_file
+        self.cadence = datetime.timedelta(minutes=cadence)
+        self.max_window = datetime.timedelta(minutes=max(cadence, max_window))
+        self.lag = datetime.timedelta(minutes=lag)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.watermark = None
+
+    def load_watermark(self, default):
+        """
+        :param default: 沒有紀錄時的起始時間, datetime
+        :return: watermark: datetime
+        """
+        if os.path.exists(self.__state_file):
+            with open(self.__state_file, "r") as f:
+                self.watermark = datetime.datetime.strptime(json.loads(f.read())['end'], TIME_FORMAT)
+        else:
+            self.watermark = default
+        return self.watermark
+
+    def commit(self, end_time):
+        """
+        時間段完成後推進水位線, 並寫回檔案
+        :param end_time: datetime
+        """
+        self.watermark = end_time
+        state_dir = os.path.dirname(self.__state_file)
+        if state_dir and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        tmp_file = self.__state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(json.dumps({'end': end_time.strftime(TIME_FORMAT),
+                                'committed': datetime.datetime.now().strftime(TIME_FORMAT)}))
+        os.rename(tmp_file, self.__state_file)
+
+    def pending(self, now):
+        """
+        :param now: datetime
+        :return: 待執行的時間段, list of (start datetime, end datetime), 不足一個cadence時為空
+        """
+        target = now - self.lag
+        windows = []
+        start = self.watermark
+        while target - start >= self.cadence:
+            end = min(start + self.max_window, target)
+            windows.append((start, end))
+            start = end
+        return windows
+
+    def run_with_retry(self, start_time, end_time):
+        """
+        :return: 是否成功
+        """
+        start_time_t = start_time.strftime(TIME_FORMAT)
+        end_time_t = end_time.strftime(TIME_FORMAT)
+        for attempt in range(self.retries + 1):
+            try:
+                self.__run_window(start_time_t, end_time_t)
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    print "window", start_time_t, end_time_t, "failed:", repr(e)
+                    return False
+                delay = self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+                print "window", start_time_t, end_time_t, "failed:", repr(e), "retry in %.1f s" % delay
+                time.sleep(delay)
+
+    def tick(self, now=None):
+        """
+        執行目前積壓的全部時間段, 其他process正在執行時直接略過
+        :return: 完成的時間段數, 略過時為 None
+        """
+        lock_dir = os.path.dirname(self.__lock_file)
+        if lock_dir and not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+        with open(self.__lock_file, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                print "another run holds", self.__lock_file, "skip"
+                return None
+            try:
+                done = 0
+                for start_time, end_time in self.pending(now or datetime.datetime.now()):
+                    print "window", start_time.strftime(TIME_FORMAT), end_time.strftime(TIME_FORMAT)
+                    # 失敗時保留水位線, 下一次tick從同一個時間段開始
+                    if not self.run_with_retry(start_time, end_time):
+                        break
+                    self.commit(end_time)
+                    done += 1
+                return done
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def next_run(self):
+        """
+        :return: 距離下一個時間段可以執行的秒數
+        """
+        due = self.watermark + self.cadence + self.lag
+        return max(0., (due - datetime.datetime.now()).total_seconds())
+
+    def run_forever(self, poll_interval=60):
+        """
+        持續執行, 執行時間超過cadence時錯過的時間段由下一次tick補跑
+        """
+        while True:
+            self.tick()
+            time.sleep(min(self.next_run(), poll_interval) or poll_interval)
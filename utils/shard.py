@@ -0,0 +1,197 @@
+# -*- coding:utf-8 -*-
+import zlib
+import datetime
+import multiprocessing
+
+import numpy as np
+
+from codec import VectorCodec
+from reader import NewsReader
+from metrics import Metrics
+from stats import ClusterStats
+
+
+def time_slices(start_time_t, end_time_t, n_shards):
+    """
+    將時間段切成n_shards個不重疊的子時間段, 除了第一段以外都包含開始時間, 切點上的新聞不會遺漏
+    :return: list of task dict
+    """
+    fmt = "%Y-%m-%d %H:%M:%S"
+    start = datetime.datetime.strptime(start_time_t, fmt)
+    end = datetime.datetime.strptime(end_time_t, fmt)
+    step = (end - start) / n_shards
+    tasks = []
+    for i in range(n_shards):
+        slice_end = end if i == n_shards - 1 else start + step * (i + 1)
+        tasks.append({'shard': i, 'start': (start + step * i).strftime(fmt), 'end': slice_end.strftime(fmt),
+                      'include_start': i > 0})
+    return tasks
+
+
+def hash_shards(start_time_t, end_time_t, n_shards):
+    """
+    整個時間段, 依新聞 _id 的crc32分成n_shards份
+    :return: list of task dict
+    """
+    return [{'shard': i, 'start': start_time_t, 'end': end_time_t, 'n_shards': n_shards}
+            for i in range(n_shards)]
+
+
+class ShardWorker():
+    """
+    map: 讀取一個shard的新聞, 以Model的vectorize與online_clustering聚類, 輸出聚類摘要
+    摘要只包含 sum, count, 成員id, 充分統計量 (ClusterStats) 以及成員的精簡紀錄, 不傳送成員向量與content等heavy欄位
+    成員向量由coordinator以stemmed欄位重新建立 (Model.rebuild_clusters), --dedup時另外傳送重複新聞與代表的對應
+    """
+    def __init__(self, config, news_reader=None):
+        # 延遲import, 避免utils與model互相import
+        from model import Model
+        self.config = config
+        self.codec = VectorCodec()
+        self.news_reader = news_reader or NewsReader(uri=config.ip_port)
+        self.model = Model(config=config, news_reader=self.news_reader, event_reader=None)
+
+    def news(self, task):
+        """
+        hash_shards時先只讀取 _id (crawlTime, _id 索引即可回答), 依crc32過濾後再以 $in 分批讀取本shard的完整新聞,
+        每個worker不需要讀取整個時間段的完整document
+        """
+        if 'n_shards' not in task:
+            return self.news_reader.query_many_by_time(start_time=task['start'], end_time=task['end'],
+                                                       include_start=task.get('include_start', False))
+        ids = [news['_id'] for news in self.news_reader.query_many_by_time(start_time=task['start'], end_time=task['end'],
+                                                                           fields={'_id': 1})
+               if zlib.crc32(str(news['_id'])) % task['n_shards'] == task['shard']]
+        batch_size = self.config.fetch_batch
+        docs = {}
+        for i in range(0, len(ids), batch_size):
+            for news in self.news_reader.query_many_by_item({'_id': {'$in': ids[i:i + batch_size]}}):
+                docs[news['_id']] = news
+        # online clustering與讀取順序有關, 維持時間段查詢的順序
+        return [docs[news_id] for news_id in ids if news_id in docs]
+
+    def run(self, task):
+        """
+        :param task: time_slices或hash_shards產生的task
+        :return: summary dict
+        """
+        self.model.metrics = Metrics()
+        news_list = self.news(task)
+        clusters_vec, clusters_id, centroids = self.model.clustering_news(news_list=news_list)
+        copies = self.model.copies()
+        clusters = []
+        for key in clusters_id:
+            ids = clusters_id[key]
+            stats = ClusterStats.from_vectors(clusters_vec[key], last=ids[-1])
+            clusters.append({'id': key,
+                             'sum': self.codec.encode(stats.vec_sum, kind='dense32'),
+                             'count': len(ids),
+                             'ids': ids,
+                             'copies': dict((copy_id, news_id) for news_id in ids for copy_id in copies.get(news_id, ())),
+                             'stats': stats.encode(self.codec)})
+        member_ids = [news_id for cluster in clusters for news_id in cluster['ids']]
+        return {'shard': task['shard'],
+                'n_news': self.model.count_news(news_list),
+                'clusters': clusters,
+                'records': self.model.export_news(member_ids, release=True),
+                'metrics': self.model.metrics.report()}
+
+
+class Transport():
+    """
+    coordinator與worker之間的傳輸介面, map將task送到worker並依task順序回傳summary
+    summary只包含list, dict, str, 數值以及bson Binary, 可以pickle或以bson json_util序列化
+    其他節點的實作 (例如message queue) 只需要提供 map 與 close
+    """
+    def map(self, tasks):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InlineTransport(Transport):
+    """
+    在同一個process中依序執行, 用於除錯
+    """
+    def __init__(self, config, news_reader=None):
+        self.worker = ShardWorker(config, news_reader=news_reader)
+
+    def map(self, tasks):
+        return [self.worker.run(task) for task in tasks]
+
+
+_worker = None
+
+
+def _init_worker(config):
+    global _worker
+    _worker = ShardWorker(config)
+
+
+def _run_task(task):
+    return _worker.run(task)
+
+
+class ProcessTransport(Transport):
+    """
+    本機的multiprocessing worker, 每個process各自連線mongoDB並讀取詞模型一次
+    """
+    def __init__(self, config, processes=2):
+        self.pool = multiprocessing.Pool(processes=processes, initializer=_init_worker, initargs=(config,))
+
+    def map(self, tasks):
+        return self.pool.map(_run_task, tasks, chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def reduce_summaries(summaries, merge_sim_thres, func, codec):
+    """
+    reduce: 依shard順序合併各shard的聚類, centroid相似度大於merge_sim_thres時合併到之前shard的聚類
+    同一個shard內的聚類已經由online_clustering分開, 不互相比較
+    :param summaries: list of summary, 依task順序
+    :param merge_sim_thres: 合併閾值
+    :param func: Function, 計算cosine similarity
+    :param codec: VectorCodec
+    :return: clusters_id, centroids: 格式同Model.online_clustering, 不包含成員向量
+    :return: stats: { 聚類id: ClusterStats.encode的結果 }, 只保留沒有被合併的聚類
+    :return: copies: { 重複的news id: 代表的news id }
+    :return: merged: 被合併的聚類數
+    """
+    sums = {}
+    counts = {}
+    clusters_id = {}
+    centroids = {}
+    stats = {}
+    copies = {}
+    merged = 0
+    for summary in sorted(summaries, key=lambda s: s['shard']):
+        # 只與之前shard的聚類比較, 以合併後最新的centroid計算
+        previous = list(centroids)
+        for cluster in summary['clusters']:
+            cluster_sum = codec.decode(cluster['sum']).astype(np.float)
+            copies.update(cluster['copies'])
+            centroid = cluster_sum / cluster['count']
+            best = None
+            if previous:
+                best = max(((key, func.cal_similarity(centroid, centroids[key])) for key in previous),
+                           key=lambda t: t[1])
+            if best and best[1] >= merge_sim_thres:
+                key = best[0]
+                sums[key] = sums[key] + cluster_sum
+                counts[key] += cluster['count']
+                clusters_id[key].extend(cluster['ids'])
+                # 合併後的統計量在重新評估時以成員向量重新計算
+                stats.pop(key, None)
+                merged += 1
+            else:
+                key = cluster['id']
+                sums[key] = cluster_sum
+                counts[key] = cluster['count']
+                clusters_id[key] = list(cluster['ids'])
+                stats[key] = cluster['stats']
+            centroids[key] = sums[key] / counts[key]
+    return clusters_id, centroids, stats, copies, merged
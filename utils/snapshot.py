@@ -0,0 +1,150 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import gzip
+import shutil
+import numpy as np
+from scipy import sparse
+
+
+class SnapshotManager():
+    """
+    聚類狀態快照, 每個時間段結束時寫入, 下次運行時讀取以取代從mongoDB重建event
+    目錄結構:
+        log/snapshot/latest.json            指向最新的快照
+        log/snapshot/<date>/manifest.json   版本, 維度, 閾值, 時間等資訊
+        log/snapshot/<date>/state.npz       centroid matrix, counts, membership (CSR), 父子關係, closed flag
+        log/snapshot/<date>/records.json.gz 成員新聞的精簡紀錄
+    """
+    VERSION = 1
+
+    def __init__(self, base_path, keep=3):
+        """
+        :param base_path: 快照目錄
+        :param keep: 保留的快照數
+        """
+        self.base_path = base_path
+        self.keep = keep
+
+    def save(self, name, manifest, state, records):
+        """
+        :param name: 快照名稱 (時間段的date)
+        :param manifest: dict, 額外寫入manifest的資訊
+        :param state: dict { event_id: (member_ids, member_vecs, centroid, father, closed, updated) }
+        :param records: list of dict, 成員新聞的精簡紀錄
+        :return: 快照目錄
+        """
+        if not os.path.exists(self.base_path):
+            os.makedirs(self.base_path)
+        path = os.path.join(self.base_path, name)
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.mkdir(tmp_path)
+
+        event_ids = sorted(state)
+        dim = manifest['dim']
+        counts = np.zeros(len(event_ids), dtype=np.int32)
+        centroids = np.zeros((len(event_ids), dim), dtype=np.float32)
+        fathers = []
+        closed = np.zeros(len(event_ids), dtype=np.bool_)
+        updated = []
+        member_ids = []
+        member_vecs = []
+        for i, event_id in enumerate(event_ids):
+            ids, vecs, centroid, father, is_closed, updated_t = state[event_id]
+            counts[i] = len(ids)
+            centroids[i] = centroid
+            fathers.append(father or "")
+            closed[i] = is_closed
+            updated.append(updated_t or "")
+            member_ids.extend(ids)
+            if len(ids):
+                member_vecs.append(sparse.csr_matrix(np.asarray(vecs, dtype=np.float32).reshape(len(ids), dim)))
+        if member_vecs:
+            members = sparse.vstack(member_vecs, format='csr')
+        else:
+            members = sparse.csr_matrix((0, dim), dtype=np.float32)
+
+        np.savez(os.path.join(tmp_path, "state.npz"),
+                 event_ids=np.array(event_ids, dtype=np.str_),
+                 counts=counts,
+                 sums=centroids * counts[:, None],
+                 centroids=centroids,
+                 fathers=np.array(fathers, dtype=np.str_),
+                 closed=closed,
+                 updated=np.array(updated, dtype=np.str_),
+                 member_ids=np.array(member_ids, dtype=np.str_),
+                 member_data=members.data,
+                 member_indices=members.indices,
+                 member_indptr=members.indptr)
+        with gzip.open(os.path.join(tmp_path, "records.json.gz"), "wb") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        manifest = dict(manifest)
+        manifest['version'] = self.VERSION
+        manifest['n_events'] = len(event_ids)
+        manifest['n_members'] = len(member_ids)
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            f.write(json.dumps(manifest))
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        with open(os.path.join(self.base_path, "latest.json"), "w") as f:
+            f.write(json.dumps({'name': name}))
+        self.cleanup()
+        return path
+
+    def cleanup(self):
+        names = sorted(name for name in os.listdir(self.base_path)
+                       if os.path.isdir(os.path.join(self.base_path, name)) and not name.endswith(".tmp"))
+        for name in names[:-self.keep]:
+            shutil.rmtree(os.path.join(self.base_path, name))
+
+    def load_manifest(self):
+        """
+        :return: 最新快照的manifest, 沒有快照或版本不符時回傳 None
+        """
+        latest_file = os.path.join(self.base_path, "latest.json")
+        if not os.path.exists(latest_file):
+            return None
+        with open(latest_file, "r") as f:
+            name = json.loads(f.read())['name']
+        manifest_file = os.path.join(self.base_path, name, "manifest.json")
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, "r") as f:
+            manifest = json.loads(f.read())
+        if manifest.get('version') != self.VERSION:
+            return None
+        manifest['name'] = name
+        return manifest
+
+    def load(self, manifest):
+        """
+        :param manifest: load_manifest的結果
+        :return: state: dict { event_id: (member_ids, member_vecs, centroid, father, closed, updated) }
+        :return: records: generator of dict
+        """
+        path = os.path.join(self.base_path, manifest['name'])
+        arrays = np.load(os.path.join(path, "state.npz"))
+        members = sparse.csr_matrix((arrays['member_data'], arrays['member_indices'], arrays['member_indptr']),
+                                    shape=(len(arrays['member_ids']), manifest['dim']))
+        member_ids = [str(i) for i in arrays['member_ids']]
+        offsets = np.concatenate(([0], np.cumsum(arrays['counts'])))
+        state = {}
+        for i, event_id in enumerate(arrays['event_ids']):
+            start, end = offsets[i], offsets[i + 1]
+            state[str(event_id)] = (member_ids[start:end],
+                                    members[start:end].toarray(),
+                                    arrays['centroids'][i],
+                                    str(arrays['fathers'][i]) or None,
+                                    bool(arrays['closed'][i]),
+                                    str(arrays['updated'][i]))
+
+        def records():
+            with gzip.open(os.path.join(path, "records.json.gz"), "rb") as f:
+                for line in f:
+                    yield json.loads(line)
+        return state, records()
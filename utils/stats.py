@@ -0,0 +1,136 @@
+# -*- coding:utf-8 -*-
+import math
+
+import numpy as np
+
+
+class ClusterStats():
+    """
+    聚類的充分統計量, 取代以全部成員向量計算centroid與 Function.get_cos
+    - vec_sum: 成員向量總和, centroid = vec_sum / n
+    - unit_sum: 成員單位向量 u 的總和, 成員與centroid的平均cosine similarity = unit_sum . c / (n |c|), 永遠是精確值
+    - ref: 上次精確計算時的單位centroid r, ref_sq = sum (u . r)^2, ref_sum = sum (u . r) u, 新成員也以 r 精確累加
+    - cosine similarity的平方和在centroid c = a r + d (d 垂直 r) 時為 a^2 ref_sq + 2a (ref_sum . d) + sum (u . d)^2,
+      最後一項以下界 (unit_sum . d)^2 / n 近似, 誤差只與centroid移動量的平方有關; c = r 時為精確值
+    - drift: centroid與 r 的 1 - cosine, 超過容許值 (Config.cluster_stats_tolerance) 時以成員向量重新精確計算
+    - stale: 上次精確計算後加入的成員數
+    成員只會附加在尾端, 以 n 與最後一個成員id (last) 確認統計量與目前的成員一致
+    """
+    def __init__(self, dim):
+        self.n = 0
+        self.vec_sum = np.zeros(dim)
+        self.unit_sum = np.zeros(dim)
+        self.ref = np.zeros(dim)
+        self.ref_sum = np.zeros(dim)
+        self.ref_sq = 0.
+        self.stale = 0
+        self.last = None
+
+    @staticmethod
+    def units(vecs):
+        norms = np.linalg.norm(vecs, axis=1)
+        return vecs / np.where(norms > 0, norms, 1.)[:, np.newaxis]
+
+    @classmethod
+    def from_vectors(cls, vecs, last=None):
+        """
+        以全部成員向量精確計算
+        :param vecs: np.array (n, dim)
+        :param last: 最後一個成員的id
+        """
+        vecs = np.asarray(vecs, dtype=np.float64)
+        stats = cls(vecs.shape[1])
+        stats.n = len(vecs)
+        stats.vec_sum = vecs.sum(axis=0)
+        units = cls.units(vecs)
+        stats.unit_sum = units.sum(axis=0)
+        stats.ref = stats.unit_centroid()
+        stats.accumulate(units)
+        stats.last = last
+        return stats
+
+    def add(self, vecs, last=None):
+        """
+        附加新成員, 不需要既有成員的向量
+        :param vecs: 新成員的向量, np.array (m, dim)
+        :param last: 最後一個成員的id
+        """
+        vecs = np.asarray(vecs, dtype=np.float64)
+        if not len(vecs):
+            return self
+        self.n += len(vecs)
+        self.vec_sum += vecs.sum(axis=0)
+        units = self.units(vecs)
+        self.unit_sum += units.sum(axis=0)
+        self.accumulate(units)
+        self.stale += len(vecs)
+        self.last = last
+        return self
+
+    def accumulate(self, units):
+        sims = units.dot(self.ref)
+        self.ref_sum += sims.dot(units)
+        self.ref_sq += float(sims.dot(sims))
+
+    def drift(self):
+        """
+        :return: 目前centroid與上次精確計算時的 1 - cosine
+        """
+        return 1. - float(self.unit_centroid().dot(self.ref))
+
+    def matches(self, members):
+        """
+        :param members: 目前的成員id list
+        :return: 統計量是否為members的前 n 個成員
+        """
+        return 0 < self.n <= len(members) and members[self.n - 1] == self.last
+
+    def centroid(self):
+        return self.vec_sum / self.n
+
+    def unit_centroid(self):
+        norm = np.linalg.norm(self.vec_sum)
+        return self.vec_sum / norm if norm > 0 else self.vec_sum
+
+    def dispersion(self):
+        """
+        :return: (cos, cos_std), 與 Function.get_cos 相同: 成員與centroid的cosine distance的平均與標準差
+        """
+        centroid = self.unit_centroid()
+        mean = float(self.unit_sum.dot(centroid)) / self.n
+        a = float(centroid.dot(self.ref))
+        d = centroid - a * self.ref
+        sq_sum = a * a * self.ref_sq + 2 * a * float(self.ref_sum.dot(d)) + float(self.unit_sum.dot(d)) ** 2 / self.n
+        var = sq_sum / self.n - mean * mean
+        return 1. - mean, math.sqrt(max(0., var))
+
+    def encode(self, codec):
+        """
+        存入event的格式, vec_sum 即 eventVector * n 不另外存放
+        向量只在成員的詞上非零, 由codec依非零比例選擇sparse或dense32
+        :param codec: utils.codec.VectorCodec
+        """
+        return {'n': self.n,
+                'unitSum': codec.encode(self.unit_sum),
+                'ref': codec.encode(self.ref),
+                'refSum': codec.encode(self.ref_sum),
+                'refSq': self.ref_sq,
+                'stale': self.stale,
+                'last': self.last}
+
+    @classmethod
+    def decode(cls, doc, codec, dim, centroid):
+        """
+        :param doc: encode的結果
+        :param centroid: 寫入時的centroid (eventVector)
+        """
+        stats = cls(dim)
+        stats.n = doc['n']
+        stats.vec_sum = np.asarray(centroid, dtype=np.float64) * stats.n
+        stats.unit_sum = np.asarray(codec.decode(doc['unitSum'], dim), dtype=np.float64)
+        stats.ref = np.asarray(codec.decode(doc['ref'], dim), dtype=np.float64)
+        stats.ref_sum = np.asarray(codec.decode(doc['refSum'], dim), dtype=np.float64)
+        stats.ref_sq = doc['refSq']
+        stats.stale = doc['stale']
+        stats.last = doc['last']
+        return stats
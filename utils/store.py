@@ -0,0 +1,151 @@
+# -*- coding:utf-8 -*-
+from collections import OrderedDict
+
+# 聚類以及寫入articles需要的欄位, 常駐記憶體
+LIGHT_FIELDS = ('_id', 'title', 'category', 'publisher', 'url', 'image', 'publishTime', 'crawlTime')
+# 只有write_event, write_result會用到的欄位, 寫入時批次讀取, 受記憶體上限管理
+HEAVY_FIELDS = ('content', 'keywords', 'when', 'where', 'who', 'persons', 'locations', 'organizations')
+# 向量化需要的欄位
+STEM_FIELDS = ('stemmedTitle', 'stemmedContent')
+
+
+class NewsRecord(object):
+    """
+    新聞的精簡紀錄, 只保留 LIGHT_FIELDS
+    """
+    __slots__ = ('id', 'title', 'category', 'publisher', 'url', 'image', 'publishTime', 'crawlTime')
+
+    def __init__(self, news_dict):
+        self.id = news_dict['_id']
+        self.title = news_dict.get('title', "")
+        self.category = news_dict.get('category', "")
+        self.publisher = news_dict.get('publisher', "")
+        self.url = news_dict.get('url', "")
+        self.image = news_dict.get('image', "")
+        self.publishTime = news_dict.get('publishTime', "")
+        self.crawlTime = news_dict.get('crawlTime', "")
+
+
+class NewsStore():
+    """
+    新聞紀錄存儲: NewsRecord常駐, HEAVY_FIELDS放在有記憶體上限的LRU cache中
+    cache中沒有的新聞在寫入時以 $in 批次從mongoDB讀取
+    """
+    def __init__(self, news_reader, budget_mb=256, batch_size=500):
+        """
+        :param news_reader: NewsReader
+        :param budget_mb: heavy欄位cache的記憶體上限 (MB, 以字串長度估計)
+        :param batch_size: 每次 $in 查詢的新聞數
+        """
+        self.__news_reader = news_reader
+        self.__budget = budget_mb * 1024 * 1024
+        self.__batch_size = batch_size
+        self.__records = {}
+        self.__heavy = OrderedDict()
+        self.__heavy_size = {}
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __contains__(self, news_id):
+        return news_id in self.__records
+
+    def __getitem__(self, news_id):
+        return self.__records[news_id]
+
+    def __len__(self):
+        return len(self.__records)
+
+    def fetch_fields(self):
+        """
+        :return: 讀取event中新聞時的projection, 不含heavy欄位
+        """
+        return dict((field, True) for field in LIGHT_FIELDS + STEM_FIELDS)
+
+    def add(self, news_dict):
+        """
+        加入新聞, 如果news_dict帶有heavy欄位則一併放入cache
+        :param news_dict: mongoDB news document
+        :return: NewsRecord
+        """
+        record = NewsRecord(news_dict)
+        self.__records[record.id] = record
+        if 'content' in news_dict:
+            self.__put_heavy(record.id, news_dict)
+        return record
+
+    def export(self, news_ids):
+        """
+        :param news_ids: list of news id
+        :return: list of dict, 精簡紀錄 (LIGHT_FIELDS), 可再以add讀回
+        """
+        result = []
+        for news_id in news_ids:
+            record = self.__records.get(news_id)
+            if record:
+                news_dict = dict((field, getattr(record, field)) for field in NewsRecord.__slots__[1:])
+                news_dict['_id'] = record.id
+                result.append(news_dict)
+        return result
+
+    def pop(self, news_id, default=None):
+        self.__drop_heavy(news_id)
+        return self.__records.pop(news_id, default)
+
+    def estimate(self, heavy):
+        size = len(heavy.get('content') or "")
+        for field in HEAVY_FIELDS[1:]:
+            size += 64 * len(heavy.get(field) or [])
+        return size
+
+    def __put_heavy(self, news_id, news_dict):
+        self.__drop_heavy(news_id)
+        heavy = dict((field, news_dict.get(field, [])) for field in HEAVY_FIELDS)
+        size = self.estimate(heavy)
+        self.__heavy[news_id] = heavy
+        self.__heavy_size[news_id] = size
+        self.__size += size
+        while self.__size > self.__budget and len(self.__heavy) > 1:
+            old_id, _ = self.__heavy.popitem(last=False)
+            self.__size -= self.__heavy_size.pop(old_id)
+            self.evicted += 1
+        return heavy
+
+    def __drop_heavy(self, news_id):
+        if news_id in self.__heavy:
+            del self.__heavy[news_id]
+            self.__size -= self.__heavy_size.pop(news_id)
+
+    def load_heavy(self, news_ids):
+        """
+        批次取得新聞的heavy欄位, cache中沒有的以 $in 從mongoDB讀取
+        回傳的dict由呼叫者持有, 即使之後被cache淘汰也不影響
+        :param news_ids: list of news id
+        :return: dict { news_id: { field: value } }
+        """
+        result = {}
+        missing = []
+        for news_id in news_ids:
+            if news_id in self.__heavy:
+                heavy = self.__heavy.pop(news_id)
+                self.__heavy[news_id] = heavy
+                result[news_id] = heavy
+                self.hits += 1
+            else:
+                missing.append(news_id)
+        self.misses += len(missing)
+        fields = dict((field, True) for field in HEAVY_FIELDS)
+        for i in range(0, len(missing), self.__batch_size):
+            batch = missing[i:i + self.__batch_size]
+            for news_dict in self.__news_reader.query_many_by_item({'_id': {'$in': batch}}, fields=fields):
+                result[news_dict['_id']] = self.__put_heavy(news_dict['_id'], news_dict)
+        return result
+
+    def report(self):
+        return {'records': len(self.__records),
+                'cached': len(self.__heavy),
+                'cache_mb': round(self.__size / 1024. / 1024., 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted}
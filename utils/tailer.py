@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+
+
+class NewsTailer():
+    """
+    以 (crawlTime, _id) 作為高水位線持續追蹤news collection, 並將新進的新聞切成micro-batch輸出
+    高水位線 (resume token) 在每個batch處理完成後寫入檔案, 程序重啟後從上次處理到的位置繼續
+    """
+    def __init__(self, news_reader, token_file, batch_size=200, max_latency=60, poll_interval=5):
+        """
+        :param news_reader: NewsReader
+        :param token_file: resume token的存放位置, json
+        :param batch_size: 每個micro-batch最多的新聞數
+        :param max_latency: 第一筆新聞進入buffer後最多等待的秒數, 超過即輸出batch
+        :param poll_interval: 沒有新新聞時的輪詢間隔秒數
+        """
+        self.__news_reader = news_reader
+        self.__token_file = token_file
+        self.__batch_size = batch_size
+        self.__max_latency = max_latency
+        self.__poll_interval = poll_interval
+        self.token = None
+
+    def load_token(self, crawl_time):
+        """
+        讀取resume token, 如果沒有token則從給定的crawlTime開始
+        :param crawl_time: 沒有token時的起始crawlTime
+        :return: token: dict {'crawlTime': str, '_id': str}
+        """
+        if os.path.exists(self.__token_file):
+            with open(self.__token_file, "r") as f:
+                self.token = json.loads(f.read())
+        else:
+            self.token = {'crawlTime': crawl_time, '_id': ""}
+        return self.token
+
+    def commit(self, batch):
+        """
+        batch處理完成後將高水位線推進到batch最後一筆新聞, 並寫回檔案
+        :param batch: list [ dict news_info, ... , ]
+        :return: token: dict
+        """
+        if not batch:
+            return self.token
+        last = batch[-1]
+        self.token = {'crawlTime': last['crawlTime'], '_id': last['_id']}
+        token_dir = os.path.dirname(self.__token_file)
+        if token_dir and not os.path.exists(token_dir):
+            os.mkdir(token_dir)
+        tmp_file = self.__token_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(json.dumps(self.token))
+        os.rename(tmp_file, self.__token_file)
+        return self.token
+
+    def poll(self, cursor_token, limit):
+        """
+        從高水位線之後讀取最多limit筆新聞
+        :param cursor_token: 本次查詢的高水位線 (尚未commit的buffer也要跳過)
+        :param limit: int
+        :return: list [ dict news_info, ... , ]
+        """
+        result = self.__news_reader.query_many_after(crawl_time=cursor_token['crawlTime'],
+                                                     news_id=cursor_token['_id'],
+                                                     limit=limit)
+        return list(result)
+
+    def batches(self):
+        """
+        持續輸出micro-batch, 當buffer滿batch_size或最早的新聞等待超過max_latency時輸出
+        每個batch處理完後呼叫commit(batch), 否則重啟時會重新處理 (at-least-once)
+        :return: generator of list [ dict news_info, ... , ]
+        """
+        buf = []
+        buf_since = None
+        cursor_token = dict(self.token)
+        while True:
+            news_list = self.poll(cursor_token, self.__batch_size - len(buf))
+            if news_list:
+                if not buf:
+                    buf_since = time.time()
+                buf.extend(news_list)
+                cursor_token = {'crawlTime': news_list[-1]['crawlTime'], '_id': news_list[-1]['_id']}
+
+            if buf and (len(buf) >= self.__batch_size or time.time() - buf_since >= self.__max_latency):
+                yield buf
+                buf = []
+                buf_since = None
+            # 等待下一次輪詢, 不超過buffer剩餘的等待時間
+            else:
+                wait = self.__poll_interval
+                if buf:
+                    wait = max(0, min(wait, self.__max_latency - (time.time() - buf_since)))
+                time.sleep(wait)